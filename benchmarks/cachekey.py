@@ -0,0 +1,121 @@
+"""
+Compare the time taken to build cache keys from the canonical form of
+queries with the key builder of catalogcache 0.2, which merged, sorted and
+repr'd the query.
+
+Run with the python of a Zope instance, eg.
+
+    bin/zopepy benchmarks/cachekey.py
+"""
+
+import sys
+import time
+import types
+from md5 import md5
+
+from DateTime import DateTime
+from Products.ZCatalog.Catalog import CatalogSearchArgumentsMap
+
+from collective.catalogcache import patch
+from collective.catalogcache import query
+
+class Index(object):
+
+    def __init__(self, meta_type):
+        self.meta_type = meta_type
+
+INDEXES = {
+    'portal_type': Index('FieldIndex'),
+    'review_state': Index('FieldIndex'),
+    'Subject': Index('KeywordIndex'),
+    'path': Index('ExtendedPathIndex'),
+    'effective': Index('DateIndex'),
+    'effectiveRange': Index('DateRangeIndex'),
+    'sortable_title': Index('FieldIndex'),
+    'SearchableText': Index('ZCTextIndex'),
+    }
+
+NOW = DateTime()
+
+QUERIES = (
+    ('single string', {'portal_type': 'Document'}),
+    ('two strings', {'portal_type': 'News Item',
+                     'review_state': 'published'}),
+    ('navigation', {'path': {'query': '/plone/news', 'depth': 1},
+                    'portal_type': ['Document', 'Folder', 'News Item'],
+                    'sort_on': 'getObjPositionInParent'}),
+    ('listing', {'portal_type': ('News Item', 'Event'),
+                 'review_state': 'published',
+                 'effectiveRange': NOW,
+                 'sort_on': 'effective', 'sort_order': 'reverse',
+                 'sort_limit': 5}),
+    ('date range', {'effective': {'query': [NOW - 7, NOW],
+                                  'range': 'min:max'},
+                    'Subject': ['a', 'b']}),
+    )
+
+def baseline_key(args):
+    # The key builder of catalogcache 0.2, without its bugs fixed
+    def pin_datetime(dt):
+        return dt.strftime('%Y-%m-%d.%h:%m %Z')
+
+    items = list(args.request.items())
+    items.extend(list(args.keywords.items()))
+    items.sort()
+    sorted = []
+    for k, v in items:
+        if isinstance(v, types.ListType):
+            v.sort()
+        elif isinstance(v, types.TupleType):
+            v = list(v)
+            v.sort()
+        elif isinstance(v, DateTime):
+            v = pin_datetime(v)
+        elif isinstance(v, types.DictType):
+            tsorted = []
+            titems = v.items()
+            titems.sort()
+            for tk, tv in titems:
+                if isinstance(tv, DateTime):
+                    tv = pin_datetime(tv)
+                elif isinstance(tv, types.ListType) \
+                    or isinstance(tv, types.TupleType):
+                    li = []
+                    for item in list(tv):
+                        if isinstance(item, DateTime):
+                            item = pin_datetime(item)
+                        li.append(item)
+                    tv = li
+                tsorted.append((tk, tv))
+            v = tsorted
+        sorted.append((k, v))
+    return md5(str(sorted)).hexdigest()
+
+def canonical_key(args):
+    canonical = query.normalize(args, INDEXES, patch._pin_time)
+    return query.digest(canonical + '|' + '1700000000000')
+
+def measure(function, args, repeat):
+    best = None
+    for run in range(3):
+        start = time.time()
+        for i in xrange(repeat):
+            function(args)
+        elapsed = (time.time() - start) / repeat
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best * 1000000
+
+def main(repeat=20000):
+    print '%-16s %12s %12s' % ('query', 'baseline us', 'canonical us')
+    for name, kw in QUERIES:
+        args = CatalogSearchArgumentsMap({}, kw)
+        print '%-16s %12.1f %12.1f' % (name,
+            measure(baseline_key, args, repeat),
+            measure(canonical_key, args, repeat))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,71 @@
+"""
+Compare the transactional write buffer with the list based overlay of
+catalogcache 0.2 for transactions which reindex many objects. Per object
+the rid map is deleted, a value is set and a key is read through the
+buffer.
+
+Run with the python of a Zope instance, eg.
+
+    bin/zopepy benchmarks/writebuffer.py [--all] [objects ...]
+
+The list based overlay is quadratic, so it is only measured up to 20000
+objects unless --all is given.
+"""
+
+import sys
+import time
+
+from collective.catalogcache.datastructures import WriteBuffer
+
+BASELINE_MAX = 20000
+
+class ListBuffer(object):
+    """
+    The overlay of catalogcache 0.2: txn.v_cache and the list
+    txn.v_delete_cache
+    """
+
+    def __init__(self):
+        self.cache = {}
+        self.delete_cache = []
+
+    def set(self, key, value):
+        self.cache[key] = value
+        if key in self.delete_cache:
+            try:
+                self.delete_cache.remove(key)
+            except ValueError:
+                pass
+
+    def delete(self, key):
+        if key not in self.delete_cache:
+            self.delete_cache.append(key)
+        self.cache.pop(key, None)
+
+    def get(self, key, default=None):
+        if key in self.delete_cache:
+            return default
+        return self.cache.get(key, default)
+
+def reindex(buffer, objects):
+    start = time.time()
+    for rid in xrange(objects):
+        buffer.delete('/plone/portal_catalog%d' % rid)
+        buffer.set('/plone/portal_catalog_q%d' % rid, 'x')
+        buffer.get('/plone/portal_catalog%d' % (rid // 2))
+    return time.time() - start
+
+def main(args):
+    everything = '--all' in args
+    sizes = [int(a) for a in args if a != '--all'] or [10000, 100000]
+    print '%10s %14s %14s' % ('objects', 'list based s', 'WriteBuffer s')
+    for objects in sizes:
+        if everything or (objects <= BASELINE_MAX):
+            baseline = '%14.3f' % reindex(ListBuffer(), objects)
+        else:
+            baseline = '%14s' % 'skipped'
+        print '%10d %s %14.3f' % (objects, baseline,
+                                  reindex(WriteBuffer(), objects))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
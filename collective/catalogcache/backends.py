@@ -0,0 +1,665 @@
+import os
+import stat
+import mmap
+import time
+import struct
+import threading
+from bisect import bisect
+from md5 import md5
+from cPickle import dumps, loads
+
+from zope.interface import implements
+from Products.ZCatalog.Catalog import LOG
+
+from collective.catalogcache.interfaces import ICacheBackend
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of one server. After threshold consecutive failures
+    the breaker opens and the server is not used for retry_interval
+    seconds. Then one caller may probe the server. The breaker closes on
+    success and opens again on failure.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    PROBING = 'probing'
+
+    def __init__(self, threshold=5, retry_interval=10):
+        self.threshold = threshold
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+
+    def allow(self):
+        """
+        Returns: CLOSED if the server may be used, PROBING if the caller
+        should probe it or None if it may not be used.
+        """
+        if self.state is self.CLOSED:
+            return self.CLOSED
+        self.lock.acquire()
+        try:
+            if (self.state is self.OPEN) \
+                and (time.time() - self.opened >= self.retry_interval):
+                self.state = self.PROBING
+                return self.PROBING
+            return None
+        finally:
+            self.lock.release()
+
+    def success(self):
+        if (self.state is self.CLOSED) and not self.failures:
+            return
+        self.lock.acquire()
+        try:
+            self.state = self.CLOSED
+            self.failures = 0
+        finally:
+            self.lock.release()
+
+    def failure(self):
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if (self.state is self.PROBING) or (self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.opened = time.time()
+        finally:
+            self.lock.release()
+
+class HashRing(object):
+    """
+    Consistent hashing of keys to nodes, so that removing a node only
+    moves the keys of that node.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        self.points = []
+        ring = {}
+        for node in nodes:
+            for i in range(replicas):
+                ring[self._hash('%s-%s' % (node, i))] = node
+        self.points = ring.keys()
+        self.points.sort()
+        self.nodes = [ring[point] for point in self.points]
+
+    def _hash(self, key):
+        return int(md5(key).hexdigest()[:8], 16)
+
+    def get(self, key):
+        i = bisect(self.points, self._hash(key))
+        if i == len(self.points):
+            i = 0
+        return self.nodes[i]
+
+class MemcachedBackend(object):
+    """
+    Stores entries in memcached through one python-memcached client per
+    server. Clients keep their connections per thread, so every thread
+    has its own connection to each server. Keys are distributed over the
+    servers by consistent hashing. Every server has a circuit breaker, so a
+    failing server only makes its own keys miss. A server is flushed when
+    it recovers, since it missed the invalidations done while it was not
+    used.
+
+    Raises TypeError if python-memcached is older than 1.45, which has no
+    socket timeouts.
+    """
+
+    implements(ICacheBackend)
+
+    # The patch need not stop using every server when one fails
+    tracks_health = True
+
+    def __init__(self, servers, timeout=0.5, failure_threshold=5,
+                 retry_interval=10):
+        self.servers = servers
+        self.ring = HashRing(servers)
+        self.clients = {}
+        self.breakers = {}
+        for server in servers:
+            self.clients[server] = memcache.Client([server], debug=0,
+                socket_timeout=timeout, dead_retry=retry_interval)
+            self.breakers[server] = CircuitBreaker(failure_threshold,
+                                                   retry_interval)
+
+    def _call(self, server, method, *args, **kw):
+        """
+        Call method of a client of server.
+
+        Returns: (True, result) or (False, None) if the server failed or
+        may not be used
+        """
+        breaker = self.breakers[server]
+        state = breaker.allow()
+        if state is None:
+            return False, None
+        client = self.clients[server]
+        try:
+            if state is breaker.PROBING:
+                LOG.info("Flushing recovering memcached server %s" % server)
+                client.flush_all()
+                if self._dead(client):
+                    breaker.failure()
+                    return False, None
+            result = getattr(client, method)(*args, **kw)
+            dead = self._dead(client)
+        except Exception:
+            LOG.exception("memcached %s on %s failed" % (method, server))
+            breaker.failure()
+            return False, None
+        if dead:
+            LOG.error("memcached server %s failed" % server)
+            breaker.failure()
+            return False, None
+        breaker.success()
+        return True, result
+
+    def _dead(self, client):
+        # python-memcached marks a server dead instead of raising
+        for host in client.servers:
+            if getattr(host, 'deaduntil', 0) > time.time():
+                return True
+        return False
+
+    def _group(self, keys, key_prefix=''):
+        # server -> list of keys
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.ring.get(key_prefix + key), []).append(key)
+        return groups
+
+    def get(self, key):
+        ok, result = self._call(self.ring.get(key), 'get', key)
+        return result
+
+    def get_multi(self, keys, key_prefix=''):
+        result = {}
+        for server, server_keys in self._group(keys, key_prefix).items():
+            ok, found = self._call(server, 'get_multi', server_keys,
+                                   key_prefix=key_prefix)
+            if ok and found:
+                result.update(found)
+        return result
+
+    def set_multi(self, mapping, key_prefix='', time=0):
+        failed = []
+        for server, server_keys in self._group(mapping.keys(), key_prefix).items():
+            to_set = {}
+            for key in server_keys:
+                to_set[key] = mapping[key]
+            ok, notstored = self._call(server, 'set_multi', to_set,
+                                       key_prefix=key_prefix, time=time)
+            if not ok:
+                failed.extend(server_keys)
+            elif notstored:
+                failed.extend(notstored)
+        return failed
+
+    def add(self, key, val, time=0):
+        ok, result = self._call(self.ring.get(key), 'add', key, val, time=time)
+        return ok and result
+
+    def incr(self, key, delta=1):
+        ok, result = self._call(self.ring.get(key), 'incr', key, delta)
+        return result
+
+    def delete_multi(self, keys):
+        success = 1
+        for server, server_keys in self._group(keys).items():
+            ok, result = self._call(server, 'delete_multi', server_keys)
+            if not (ok and result):
+                success = 0
+        return success
+
+    def flush_all(self):
+        for server in self.servers:
+            self._call(server, 'flush_all')
+
+# Layout of the memory mapped file. The file is divided into buckets of
+# equal size. A key is stored in the bucket selected by its digest. A
+# bucket starts with a header holding a format marker, the number of bytes
+# of entries in use and the number of slots which are not empty. The
+# header is followed by an open addressing table of slots, each holding a
+# hash of a key and the offset of its entry in the bucket, and by the
+# entries in the order they were written. An entry is a header followed by
+# the key and the value. A lookup probes the slots and reads one entry.
+# Replaced and deleted entries are left in place until the bucket is full,
+# when its live entries are compacted and the oldest ones evicted.
+BUCKET_MAGIC = 'CCB2'
+BUCKET_HEADER = '>4sII'
+BUCKET_HEADER_SIZE = struct.calcsize(BUCKET_HEADER)
+SLOT = '>II'
+SLOT_SIZE = struct.calcsize(SLOT)
+SLOT_EMPTY = 0
+SLOT_DELETED = 1
+# One slot per this many bytes of a bucket. At most MAX_LOAD of the slots
+# are used.
+BYTES_PER_SLOT = 64
+MAX_LOAD = 0.75
+ENTRY_HEADER = '>IIIB'
+ENTRY_HEADER_SIZE = struct.calcsize(ENTRY_HEADER)
+FLAG_STRING = 0
+FLAG_INTEGER = 1
+FLAG_PICKLE = 2
+# Durations longer than 30 days are timestamps, as in memcached
+MAX_RELATIVE_DURATION = 60*60*24*30
+
+class MMapBackend(object):
+    """
+    Stores entries in a memory mapped file which is shared by all processes
+    on a host. Buckets are locked with fcntl across processes and with
+    thread locks within a process.
+    """
+
+    implements(ICacheBackend)
+
+    def __init__(self, path, size=64*1024*1024, bucket_size=256*1024):
+        self.path = path
+        self.bucket_size = bucket_size
+        self.buckets = max(1, size / bucket_size)
+        self.size = self.buckets * bucket_size
+        self.slots = max(16, bucket_size / BYTES_PER_SLOT)
+        self.max_filled = int(self.slots * MAX_LOAD)
+        # Offset of the first entry in a bucket
+        self.entries_start = BUCKET_HEADER_SIZE + self.slots * SLOT_SIZE
+        self.capacity = bucket_size - self.entries_start
+        if self.capacity <= ENTRY_HEADER_SIZE:
+            raise ValueError("Bucket size %s is too small" % bucket_size)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT,
+                          stat.S_IRUSR | stat.S_IWUSR)
+        if os.fstat(self.fd).st_size < self.size:
+            # New buckets are zero filled, ie. empty
+            os.ftruncate(self.fd, self.size)
+        self.map = mmap.mmap(self.fd, self.size)
+        self.locks = [threading.Lock() for i in range(self.buckets)]
+
+    # Locking
+
+    def _lock(self, bucket):
+        self.locks[bucket].acquire()
+        if fcntl is not None:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, self.bucket_size,
+                            bucket * self.bucket_size)
+            except:
+                self.locks[bucket].release()
+                raise
+
+    def _unlock(self, bucket):
+        try:
+            if fcntl is not None:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, self.bucket_size,
+                            bucket * self.bucket_size)
+        finally:
+            self.locks[bucket].release()
+
+    # Buckets
+
+    def _locate(self, key):
+        """
+        Returns: (bucket, hash) of key
+        """
+        bucket, h = struct.unpack('>II', md5(key).digest()[:8])
+        return bucket % self.buckets, h
+
+    def _header(self, bucket):
+        """
+        Returns: (bytes of entries in use, slots which are not empty). A
+        bucket which is not in the current format, eg. a new one or one
+        corrupted by a crash during a write, is cleared.
+        """
+        offset = bucket * self.bucket_size
+        magic, used, filled = struct.unpack(BUCKET_HEADER,
+            self.map[offset:offset+BUCKET_HEADER_SIZE])
+        if (magic != BUCKET_MAGIC) or (used > self.capacity) \
+            or (filled > self.slots):
+            self._clear(bucket)
+            return 0, 0
+        return used, filled
+
+    def _set_header(self, bucket, used, filled):
+        offset = bucket * self.bucket_size
+        self.map[offset:offset+BUCKET_HEADER_SIZE] = struct.pack(
+            BUCKET_HEADER, BUCKET_MAGIC, used, filled)
+
+    def _clear(self, bucket):
+        offset = bucket * self.bucket_size
+        self.map[offset:offset+self.entries_start] = \
+            struct.pack(BUCKET_HEADER, BUCKET_MAGIC, 0, 0) \
+            + '\0' * (self.slots * SLOT_SIZE)
+
+    def _slot(self, bucket, i):
+        """
+        Returns: (hash, offset) of slot i
+        """
+        position = bucket * self.bucket_size + BUCKET_HEADER_SIZE \
+            + i * SLOT_SIZE
+        return struct.unpack(SLOT, self.map[position:position+SLOT_SIZE])
+
+    def _set_slot(self, bucket, i, h, offset):
+        position = bucket * self.bucket_size + BUCKET_HEADER_SIZE \
+            + i * SLOT_SIZE
+        self.map[position:position+SLOT_SIZE] = struct.pack(SLOT, h, offset)
+
+    def _entry(self, bucket, offset):
+        """
+        Returns: [key, expires, flags, data] of the entry at offset in
+        bucket, or None if it does not fit the bucket.
+        """
+        if (offset < self.entries_start) \
+            or (offset + ENTRY_HEADER_SIZE > self.bucket_size):
+            return None
+        position = bucket * self.bucket_size + offset
+        keylen, datalen, expires, flags = struct.unpack(ENTRY_HEADER,
+            self.map[position:position+ENTRY_HEADER_SIZE])
+        if offset + ENTRY_HEADER_SIZE + keylen + datalen > self.bucket_size:
+            return None
+        position += ENTRY_HEADER_SIZE
+        key = self.map[position:position+keylen]
+        position += keylen
+        data = self.map[position:position+datalen]
+        return [key, expires, flags, data]
+
+    def _find(self, bucket, key, h):
+        """
+        Probe the slots of bucket for key.
+
+        Returns: (slot, entry) of key, or (slot, None) where slot is the
+        first deleted or empty slot in which key may be indexed. Expired
+        entries are returned as well.
+        """
+        free = None
+        i = h % self.slots
+        for n in xrange(self.slots):
+            slot_hash, offset = self._slot(bucket, i)
+            if offset == SLOT_EMPTY:
+                if free is None:
+                    free = i
+                break
+            if offset == SLOT_DELETED:
+                if free is None:
+                    free = i
+            elif slot_hash == h:
+                entry = self._entry(bucket, offset)
+                if (entry is not None) and (entry[0] == key):
+                    return i, entry
+            i = (i + 1) % self.slots
+        return free, None
+
+    def _get(self, bucket, key, h):
+        """
+        Returns: the unexpired [key, expires, flags, data] of key or None
+        """
+        self._header(bucket)
+        i, entry = self._find(bucket, key, h)
+        if entry is None:
+            return None
+        expires = entry[1]
+        if expires and (expires <= int(time.time())):
+            return None
+        return entry
+
+    def _store(self, bucket, key, h, expires, flags, data):
+        """
+        Append an entry for key to bucket and index it, compacting the
+        bucket first if it is full.
+        """
+        size = ENTRY_HEADER_SIZE + len(key) + len(data)
+        used, filled = self._header(bucket)
+        i, entry = self._find(bucket, key, h)
+        new_slot = (entry is None) \
+            and (self._slot(bucket, i)[1] == SLOT_EMPTY)
+        if (used + size > self.capacity) \
+            or (new_slot and (filled >= self.max_filled)):
+            self._compact(bucket, size, key)
+            used, filled = self._header(bucket)
+            i, entry = self._find(bucket, key, h)
+            new_slot = True
+        offset = self.entries_start + used
+        position = bucket * self.bucket_size + offset
+        self.map[position:position+size] = struct.pack(ENTRY_HEADER,
+            len(key), len(data), expires, flags) + key + data
+        # The entry is written before it is indexed, so an interrupted
+        # write leaves an unreferenced entry at worst
+        if new_slot:
+            filled += 1
+        self._set_header(bucket, used + size, filled)
+        self._set_slot(bucket, i, h, offset)
+
+    def _compact(self, bucket, needed, skip=None):
+        """
+        Rewrite the live entries of bucket, except the one of skip, in
+        order, evicting the oldest ones until an entry of needed bytes fits.
+        """
+        base = bucket * self.bucket_size
+        table = struct.unpack('>%dI' % (2 * self.slots),
+            self.map[base+BUCKET_HEADER_SIZE:base+self.entries_start])
+        now = int(time.time())
+        live = []
+        for i in xrange(0, len(table), 2):
+            offset = table[i+1]
+            if offset <= SLOT_DELETED:
+                continue
+            entry = self._entry(bucket, offset)
+            if (entry is None) or (entry[0] == skip) \
+                or (entry[1] and (entry[1] <= now)):
+                continue
+            live.append((offset, table[i], entry))
+        # Oldest first
+        live.sort()
+        sizes = [ENTRY_HEADER_SIZE + len(e[0]) + len(e[3]) \
+                 for offset, h, e in live]
+        total = sum(sizes)
+        start = 0
+        while (start < len(live)) \
+            and ((total + needed > self.capacity) \
+                 or (len(live) - start >= self.max_filled)):
+            total -= sizes[start]
+            start += 1
+
+        slots = [0] * (2 * self.slots)
+        chunks = []
+        offset = self.entries_start
+        for n in xrange(start, len(live)):
+            h, entry = live[n][1], live[n][2]
+            key, expires, flags, data = entry
+            i = h % self.slots
+            while slots[2*i+1] != SLOT_EMPTY:
+                i = (i + 1) % self.slots
+            slots[2*i] = h
+            slots[2*i+1] = offset
+            chunks.append(struct.pack(ENTRY_HEADER, len(key), len(data),
+                                      expires, flags))
+            chunks.append(key)
+            chunks.append(data)
+            offset += sizes[n]
+        buf = struct.pack(BUCKET_HEADER, BUCKET_MAGIC, total,
+                          len(live) - start) \
+            + struct.pack('>%dI' % len(slots), *slots) + ''.join(chunks)
+        self.map[base:base+len(buf)] = buf
+
+    # Values
+
+    def _encode(self, val):
+        if isinstance(val, str):
+            return FLAG_STRING, val
+        if isinstance(val, (int, long)):
+            return FLAG_INTEGER, str(val)
+        return FLAG_PICKLE, dumps(val, 2)
+
+    def _decode(self, flags, data):
+        if flags == FLAG_STRING:
+            return data
+        if flags == FLAG_INTEGER:
+            return int(data)
+        return loads(data)
+
+    def _expires(self, duration):
+        if not duration:
+            return 0
+        if duration > MAX_RELATIVE_DURATION:
+            return int(duration)
+        return int(time.time()) + int(duration)
+
+    def _group(self, keys, key_prefix=''):
+        # bucket -> list of (key, hash)
+        groups = {}
+        for key in keys:
+            bucket, h = self._locate(key_prefix + key)
+            groups.setdefault(bucket, []).append((key, h))
+        return groups
+
+    # ICacheBackend
+
+    def get(self, key):
+        return self.get_multi([key]).get(key)
+
+    def get_multi(self, keys, key_prefix=''):
+        result = {}
+        for bucket, bucket_keys in self._group(keys, key_prefix).items():
+            found = []
+            self._lock(bucket)
+            try:
+                for key, h in bucket_keys:
+                    entry = self._get(bucket, key_prefix + key, h)
+                    if entry is not None:
+                        found.append((key, entry[2], entry[3]))
+            finally:
+                self._unlock(bucket)
+            for key, flags, data in found:
+                try:
+                    result[key] = self._decode(flags, data)
+                except Exception:
+                    LOG.error("Unable to decode %s from %s" \
+                        % (key_prefix + key, self.path))
+        return result
+
+    def set_multi(self, mapping, key_prefix='', time=0):
+        failed = []
+        expires = self._expires(time)
+        for bucket, bucket_keys in self._group(mapping.keys(), key_prefix).items():
+            new = []
+            for key, h in bucket_keys:
+                flags, data = self._encode(mapping[key])
+                full_key = key_prefix + key
+                if ENTRY_HEADER_SIZE + len(full_key) + len(data) > self.capacity:
+                    failed.append(key)
+                    continue
+                new.append((full_key, h, flags, data))
+            if not new:
+                continue
+            self._lock(bucket)
+            try:
+                for full_key, h, flags, data in new:
+                    self._store(bucket, full_key, h, expires, flags, data)
+            finally:
+                self._unlock(bucket)
+        return failed
+
+    def add(self, key, val, time=0):
+        flags, data = self._encode(val)
+        if ENTRY_HEADER_SIZE + len(key) + len(data) > self.capacity:
+            return 0
+        bucket, h = self._locate(key)
+        self._lock(bucket)
+        try:
+            if self._get(bucket, key, h) is not None:
+                return 0
+            self._store(bucket, key, h, self._expires(time), flags, data)
+        finally:
+            self._unlock(bucket)
+        return 1
+
+    def incr(self, key, delta=1):
+        bucket, h = self._locate(key)
+        self._lock(bucket)
+        try:
+            entry = self._get(bucket, key, h)
+            if entry is None:
+                return None
+            try:
+                value = int(entry[3]) + delta
+            except ValueError:
+                return None
+            self._store(bucket, key, h, entry[1], entry[2], str(value))
+            return value
+        finally:
+            self._unlock(bucket)
+
+    def delete_multi(self, keys):
+        for bucket, bucket_keys in self._group(keys).items():
+            self._lock(bucket)
+            try:
+                self._header(bucket)
+                for key, h in bucket_keys:
+                    i, entry = self._find(bucket, key, h)
+                    if entry is not None:
+                        # The entry is reclaimed by the next compaction
+                        self._set_slot(bucket, i, h, SLOT_DELETED)
+            finally:
+                self._unlock(bucket)
+        return 1
+
+    def flush_all(self):
+        for bucket in range(self.buckets):
+            self._lock(bucket)
+            try:
+                self._clear(bucket)
+            finally:
+                self._unlock(bucket)
+
+def getBackend():
+    """
+    Return the backend configured through the environment or None if
+    caching is not possible.
+
+    CATALOGCACHE_BACKEND selects either memcached, the default, or mmap.
+    """
+    name = os.environ.get('CATALOGCACHE_BACKEND', 'memcached')
+
+    if name == 'mmap':
+        path = os.environ.get('CATALOGCACHE_MMAP_FILE', '')
+        if not path:
+            LOG.info("No CATALOGCACHE_MMAP_FILE defined. Catalog will function as normal.")
+            return None
+        size = int(os.environ.get('CATALOGCACHE_MMAP_SIZE', 64*1024*1024))
+        bucket_size = int(os.environ.get('CATALOGCACHE_MMAP_BUCKET_SIZE', 256*1024))
+        LOG.info("Using memory mapped file %s" % path)
+        return MMapBackend(path, size, bucket_size)
+
+    if memcache is None:
+        LOG.info("Cannot import memcached. Catalog will function as normal.")
+        return None
+
+    s = os.environ.get('MEMCACHE_SERVERS', '')
+    if not s:
+        LOG.info("No memcached servers defined. Catalog will function as normal.")
+        return None
+
+    servers = s.split(',')
+    try:
+        backend = MemcachedBackend(servers,
+            timeout=float(os.environ.get('CATALOGCACHE_MEMCACHE_TIMEOUT', 0.5)),
+            failure_threshold=int(os.environ.get('CATALOGCACHE_MEMCACHE_FAILURES', 5)),
+            retry_interval=int(os.environ.get('CATALOGCACHE_MEMCACHE_RETRY_INTERVAL', 10)))
+    except TypeError:
+        # Without socket timeouts a hanging server blocks every thread
+        LOG.error("python-memcached 1.45 or later is required for socket "
+                  "timeouts. Catalog will function as normal.")
+        return None
+    LOG.info("Using memcached servers %s" % ",".join(servers))
+    return backend
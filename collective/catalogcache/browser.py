@@ -0,0 +1,75 @@
+from Products.Five.browser import BrowserView
+from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
+
+from collective.catalogcache import metrics
+
+class MetricsView(BrowserView):
+    """
+    Cache metrics of a catalog in this process
+    """
+
+    template = ViewPageTemplateFile('metrics.pt')
+
+    def cache_id(self):
+        return '/'.join(self.context.getPhysicalPath())
+
+    def report(self):
+        return metrics.report(self.cache_id())
+
+    def process_report(self):
+        return metrics.report(metrics.PROCESS)
+
+    def counters(self):
+        counters = self.report()['counters']
+        return [{'name': name, 'value': counters.get(name, 0)} \
+                for name in metrics.COUNTERS]
+
+    def latencies(self):
+        latency = self.report()['latency']
+        result = []
+        for name in metrics.TIMERS:
+            snapshot = latency[name].copy()
+            snapshot['name'] = name
+            result.append(snapshot)
+        return result
+
+    def __call__(self):
+        if self.request.form.get('reset'):
+            metrics.clear(self.cache_id())
+        return self.template()
+
+class MetricsJSONView(MetricsView):
+    """
+    Cache metrics of a catalog and of this process as JSON
+    """
+
+    def __call__(self):
+        # Python 2.4 has no json module and simplejson is optional
+        try:
+            import json
+        except ImportError:
+            try:
+                import simplejson as json
+            except ImportError:
+                self.request.response.setStatus(501)
+                self.request.response.setHeader('Content-Type', 'text/plain')
+                return 'Install simplejson to get the metrics as JSON.'
+        self.request.response.setHeader('Content-Type', 'application/json')
+        return json.dumps({
+            'catalog': self.report(),
+            'process': self.process_report(),
+            })
+
+class WarmUpView(BrowserView):
+    """
+    Replay the most frequent queries of a catalog in the background so
+    that their results are cached, eg. after a restart
+    """
+
+    def __call__(self):
+        if self.request.get('REQUEST_METHOD', 'GET') != 'POST':
+            self.request.response.setStatus(405)
+            return 'Use POST to warm up the cache.'
+        count = self.context._catalog.warmUp(wait=False)
+        self.request.response.setHeader('Content-Type', 'text/plain')
+        return 'Warming up the cache with %s queries.' % count
@@ -0,0 +1,123 @@
+"""
+Compact serialization of cached result sets.
+
+A value is a version byte, a kind byte, an optional stamp and the payload.
+Rids and weights are packed as little endian 32 bit integers, which is
+what IIBTree stores, and the payload is compressed with zlib above a size
+threshold. Decoding rebuilds the BTrees set or bucket directly from the
+packed integers without going through pickle.
+"""
+
+import sys
+import struct
+import zlib
+from array import array
+from os import environ
+
+from BTrees.IIBTree import IISet, IIBucket
+
+VERSION = 1
+
+KIND_SET = 1
+KIND_BUCKET = 2
+KIND_LIST = 3
+KIND_MASK = 0x0f
+STAMPED = 0x10
+COMPRESSED = 0x80
+
+HEADER = '<BB'
+HEADER_SIZE = struct.calcsize(HEADER)
+STAMP = '<q'
+STAMP_SIZE = struct.calcsize(STAMP)
+COUNT = '<I'
+COUNT_SIZE = struct.calcsize(COUNT)
+
+# Payloads larger than this many bytes are compressed. Zero disables
+# compression.
+COMPRESS_THRESHOLD = int(environ.get('CATALOGCACHE_COMPRESS_THRESHOLD', 16384))
+
+_swap = sys.byteorder == 'big'
+
+class CodecError(ValueError):
+    pass
+
+def _pack(values):
+    a = array('i', values)
+    if _swap:
+        a.byteswap()
+    return a.tostring()
+
+def _unpack(data):
+    a = array('i')
+    a.fromstring(data)
+    if _swap:
+        a.byteswap()
+    return a
+
+def encode(rs, stamp=None):
+    """
+    Encode rs, which is a set or bucket of rids or an ordered list of rids.
+    The optional integer stamp is returned by decode along with rs.
+    """
+    if isinstance(rs, list):
+        kind = KIND_LIST
+        payload = _pack(rs)
+    elif hasattr(rs, 'values'):
+        # A bucket of rid to weight
+        kind = KIND_BUCKET
+        keys = rs.keys()
+        payload = struct.pack(COUNT, len(keys)) + _pack(keys) \
+            + _pack(rs.values())
+    else:
+        kind = KIND_SET
+        payload = _pack(rs.keys())
+
+    if COMPRESS_THRESHOLD and (len(payload) > COMPRESS_THRESHOLD):
+        payload = zlib.compress(payload, 1)
+        kind = kind | COMPRESSED
+
+    if stamp is None:
+        return struct.pack(HEADER, VERSION, kind) + payload
+    return struct.pack(HEADER, VERSION, kind | STAMPED) \
+        + struct.pack(STAMP, stamp) + payload
+
+def decode(data):
+    """
+    Returns: (stamp or None, rs). Raises CodecError on values not written
+    by encode.
+    """
+    if not isinstance(data, str) or (len(data) < HEADER_SIZE):
+        raise CodecError("Not an encoded result set")
+    version, kind = struct.unpack(HEADER, data[:HEADER_SIZE])
+    if version != VERSION:
+        raise CodecError("Unsupported version %s" % version)
+
+    position = HEADER_SIZE
+    stamp = None
+    if kind & STAMPED:
+        stamp = struct.unpack(STAMP, data[position:position+STAMP_SIZE])[0]
+        position += STAMP_SIZE
+
+    payload = data[position:]
+    if kind & COMPRESSED:
+        try:
+            payload = zlib.decompress(payload)
+        except zlib.error:
+            raise CodecError("Corrupt payload")
+
+    kind = kind & KIND_MASK
+    if kind == KIND_BUCKET:
+        count = struct.unpack(COUNT, payload[:COUNT_SIZE])[0]
+        split = COUNT_SIZE + 4 * count
+        keys = _unpack(payload[COUNT_SIZE:split])
+        values = _unpack(payload[split:])
+        if len(values) != count:
+            raise CodecError("Corrupt bucket")
+        return stamp, IIBucket(zip(keys, values))
+    if len(payload) % 4:
+        raise CodecError("Corrupt payload")
+    if kind == KIND_SET:
+        return stamp, IISet(_unpack(payload))
+    if kind == KIND_LIST:
+        return stamp, _unpack(payload).tolist()
+    raise CodecError("Unsupported kind %s" % kind)
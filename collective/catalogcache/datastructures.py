@@ -0,0 +1,631 @@
+import time
+import threading
+from collections import deque
+
+_missing = object()
+
+class LRUCache(object):
+    """
+    A thread safe least recently used cache bounded by the number of
+    entries and by the total size of the entries. Sizes are supplied by
+    the caller.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.lock = threading.Lock()
+        # key -> [previous, next, key, value, size]. The root link of the
+        # circular list precedes the most recently used entry.
+        self.mapping = {}
+        self.root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.mapping.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._link(link)
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, size=0):
+        if not self.max_entries:
+            return
+        if self.max_bytes and (size > self.max_bytes):
+            # Never fits
+            self.delete(key)
+            return
+        self.lock.acquire()
+        try:
+            link = self.mapping.get(key)
+            if link is not None:
+                self._unlink(link)
+                self.bytes -= link[4]
+                link[3] = value
+                link[4] = size
+            else:
+                link = [None, None, key, value, size]
+                self.mapping[key] = link
+            self._link(link)
+            self.bytes += size
+            self._evict()
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            link = self.mapping.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+                self.bytes -= link[4]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.mapping.clear()
+            root = self.root
+            root[:] = [root, root, None, None, 0]
+            self.bytes = 0
+        finally:
+            self.lock.release()
+
+    def _link(self, link):
+        # Insert link as the most recently used entry
+        root = self.root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
+
+    def _unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+
+    def _evict(self):
+        root = self.root
+        while (len(self.mapping) > self.max_entries) \
+            or (self.max_bytes and (self.bytes > self.max_bytes)):
+            last = root[0]
+            if last is root:
+                break
+            self._unlink(last)
+            del self.mapping[last[2]]
+            self.bytes -= last[4]
+
+class TTLMap(object):
+    """
+    A thread safe mapping whose entries expire ttl seconds after they were
+    set. At most max_entries entries are kept, the oldest are dropped
+    first.
+    """
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> (expires, value)
+        self.mapping = {}
+        # (expires, key) in the order entries were set. Since ttl is fixed
+        # this is also the order in which they expire.
+        self.order = deque()
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def get(self, key, default=None):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.mapping.get(key)
+            if (entry is None) or (entry[0] <= now):
+                return default
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        self.lock.acquire()
+        try:
+            self._set(key, value, time.time())
+        finally:
+            self.lock.release()
+
+    def set_if_absent(self, key, value):
+        """
+        Set key unless it is set and unexpired.
+
+        Returns: True if key was set
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.mapping.get(key)
+            if (entry is not None) and (entry[0] > now):
+                return False
+            self._set(key, value, now)
+            return True
+        finally:
+            self.lock.release()
+
+    def increment(self, key, delta=1):
+        """
+        Add delta to the value of key, which starts at zero. The expiry
+        time of key is not extended.
+
+        Returns: the new value
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.mapping.get(key)
+            if (entry is None) or (entry[0] <= now):
+                value = delta
+                self._set(key, value, now)
+            else:
+                value = entry[1] + delta
+                self.mapping[key] = (entry[0], value)
+            return value
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self.mapping.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.mapping.clear()
+            self.order.clear()
+        finally:
+            self.lock.release()
+
+    def _set(self, key, value, now):
+        # Called with the lock held
+        expires = now + self.ttl
+        self.mapping[key] = (expires, value)
+        self.order.append((expires, key))
+        self._purge(now)
+
+    def _purge(self, now):
+        mapping = self.mapping
+        order = self.order
+        while order:
+            expires, key = order[0]
+            entry = mapping.get(key)
+            if (entry is not None) and (entry[0] != expires):
+                # Superseded by a later set of key
+                order.popleft()
+                continue
+            # Superseded records behind the first live one are only
+            # dropped when they reach the front, so the order is bounded
+            # separately.
+            if (entry is not None) and (expires > now) \
+                and (len(mapping) <= self.max_entries) \
+                and (len(order) <= 2 * self.max_entries):
+                break
+            order.popleft()
+            if entry is not None:
+                del mapping[key]
+
+class Counters(object):
+    """
+    Thread safe integer counters grouped by eg. catalog
+    """
+
+    def __init__(self, names=()):
+        # Counters which are reported as zero before they are used
+        self.names = tuple(names)
+        self.lock = threading.Lock()
+        self.groups = {}
+
+    def incr(self, group, name, delta=1):
+        self.lock.acquire()
+        try:
+            counters = self.groups.get(group)
+            if counters is None:
+                counters = self.groups[group] = dict.fromkeys(self.names, 0)
+            counters[name] = counters.get(name, 0) + delta
+        finally:
+            self.lock.release()
+
+    def get(self, group, name, default=0):
+        self.lock.acquire()
+        try:
+            return self.groups.get(group, {}).get(name, default)
+        finally:
+            self.lock.release()
+
+    def group(self, group):
+        """
+        Returns: a copy of the counters of group
+        """
+        self.lock.acquire()
+        try:
+            counters = self.groups.get(group)
+            if counters is None:
+                return dict.fromkeys(self.names, 0)
+            return counters.copy()
+        finally:
+            self.lock.release()
+
+    def keys(self):
+        self.lock.acquire()
+        try:
+            return self.groups.keys()
+        finally:
+            self.lock.release()
+
+    def clear(self, group=None):
+        self.lock.acquire()
+        try:
+            if group is None:
+                self.groups.clear()
+            else:
+                self.groups.pop(group, None)
+        finally:
+            self.lock.release()
+
+class FrequencySketch(object):
+    """
+    A thread safe count-min sketch estimating how often keys were seen
+    recently, as used by TinyLFU. Counters saturate at max_count. All
+    counters are halved after sample_size increments so that old
+    popularity fades.
+    """
+
+    # Odd multipliers selecting a different counter per row
+    SEEDS = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+
+    def __init__(self, width=16384, max_count=15, sample_size=None):
+        # A power of two so that rows are selected by masking
+        size = 1
+        while size < width:
+            size = size * 2
+        self.width = size
+        self.mask = size - 1
+        self.max_count = max_count
+        self.sample_size = sample_size or (10 * size)
+        self.lock = threading.Lock()
+        self.rows = [[0] * size for seed in self.SEEDS]
+        self.additions = 0
+
+    def _indexes(self, key):
+        h = hash(key) & 0xffffffff
+        mask = self.mask
+        return [((h * seed) >> 16) & mask for seed in self.SEEDS]
+
+    def estimate(self, key):
+        indexes = self._indexes(key)
+        self.lock.acquire()
+        try:
+            return min([row[i] for row, i in zip(self.rows, indexes)])
+        finally:
+            self.lock.release()
+
+    def increment(self, key):
+        """
+        Count key once.
+
+        Returns: the new estimate for key
+        """
+        indexes = self._indexes(key)
+        self.lock.acquire()
+        try:
+            rows = self.rows
+            estimate = min([row[i] for row, i in zip(rows, indexes)])
+            if estimate < self.max_count:
+                # Conservative update: only raise the minimal counters
+                for row, i in zip(rows, indexes):
+                    if row[i] == estimate:
+                        row[i] = estimate + 1
+                estimate += 1
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self._age()
+            return estimate
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.rows = [[0] * self.width for seed in self.SEEDS]
+            self.additions = 0
+        finally:
+            self.lock.release()
+
+    def _age(self):
+        # Called with the lock held
+        self.rows = [[c >> 1 for c in row] for row in self.rows]
+        self.additions = self.additions >> 1
+
+class WriteBuffer(object):
+    """
+    The cache writes of one transaction which are applied when it commits:
+    values to set, keys to delete and counters to increment. All operations
+    are constant time per key. Not thread safe since a transaction belongs
+    to one thread.
+
+    A key which is deleted and then set reads as the new value, but is
+    still deleted before the value is written, so that the old value is
+    gone even if the write is dropped. A key which is set and then deleted
+    reads as deleted and is not written.
+    """
+
+    def __init__(self):
+        self.sets = {}
+        self.deletes = set()
+        self.incrs = set()
+
+    def __len__(self):
+        return len(self.sets) + len(self.deletes) + len(self.incrs)
+
+    def set(self, key, value):
+        self.sets[key] = value
+
+    def delete(self, key):
+        self.sets.pop(key, None)
+        self.deletes.add(key)
+
+    def incr(self, key):
+        self.incrs.add(key)
+
+    def get(self, key, default=None, deleted=None):
+        """
+        Returns: the pending value of key, deleted if key is deleted or
+        default if this transaction did not write key.
+        """
+        value = self.sets.get(key, _missing)
+        if value is not _missing:
+            return value
+        if key in self.deletes:
+            return deleted
+        return default
+
+    def is_deleted(self, key):
+        return key in self.deletes
+
+    def incr_pending(self, keys):
+        incrs = self.incrs
+        for key in keys:
+            if key in incrs:
+                return True
+        return False
+
+    def clear(self):
+        self.sets.clear()
+        self.deletes.clear()
+        self.incrs.clear()
+
+class Flight(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = _missing
+
+class SingleFlight(object):
+    """
+    Lets one thread compute the value of a key while other threads asking
+    for the same key wait for it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def join(self, key):
+        """
+        Returns: (leader, flight). The leader must call land with the flight
+        when it is done, even if it failed.
+        """
+        self.lock.acquire()
+        try:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return False, flight
+            flight = self.flights[key] = Flight()
+            return True, flight
+        finally:
+            self.lock.release()
+
+    def wait(self, flight, timeout, default=None):
+        """
+        Returns: the value of flight or default if the leader failed or did
+        not land within timeout seconds.
+        """
+        flight.event.wait(timeout)
+        if flight.value is _missing:
+            return default
+        return flight.value
+
+    def land(self, key, flight, value=_missing):
+        self.lock.acquire()
+        try:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        finally:
+            self.lock.release()
+        flight.value = value
+        flight.event.set()
+
+    def __len__(self):
+        return len(self.flights)
+
+class SpaceSaving(object):
+    """
+    A thread safe record of the most frequent keys of a stream, using the
+    space saving algorithm. At most capacity keys are monitored. A new key
+    replaces the least frequent one and inherits its count, which is kept
+    as the error of the new key. Keys more frequent than the total count
+    divided by capacity are always monitored.
+
+    A value, eg. a description of the key, may be kept per monitored key.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        # key -> [count, error, value]
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key):
+        """
+        Count key once.
+
+        Returns: True if key was not monitored before, in which case its
+        value should be set.
+        """
+        self.lock.acquire()
+        try:
+            entries = self.entries
+            entry = entries.get(key)
+            if entry is not None:
+                entry[0] += 1
+                return False
+            if not self.capacity:
+                return False
+            count = 0
+            if len(entries) >= self.capacity:
+                # Linear in capacity, which is small, and only done for
+                # keys which are not monitored
+                victim = None
+                for k, e in entries.iteritems():
+                    if (victim is None) or (e[0] < count):
+                        victim, count = k, e[0]
+                del entries[victim]
+            entries[key] = [count + 1, count, None]
+            return True
+        finally:
+            self.lock.release()
+
+    def set_value(self, key, value):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[2] = value
+        finally:
+            self.lock.release()
+
+    def merge(self, key, count, value):
+        """
+        Monitor key with at least count, eg. when restoring a record
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if count > entry[0]:
+                    entry[0] = count
+                if entry[2] is None:
+                    entry[2] = value
+                return
+            if len(self.entries) >= self.capacity:
+                return
+            self.entries[key] = [count, 0, value]
+        finally:
+            self.lock.release()
+
+    def top(self, n=None):
+        """
+        Returns: a list of (key, count, value) of the n most frequent keys,
+        most frequent first
+        """
+        self.lock.acquire()
+        try:
+            items = [(e[0], k, e[2]) for k, e in self.entries.items()]
+        finally:
+            self.lock.release()
+        items.sort()
+        items.reverse()
+        if n is not None:
+            items = items[:n]
+        return [(k, count, value) for count, k, value in items]
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+class HitRatioClassifier(object):
+    """
+    Thread safe classification of keys, eg. query shapes, by their observed
+    hit ratio. Lookups of a key are counted in windows of min_lookups. If
+    less than min_ratio of the lookups of a window hit, the key is bypassed
+    for bypass_time seconds and observed again afterwards. Counts of at
+    most max_entries keys are kept.
+    """
+
+    def __init__(self, min_lookups=200, min_ratio=0.01, bypass_time=300,
+                 max_entries=10000):
+        self.min_lookups = min_lookups
+        self.min_ratio = min_ratio
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> [lookups, hits]
+        self.counts = {}
+        self.bypassed_keys = TTLMap(bypass_time, max_entries)
+
+    def bypassed(self, key):
+        return self.bypassed_keys.get(key) is not None
+
+    def record(self, key, hit):
+        """
+        Count a lookup of key.
+
+        Returns: True if key is bypassed from now on
+        """
+        if not self.min_ratio:
+            return False
+        self.lock.acquire()
+        try:
+            counts = self.counts.get(key)
+            if counts is None:
+                if len(self.counts) >= self.max_entries:
+                    # Shapes are few, so this only happens with unusual
+                    # keys. Start over rather than track recency.
+                    self.counts.clear()
+                counts = self.counts[key] = [0, 0]
+            counts[0] += 1
+            if hit:
+                counts[1] += 1
+            if counts[0] < self.min_lookups:
+                return False
+            bypass = counts[1] < counts[0] * self.min_ratio
+            del self.counts[key]
+        finally:
+            self.lock.release()
+        if bypass:
+            self.bypassed_keys.set(key, 1)
+        return bypass
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.counts.clear()
+        finally:
+            self.lock.release()
+        self.bypassed_keys.clear()
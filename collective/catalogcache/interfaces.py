@@ -0,0 +1,57 @@
+from zope.interface import Interface
+
+class ICacheBackend(Interface):
+    """
+    Storage used by MemcachedAdapter. The method signatures follow those of
+    memcache.Client from python-memcached. Keys are strings without spaces
+    and durations are in seconds, with 0 meaning no expiry.
+    """
+
+    def get(key):
+        """
+        Returns:
+            success: value
+            failure: None
+        """
+
+    def get_multi(keys, key_prefix=''):
+        """
+        Returns a dictionary of the found keys, without key_prefix, mapped
+        to their values.
+        """
+
+    def set_multi(mapping, key_prefix='', time=0):
+        """
+        Returns a list of the keys, without key_prefix, which could not be
+        stored.
+        """
+
+    def add(key, val, time=0):
+        """
+        Store val only if key is not stored yet.
+
+        Returns:
+            success: non-zero
+            failure: zero
+        """
+
+    def incr(key, delta=1):
+        """
+        Increment the integer stored under key.
+
+        Returns:
+            success: new value
+            failure: None, eg. if key is not stored
+        """
+
+    def delete_multi(keys):
+        """
+        Returns:
+            success: 1
+            failure: not 1
+        """
+
+    def flush_all():
+        """
+        Remove all keys.
+        """
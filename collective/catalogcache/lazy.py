@@ -0,0 +1,80 @@
+from Products.ZCatalog.Lazy import LazyMap
+
+class LazyBrains(LazyMap):
+    """
+    A LazyMap of the brains of a sequence of rids which materializes them
+    in batches of batch_size through catalog._get_brains, so that the
+    records of a batch are validated and fetched together.
+
+    Rids which are no longer in the catalog are skipped instead of raising
+    KeyError. The length is reduced as they are found, so it may shrink
+    while the sequence is accessed.
+    """
+
+    def __init__(self, catalog, rids, length=None, batch_size=50,
+                 token=None):
+        LazyMap.__init__(self, catalog.__getitem__, rids, length)
+        self._catalog = catalog
+        self._batch_size = batch_size
+        # Keys the metadata cache, see patch._get_brains
+        self._token = token
+        # Brains are materialized from the start up to the rid at
+        # _position and, for negative indexes, from the end back to the
+        # rid at _tail_start
+        self._position = 0
+        self._tail = []
+        self._tail_start = len(rids)
+
+    def __getitem__(self, index):
+        data = self._data
+        if index < 0:
+            if self._position < len(self._seq):
+                return self._get_from_tail(-index)
+        elif index >= len(data):
+            self._fill(index)
+        return data[index]
+
+    def __len__(self):
+        return self._len
+
+    def _materialize(self, start, end):
+        # The brains of the rids from start to end, without stale rids
+        seq = self._seq
+        rids = [seq[i] for i in xrange(start, end)]
+        brains = self._catalog._get_brains(rids, self._token)
+        self._len = self._len - (len(rids) - len(brains))
+        return brains
+
+    def _fill(self, index):
+        # Materialize brains from the start up to index
+        data = self._data
+        while index >= len(data):
+            start = self._position
+            if start >= self._tail_start:
+                break
+            end = min(start + self._batch_size, self._tail_start)
+            data.extend(self._materialize(start, end))
+            self._position = end
+        if self._position >= self._tail_start:
+            self._join_tail()
+
+    def _get_from_tail(self, count):
+        # Return the count-th brain from the end. Stale rids before the
+        # tail do not change which brain that is, so only the batches at
+        # the end are materialized.
+        tail = self._tail
+        while (len(tail) < count) and (self._tail_start > self._position):
+            end = self._tail_start
+            start = max(self._position, end - self._batch_size)
+            tail[:0] = self._materialize(start, end)
+            self._tail_start = start
+        if self._tail_start <= self._position:
+            self._join_tail()
+            return self._data[-count]
+        return tail[-count]
+
+    def _join_tail(self):
+        # Every rid before the tail is materialized
+        self._data.extend(self._tail)
+        self._tail = []
+        self._position = self._tail_start = len(self._seq)
@@ -0,0 +1,195 @@
+"""
+Per catalog cache metrics.
+
+Counters and latency histograms are kept per process and per catalog,
+identified by the physical path of the catalog. Work which is not done on
+behalf of a single catalog, like writing queued values to the backend, is
+recorded under PROCESS. All functions are thread safe.
+"""
+
+import threading
+
+from collective.catalogcache.datastructures import Counters
+
+PROCESS = ''
+
+COUNTERS = (
+    'hits',         # searches answered from the cache
+    'misses',       # searches answered by the indexes
+    'memoized',     # searches repeated within a transaction
+    'coalesced',    # searches answered by a concurrent search or stale
+    'stale',        # stale results served while revalidating
+    'sets',         # keys written, including rid maps
+    'deletes',      # keys deleted
+    'bytes_in',     # bytes read from the backend
+    'bytes_out',    # bytes written to the backend
+    'throttled',    # writes skipped because they were done recently
+    'failures',     # failed backend operations
+    'dropped',      # queued writes dropped because the queue was full
+    'tracked',      # result sets cached and tracked per rid
+    'untracked',    # result sets cached with a removal generation stamp
+    'uncached',     # result sets too large to cache
+    'rejected',     # result sets too cheap or too rare to cache
+    'warmed',       # queries replayed to warm up the cache
+    'bypassed',     # searches which skipped the cache by their shape
+    'partial_hits', # index results found in the partial cache
+    'partial_misses',  # index results computed for the partial cache
+    )
+
+TIMERS = (
+    'index',        # applying the indexes on a miss
+    'get',          # fetching a result from the backend
+    'set',          # storing a result and its rid maps
+    )
+
+# Upper bounds of the histogram buckets in milliseconds. Larger values fall
+# in a final unbounded bucket.
+BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+class Histogram(object):
+    """
+    A thread safe latency histogram with fixed buckets
+    """
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000.0
+        bounds = self.bounds
+        i = 0
+        while (i < len(bounds)) and (ms > bounds[i]):
+            i += 1
+        self.lock.acquire()
+        try:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += ms
+            if ms > self.max:
+                self.max = ms
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """
+        Returns: a dictionary of the count, the total, mean and maximum in
+        milliseconds, upper bounds of the 50th, 95th and 99th percentiles
+        and the bucket counts.
+        """
+        self.lock.acquire()
+        try:
+            counts = self.counts[:]
+            count, total, max = self.count, self.total, self.max
+        finally:
+            self.lock.release()
+        result = {
+            'count': count,
+            'total_ms': total,
+            'mean_ms': count and (total / count) or 0.0,
+            'max_ms': max,
+            'buckets': [[bound, n] for bound, n \
+                        in zip(list(self.bounds) + [None], counts)],
+            }
+        for name, fraction in (('p50_ms', 0.5), ('p95_ms', 0.95),
+                               ('p99_ms', 0.99)):
+            result[name] = self._percentile(counts, count, fraction, max)
+        return result
+
+    def _percentile(self, counts, count, fraction, max):
+        if not count:
+            return 0.0
+        seen = 0
+        for i in range(len(counts)):
+            seen += counts[i]
+            if seen >= count * fraction:
+                if i < len(self.bounds):
+                    return float(self.bounds[i])
+                break
+        return max
+
+_counters = Counters(COUNTERS)
+_histograms = {}
+_lock = threading.Lock()
+
+def _histogram(cache_id, name):
+    key = (cache_id, name)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        _lock.acquire()
+        try:
+            histogram = _histograms.get(key)
+            if histogram is None:
+                histogram = _histograms[key] = Histogram()
+        finally:
+            _lock.release()
+    return histogram
+
+def incr(cache_id, name, delta=1):
+    _counters.incr(cache_id, name, delta)
+
+def observe(cache_id, name, seconds):
+    _histogram(cache_id, name).observe(seconds)
+
+def catalog_ids():
+    """
+    Returns: the sorted ids of the catalogs metrics were recorded for
+    """
+    ids = dict.fromkeys(_counters.keys())
+    for cache_id, name in _histograms.keys():
+        ids[cache_id] = 1
+    ids.pop(PROCESS, None)
+    ids = ids.keys()
+    ids.sort()
+    return ids
+
+def report(cache_id):
+    """
+    Returns: a dictionary of the counters and latency snapshots of
+    cache_id, the hit rate and an estimate of the time saved by caching.
+    """
+    counters = _counters.group(cache_id)
+    latency = {}
+    for name in TIMERS:
+        histogram = _histograms.get((cache_id, name))
+        if histogram is None:
+            histogram = Histogram()
+        latency[name] = histogram.snapshot()
+
+    hits = counters.get('hits', 0)
+    lookups = hits + counters.get('misses', 0)
+    hit_rate = lookups and (hits * 100.0 / lookups) or 0.0
+
+    # Each hit saves applying the indexes. Every lookup pays for a get and
+    # every miss for a set.
+    saved = hits * latency['index']['mean_ms'] \
+        - latency['get']['total_ms'] - latency['set']['total_ms']
+
+    return {
+        'id': cache_id,
+        'counters': counters,
+        'latency': latency,
+        'hit_rate': hit_rate,
+        'saved_ms': saved,
+        }
+
+def clear(cache_id=None):
+    _counters.clear(cache_id)
+    _lock.acquire()
+    try:
+        for key, histogram in _histograms.items():
+            if (cache_id is None) or (key[0] == cache_id):
+                histogram.lock.acquire()
+                try:
+                    histogram.clear()
+                finally:
+                    histogram.lock.release()
+    finally:
+        _lock.release()
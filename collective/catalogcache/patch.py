@@ -1,12 +1,13 @@
 import BTrees.Length
-from BTrees.IIBTree import intersection, weightedIntersection, IISet
+from BTrees.IIBTree import intersection, weightedIntersection, IISet, IIBucket
 from BTrees.OIBTree import OIBTree
 from BTrees.IOBTree import IOBTree
-from Products.ZCatalog.Lazy import LazyMap, LazyCat
+from Products.ZCatalog.Lazy import Lazy, LazyMap, LazyCat
 import types
 
-from DateTime import DateTime
+import struct
 from md5 import md5
+from binascii import hexlify, unhexlify
 import time
 from Products.ZCatalog.Catalog import LOG
 from os import environ
@@ -15,33 +16,268 @@ import transaction
 from zope.interface import implements
 from transaction.interfaces import IDataManager
 
-try:
-    import memcache
-    s = environ.get('MEMCACHE_SERVERS', '')
-    if s:
-        servers = s.split(',')
-
-    if not s:
-        HAS_MEMCACHE = False
-        LOG.info("No memcached servers defined. Catalog will function as normal.")
-
-    else:
-        mem_cache = memcache.Client(servers, debug=0)
-        HAS_MEMCACHE = True
-        LOG.info("Using memcached servers %s" % ",".join(servers))
-
-except ImportError:
-    mem_cache = None
-    HAS_MEMCACHE = False
-    LOG.info("Cannot import memcached. Catalog will function as normal.")
+from collective.catalogcache.datastructures import LRUCache, TTLMap, \
+    FrequencySketch, WriteBuffer, SingleFlight, HitRatioClassifier
+from collective.catalogcache.backends import getBackend
+from collective.catalogcache import codec
+from collective.catalogcache import query
+from collective.catalogcache import metrics
+from collective.catalogcache.writer import WriteBehind
+from collective.catalogcache.revalidate import Revalidator
+from collective.catalogcache import warmup
+from collective.catalogcache.lazy import LazyBrains
+
+def _parse_shapes(value):
+    # 'Creator+allowedRolesAndUsers,SearchableText' ->
+    # [('Creator', 'allowedRolesAndUsers'), ('SearchableText',)]
+    shapes = []
+    for item in value.split(','):
+        names = [n.strip() for n in item.split('+') if n.strip()]
+        if names:
+            shapes.append(tuple(names))
+    return shapes
+
+def _parse_time_buckets(value):
+    # 'effective:60,created:3600' -> {'effective': 60, 'created': 3600}
+    buckets = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, seconds = item.split(':')
+        buckets[name.strip()] = int(seconds)
+    return buckets
+
+# The backend need not be memcached but the names are kept for
+# compatibility.
+mem_cache = getBackend()
+HAS_MEMCACHE = mem_cache is not None
 
 MEMCACHE_DURATION = 7200
 MEMCACHE_RETRY_INTERVAL = 10
-memcache_insertion_timestamps = {}
-_hits = {}
-_misses = {}
+# Cache keys are namespaced by a per-catalog generation and per-index
+# generations. Bumping a generation orphans every key built with the old
+# value, so invalidation costs a single incr.
+GENERATION_KEY = '_generation'
+# Generations of the values of value indexes are created for every value
+# queried, so they expire. A new generation is always larger than an
+# expired one, see _initial_generation.
+VALUE_GENERATION_DURATION = 2 * MEMCACHE_DURATION
+# Rids map to a packed string of the raw digests of the cache keys of the
+# queries containing the rid, preceded by a flags byte and the catalog
+# generation the digests were recorded under. Digests recorded under an
+# older catalog generation are orphaned and dropped when the map is next
+# written. The number of entries is capped to keep the maps, which are
+# read and rewritten for every rid of a cached result, small.
+RIDMAP_VERSION = 2
+RIDMAP_OVERFLOW = 0x80
+RIDMAP_DIGEST_SIZE = 16
+RIDMAP_GENERATION = '>Q'
+RIDMAP_HEADER_SIZE = 1 + struct.calcsize(RIDMAP_GENERATION)
+RIDMAP_MAX_ENTRIES = int(environ.get('CATALOGCACHE_RIDMAP_MAX_ENTRIES', 256))
+# Result sets larger than TRACK_THRESHOLD rids are not tracked per rid.
+# They are stamped with the removal generation instead, which is bumped
+# whenever a record is removed from the catalog. Result sets larger than
+# CACHE_THRESHOLD rids are not cached at all. Zero disables a threshold.
+# Both may be overridden per catalog through the catalogcache_track_threshold
+# and catalogcache_cache_threshold properties.
+TRACK_THRESHOLD = int(environ.get('CATALOGCACHE_TRACK_THRESHOLD', 1000))
+CACHE_THRESHOLD = int(environ.get('CATALOGCACHE_CACHE_THRESHOLD', 0))
+REMOVAL_GENERATION_KEY = GENERATION_KEY + '_removal'
+# A computed result is only cached if the time it took to compute, in
+# microseconds, times the number of times the query missed recently is at
+# least ADMIT_MIN_COST, and the query missed at least ADMIT_MIN_FREQUENCY
+# times. Recent misses are estimated by a sketch of ADMIT_SKETCH_WIDTH
+# counters per row which saturate at 15, so queries cheaper than
+# ADMIT_MIN_COST / 15 are never cached. Zero ADMIT_MIN_COST and an
+# ADMIT_MIN_FREQUENCY of at most one admit every result. Both may be
+# overridden per catalog through the catalogcache_admit_min_cost and
+# catalogcache_admit_min_frequency properties.
+ADMIT_MIN_COST = int(environ.get('CATALOGCACHE_ADMIT_MIN_COST', 1000))
+ADMIT_MIN_FREQUENCY = int(environ.get('CATALOGCACHE_ADMIT_MIN_FREQUENCY', 1))
+ADMIT_SKETCH_WIDTH = int(environ.get('CATALOGCACHE_ADMIT_SKETCH_WIDTH', 16384))
+# Queries on these index types which name at most VALUE_DEPENDENCY_MAX
+# values are invalidated per value instead of per index.
+VALUE_INDEX_TYPES = environ.get('CATALOGCACHE_VALUE_INDEX_TYPES',
+    'FieldIndex,KeywordIndex').split(',')
+VALUE_DEPENDENCY_MAX = int(environ.get('CATALOGCACHE_VALUE_DEPENDENCY_MAX', 32))
+# index_object of these index types only returns false if the entry of the
+# object did not change, so their entries are not compared. Other types are
+# compared through a digest of the entry before and after indexing, except
+# for CHANGE_UNDETECTED_TYPES, which are assumed to change every time an
+# object is indexed.
+CHANGE_SIGNAL_TYPES = environ.get('CATALOGCACHE_CHANGE_SIGNAL_TYPES',
+    'FieldIndex,KeywordIndex,DateIndex,DateRangeIndex').split(',')
+CHANGE_UNDETECTED_TYPES = [t for t in environ.get(
+    'CATALOGCACHE_CHANGE_UNDETECTED_TYPES', '').split(',') if t]
+# Times in queries are pinned to buckets of TIME_BUCKET seconds, or the
+# number of seconds given per index in TIME_BUCKETS. Zero disables pinning.
+TIME_BUCKET = int(environ.get('CATALOGCACHE_TIME_BUCKET', 60))
+TIME_BUCKETS = _parse_time_buckets(environ.get('CATALOGCACHE_TIME_BUCKETS', ''))
+VALUE_TYPES = (types.StringType, types.UnicodeType, types.IntType,
+               types.LongType)
+# Cache the ordered and limited rids of sorted queries in addition to the
+# unsorted result set. May be overridden per catalog through the
+# catalogcache_sort_cache property.
+SORT_CACHE = int(environ.get('CATALOGCACHE_SORT_CACHE', 0))
+# Results fetched from memcached are kept in a per process cache. Entries
+# are keyed by the full cache key, so generation bumps by any client make
+# them unreachable, and are stamped with the removal generation. Zero
+# entries disables the local cache.
+LOCAL_CACHE_MAX_ENTRIES = int(environ.get('CATALOGCACHE_LOCAL_MAX_ENTRIES', 1000))
+LOCAL_CACHE_MAX_BYTES = int(environ.get('CATALOGCACHE_LOCAL_MAX_BYTES', 32*1024*1024))
+# Values are written to the cache by a background thread after the deletes
+# and generation bumps of a transaction are done. At most
+# WRITE_BEHIND_MAX_KEYS keys are queued.
+WRITE_BEHIND = int(environ.get('CATALOGCACHE_WRITE_BEHIND', 1))
+WRITE_BEHIND_MAX_KEYS = int(environ.get('CATALOGCACHE_WRITE_BEHIND_MAX_KEYS', 100000))
+# The results of up to SEARCH_MEMO_MAX_ENTRIES distinct searches per catalog
+# are reused by identical searches later in the same transaction, until the
+# catalog changes. Zero disables reuse.
+SEARCH_MEMO_MAX_ENTRIES = int(environ.get('CATALOGCACHE_SEARCH_MEMO_MAX_ENTRIES', 100))
+# Invalidations collected by a bulk invalidation are resolved when the
+# transaction commits. If more than BULK_THRESHOLD rids and generations are
+# affected the catalog generation is bumped instead.
+BULK_THRESHOLD = int(environ.get('CATALOGCACHE_BULK_THRESHOLD', 1000))
+# Concurrent misses of a query in a process are computed once. The other
+# threads wait at most SINGLE_FLIGHT_WAIT seconds for the result. Zero
+# disables waiting. If LEASE_TIME is set the computing thread also takes a
+# lease of that many seconds in the cache, and threads of other clients
+# poll the cache for its result instead of computing it. With SERVE_STALE
+# threads which would wait are served the previous result of the query
+# instead, without records which were removed since.
+SINGLE_FLIGHT_WAIT = float(environ.get('CATALOGCACHE_SINGLE_FLIGHT_WAIT', 2))
+LEASE_TIME = int(environ.get('CATALOGCACHE_LEASE_TIME', 0))
+LEASE_POLL_INTERVAL = 0.05
+LEASE_SUFFIX = ':lease'
+SERVE_STALE = int(environ.get('CATALOGCACHE_SERVE_STALE', 0))
+# Queries on REVALIDATE_INDEXES only are revalidated in the background. On a
+# miss they are served their latest result, if it was computed at most
+# REVALIDATE_MAX_AGE seconds ago, without records which were removed
+# since, and the result is recomputed by a background thread.
+REVALIDATE_INDEXES = [n for n in environ.get(
+    'CATALOGCACHE_REVALIDATE_INDEXES', '').split(',') if n]
+REVALIDATE_MAX_AGE = int(environ.get('CATALOGCACHE_REVALIDATE_MAX_AGE', 10))
+LATEST_KEY = '_latest_'
+# The WARMUP_TOP_K most frequent cacheable queries of each catalog are
+# recorded and stored in the cache every WARMUP_PERSIST_INTERVAL seconds.
+# Catalog.warmUp replays them from WARMUP_THREADS threads. With
+# WARMUP_ON_START the first search of a catalog in a process does so in
+# the background. Zero WARMUP_TOP_K disables recording.
+WARMUP_TOP_K = int(environ.get('CATALOGCACHE_WARMUP_TOP_K', 100))
+WARMUP_PERSIST_INTERVAL = int(environ.get('CATALOGCACHE_WARMUP_PERSIST_INTERVAL', 300))
+WARMUP_THREADS = int(environ.get('CATALOGCACHE_WARMUP_THREADS', 4))
+WARMUP_ON_START = int(environ.get('CATALOGCACHE_WARMUP_ON_START', 0))
+WARMUP_KEY = '_warmup'
+# With PARTIAL_CACHE the result of every index is cached on its own on a
+# miss, keyed by the part of the query the index uses and the generations
+# it depends on, so that queries combining the same parts differently
+# share them. Results larger than PARTIAL_MAX_RIDS rids are not cached.
+# Partial results are stamped with the removal generation. PARTIAL_CACHE
+# may be overridden per catalog through the catalogcache_partial_cache
+# property.
+PARTIAL_CACHE = int(environ.get('CATALOGCACHE_PARTIAL_CACHE', 0))
+PARTIAL_MAX_RIDS = int(environ.get('CATALOGCACHE_PARTIAL_MAX_RIDS', 50000))
+PARTIAL_KEY = '_partial_'
+# Brains of rids are materialized in batches of BRAIN_BATCH_SIZE whose
+# records are fetched together. Rids which are no longer in the catalog are
+# skipped. Zero materializes brains one by one. With
+# METADATA_CACHE_MAX_ENTRIES records are also kept in a per process cache,
+# keyed by the removal and metadata generations, which are bumped whenever
+# a record is removed or its metadata changes.
+BRAIN_BATCH_SIZE = int(environ.get('CATALOGCACHE_BRAIN_BATCH_SIZE', 50))
+METADATA_CACHE_MAX_ENTRIES = int(environ.get('CATALOGCACHE_METADATA_MAX_ENTRIES', 0))
+METADATA_GENERATION_KEY = GENERATION_KEY + '_metadata'
+# Batches spanning at most this many times as many rids as they contain
+# are fetched by walking the records between the smallest and the largest
+# rid instead of looking up every rid.
+BRAIN_BATCH_DENSITY = 4
+# Queries are classified by their shape, the names of the indexes they give
+# a value. Queries whose shape includes all indexes of an entry of
+# UNCACHEABLE_SHAPES bypass the cache, as do queries without any index
+# value, which return everything. Other shapes are observed over windows of
+# SHAPE_MIN_LOOKUPS lookups. If less than SHAPE_MIN_HIT_RATIO percent of
+# them hit, the shape bypasses the cache for SHAPE_BYPASS_TIME seconds,
+# unless it includes all indexes of an entry of CACHEABLE_SHAPES. Zero
+# SHAPE_MIN_HIT_RATIO disables observation.
+UNCACHEABLE_SHAPES = _parse_shapes(environ.get('CATALOGCACHE_UNCACHEABLE_SHAPES', ''))
+CACHEABLE_SHAPES = _parse_shapes(environ.get('CATALOGCACHE_CACHEABLE_SHAPES', ''))
+SHAPE_MIN_LOOKUPS = int(environ.get('CATALOGCACHE_SHAPE_MIN_LOOKUPS', 200))
+SHAPE_MIN_HIT_RATIO = float(environ.get('CATALOGCACHE_SHAPE_MIN_HIT_RATIO', 1))
+SHAPE_BYPASS_TIME = int(environ.get('CATALOGCACHE_SHAPE_BYPASS_TIME', 300))
+# Process wide state is shared by all worker threads, so it lives in lock
+# protected structures. Per key state expires and is bounded in size so it
+# does not grow with the number of distinct queries over time.
+INSERTION_THROTTLE = 10
+STATE_MAX_ENTRIES = int(environ.get('CATALOGCACHE_STATE_MAX_ENTRIES', 10000))
+memcache_insertion_timestamps = TTLMap(INSERTION_THROTTLE, STATE_MAX_ENTRIES)
 _memcache_failure_timestamp = 0
-_cache_misses = {}
+# Consecutive misses per key within a window
+_cache_misses = TTLMap(MEMCACHE_DURATION, STATE_MAX_ENTRIES)
+_local_cache = LRUCache(LOCAL_CACHE_MAX_ENTRIES, LOCAL_CACHE_MAX_BYTES)
+_frequency = FrequencySketch(ADMIT_SKETCH_WIDTH)
+_flights = SingleFlight()
+# The latest result of queries by canonical form, for SERVE_STALE
+_latest_results = LRUCache(LOCAL_CACHE_MAX_ENTRIES, LOCAL_CACHE_MAX_BYTES)
+_metadata = LRUCache(METADATA_CACHE_MAX_ENTRIES)
+_revalidator = Revalidator()
+# Queries revalidated recently, so that serving a stale result repeatedly
+# does not recompute it each time
+_revalidations = TTLMap(max(1, REVALIDATE_MAX_AGE), STATE_MAX_ENTRIES)
+# Queries whose latest result was restamped recently
+_stale_refreshes = TTLMap(max(1, REVALIDATE_MAX_AGE / 2), STATE_MAX_ENTRIES)
+# Catalogs whose query record was stored recently
+_warmup_persisted = TTLMap(max(1, WARMUP_PERSIST_INTERVAL), STATE_MAX_ENTRIES)
+# Hit ratios of query shapes per catalog
+_shapes = HitRatioClassifier(SHAPE_MIN_LOOKUPS, SHAPE_MIN_HIT_RATIO / 100.0,
+                             max(1, SHAPE_BYPASS_TIME), STATE_MAX_ENTRIES)
+
+def _record_failure():
+    """
+    Stop using the cache for MEMCACHE_RETRY_INTERVAL seconds, unless the
+    backend tracks the health of its servers itself.
+    """
+    global _memcache_failure_timestamp
+    if not getattr(mem_cache, 'tracks_health', False):
+        _memcache_failure_timestamp = int(time.time())
+
+def _set_multi(memcache, to_set, key_prefix, duration):
+    """
+    Returns: 
+        failure: (a) list of keys which failed to be stored or 
+                 (b) False if no memcache servers could be reached
+        success: empty list
+    """
+    # An edge case in the python memcache wrapper requires that
+    # we catch TypeErrors.
+    try:
+        result = memcache.set_multi(to_set, key_prefix=key_prefix, time=duration)
+    except TypeError:
+        metrics.incr(metrics.PROCESS, 'failures')
+        return False
+
+    # Return value of non-empty list indicates error
+    if isinstance(result, types.ListType) and len(result):
+        LOG.error("_cache_result set_multi failed") 
+        metrics.incr(metrics.PROCESS, 'failures')
+        _record_failure()
+        # The return value of set_multi is the original to_set list in 
+        # case of no daemons responding.
+        if len(result) != len(to_set.keys()):
+            LOG.error("Some keys were successfully written to memcache. This case needs further handling.")
+
+    return result
+
+def _write_behind(to_set):
+    start = time.time()
+    _set_multi(mem_cache, to_set, '', MEMCACHE_DURATION)
+    metrics.observe(metrics.PROCESS, 'set', time.time() - start)
+
+if HAS_MEMCACHE and WRITE_BEHIND:
+    _writer = WriteBehind(_write_behind, WRITE_BEHIND_MAX_KEYS,
+                          delete=mem_cache.delete_multi)
+else:
+    _writer = None
 
 class MemcachedDataManager(object):
 
@@ -85,6 +321,16 @@ class MemcachedAdapter(object):
         txn = transaction.get()
         txn.join(MemcachedDataManager(self.counter, self))
 
+    def _buffer(self):
+        """
+        Return the writes of the current transaction
+        """
+        txn = transaction.get()
+        buffer = getattr(txn, 'v_write_buffer', None)
+        if buffer is None:
+            buffer = txn.v_write_buffer = WriteBuffer()
+        return buffer
+
     def set_multi(self, to_set, key_prefix, duration=None, immediate=False):
         """
         Returns: 
@@ -92,45 +338,16 @@ class MemcachedAdapter(object):
                      (b) False if no memcache servers could be reached
             success: empty list
         """
-        global _memcache_failure_timestamp
-
         #LOG.debug("set multi (%s): %s" % (immediate, repr(to_set)))
 
         if immediate:
-            # An edge case in the python memcache wrapper requires that
-            # we catch TypeErrors.
-            try:
-                result = self.memcache.set_multi(to_set, key_prefix=key_prefix, time=duration or self.default_duration)
-            except TypeError:
-                return False
-
-            # xxx: I hate this code here. Make it a callback so transaction commit
-            # can set _memcache_failure_timestamp
-            # Return value of non-empty list indicates error
-            if isinstance(result, types.ListType) and len(result):
-                LOG.error("_cache_result set_multi failed") 
-                _memcache_failure_timestamp = int(time.time())
-                # The return value of set_multi is the original to_set list in 
-                # case of no daemons responding.
-                if len(result) != len(to_set.keys()):
-                    LOG.error("Some keys were successfully written to memcache. This case needs further handling.")
-
-            return result
+            return _set_multi(self.memcache, to_set, key_prefix,
+                              duration or self.default_duration)
 
-        txn = transaction.get()
+        buffer = self._buffer()
         self.counter += 1
-        if not hasattr(txn, 'v_cache'):
-            txn.v_cache = dict()
         for k,v in to_set.items():
-            s_k = key_prefix + str(k)
-            # Add to v_cache
-            txn.v_cache[s_k] = v
-            # Remove from v_delete_cache
-            if hasattr(txn, 'v_delete_cache') and (s_k in txn.v_delete_cache):            
-                try:
-                    txn.v_delete_cache.remove(s_k)
-                except ValueError:
-                    pass
+            buffer.set(key_prefix + str(k), v)
 
     def get(self, key, default=[]):
         """
@@ -140,16 +357,10 @@ class MemcachedAdapter(object):
             success: value
             failure: default
         """
-        txn = transaction.get()
-
-        if hasattr(txn, 'v_delete_cache') and (key in txn.v_delete_cache):
-            return default
-
-        if hasattr(txn, 'v_cache') and txn.v_cache.has_key(key):            
-            try:
-                return txn.v_cache[key]
-            except KeyError:
-                pass
+        marker = []
+        result = self._buffer().get(key, marker, default)
+        if result is not marker:
+            return result
 
         result = self.memcache.get(key)
         if result is None:
@@ -165,34 +376,19 @@ class MemcachedAdapter(object):
             # Nothing to do
             return {}
 
-        txn = transaction.get()       
-
-        # If any key is in v_delete_cache then to_get must be adjusted
-        new_to_get = []
-        if hasattr(txn, 'v_delete_cache'):
-            for k in to_get:
-                s_k = key_prefix + str(k)
-                if s_k not in txn.v_delete_cache:
-                    new_to_get.append(k)
-        else:
-            new_to_get = to_get
-
+        # Keys written by this transaction are served from its buffer
+        buffer = self._buffer()
+        marker = []
+        deleted = []
         result_cache = {}
         keys_still_to_get = []
-        # Try and find the keys in v_cache
-        if hasattr(txn, 'v_cache'):            
-            for k in new_to_get:
-                s_k = key_prefix + str(k)
-                if txn.v_cache.has_key(s_k):
-                    try:
-                        result_cache[k] = txn.v_cache[s_k]                         
-                    except KeyError:
-                        keys_still_to_get.append(k)
-                else:
-                    keys_still_to_get.append(k)
-        else:
-            keys_still_to_get = new_to_get
-       
+        for k in to_get:
+            value = buffer.get(key_prefix + str(k), marker, deleted)
+            if value is marker:
+                keys_still_to_get.append(k)
+            elif value is not deleted:
+                result_cache[k] = value
+
         result_memcache = {} 
         if keys_still_to_get:
             # An edge case in the python memcache wrapper requires that
@@ -224,35 +420,66 @@ class MemcachedAdapter(object):
         if immediate:
             return self.memcache.delete_multi(to_delete)
 
-        txn = transaction.get()
-
-        if not hasattr(txn, 'v_delete_cache'):
-            txn.v_delete_cache = []
+        buffer = self._buffer()
         for k in to_delete:
-            if k not in txn.v_delete_cache:
-                txn.v_delete_cache.append(k)
-
+            buffer.delete(k)
         self.counter += 1
-        if hasattr(txn, 'v_cache'):
-            for k in to_delete:
-                if txn.v_cache.has_key(k):
-                    try:
-                        del txn.v_cache[k]
-                    except KeyError:
-                        pass
 
         return 1
 
+    def incr(self, key, immediate=False):
+        """
+        Parameter key is already prefixed. Bump a generation counter. A
+        missing counter is initialised to a time based value so that an
+        evicted counter never falls back to a previously used value.
+
+        Returns:
+            success: new value
+            failure: None
+        """
+        if immediate:
+            value = self.memcache.incr(key)
+            if value is None:
+                value = _initial_generation()
+                if not self.memcache.add(key, value,
+                                         time=_generation_duration(key)):
+                    # Somebody else initialised the counter
+                    value = self.memcache.incr(key)
+            return value
+
+        self._buffer().incr(key)
+        self.counter += 1
+
+    def incr_pending(self, keys):
+        """
+        Return True if any of keys is scheduled to be bumped when the
+        current transaction commits.
+        """
+        return self._buffer().incr_pending(keys)
+
+    def delete_pending(self, key):
+        """
+        Parameter key is already prefixed. Return True if key is deleted by
+        the current transaction.
+        """
+        return self._buffer().is_deleted(key)
+
+    def add(self, key, value, duration=0):
+        """
+        Parameter key is already prefixed. Always immediate.
+
+        Returns:
+            success: True
+            failure: False
+        """
+        return bool(self.memcache.add(key, value, time=duration))
+
     def flush_all(self):
         """
         Returns:
             success, failure: undefined
         """
-        txn = transaction.get()
-        if hasattr(txn, 'v_cache'):
-            txn.v_cache.clear()
-        if hasattr(txn, 'v_cache'):
-            txn.v_delete_cache = []
+        self._buffer().clear()
         return self.memcache.flush_all()
 
     def commit(self):
@@ -260,22 +487,230 @@ class MemcachedAdapter(object):
         Do one atomic commit. This is in fact not atomic since the memcached wrapper
         needs more work but it is the best we can do.
         """
-        txn = transaction.get()
-        if hasattr(txn, 'v_delete_cache'):
-            if self.delete_multi(to_delete=txn.v_delete_cache, immediate=True) != 1:
+        buffer = self._buffer()
+        if buffer.deletes:
+            to_delete = list(buffer.deletes)
+            if _writer is not None:
+                # Do not let queued values resurrect deleted keys
+                _writer.discard(to_delete)
+            if self.delete_multi(to_delete=to_delete, immediate=True) != 1:
                 LOG.error("_invalidate_cache delete_multi failed")
-            txn.v_delete_cache = []
-
-        if hasattr(txn, 'v_cache'):
-            result_set = self.set_multi(to_set=txn.v_cache, 
-                key_prefix='', 
-                duration=self.default_duration, 
-                immediate=True)
-            txn.v_cache.clear()            
-            # Error logging is handled by the set_multi method
+                metrics.incr(metrics.PROCESS, 'failures')
+            buffer.deletes.clear()
+
+        # Bump generations before setting new values so that no value
+        # computed in this transaction is stored under a stale generation
+        # that other clients may still read.
+        if buffer.incrs:
+            for k in buffer.incrs:
+                if self.incr(k, immediate=True) is None:
+                    LOG.error("_invalidate_cache incr of %s failed" % k)
+                    metrics.incr(metrics.PROCESS, 'failures')
+            buffer.incrs.clear()
+
+        if buffer.sets:
+            if _writer is not None:
+                # Deletes and generation bumps are done. Populating the
+                # cache need not delay the transaction.
+                dropped = _writer.enqueue(buffer.sets)
+                if dropped:
+                    metrics.incr(metrics.PROCESS, 'dropped', dropped)
+            else:
+                start = time.time()
+                result_set = self.set_multi(to_set=buffer.sets, 
+                    key_prefix='', 
+                    duration=self.default_duration, 
+                    immediate=True)
+                metrics.observe(metrics.PROCESS, 'set', time.time() - start)
+                # Error logging is handled by the set_multi method
+            buffer.sets.clear()
 
         # xxx: consider what to do in case of failures
 
+class BulkInvalidation(object):
+    """
+    Collects the invalidations of a catalog in the current transaction
+    while it is open and resolves them once before the transaction
+    commits, with one get_multi of the rid maps or a single generation
+    bump. The catalog is not served from the cache for the rest of the
+    transaction once something was collected.
+
+    Use
+        bulk = catalog.bulkInvalidation()
+        try:
+            ...
+        finally:
+            bulk.close()
+
+    or the with statement. Nested use shares one instance.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.rids = set()
+        self.removed = False
+        # Generation names, not prefixed with the cache id
+        self.names = set()
+
+    def __len__(self):
+        return len(self.rids) + len(self.names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        self.depth += 1
+
+    def close(self):
+        if self.depth:
+            self.depth -= 1
+
+    def add(self, rid=None, index_name='', removed=False, value_tokens=()):
+        if rid is not None:
+            self.rids.add(rid)
+            self.removed = self.removed or removed
+        if index_name:
+            name = GENERATION_KEY + '_' + index_name
+            self.names.add(name)
+            for token in value_tokens:
+                self.names.add(name + ':' + token)
+
+def _value_token(value):
+    # Identifies a value of a value index in a generation name. Values
+    # which are equal in BTrees, eg. True, 1 and 1.0, share a token.
+    # Collisions only cause needless invalidation.
+    if isinstance(value, types.UnicodeType):
+        value = value.encode('utf-8')
+    elif isinstance(value, (types.IntType, types.LongType)):
+        # Including booleans
+        value = int(value)
+    elif isinstance(value, types.FloatType):
+        try:
+            if value == int(value):
+                value = int(value)
+        except (OverflowError, ValueError):
+            # Infinite or not a number
+            pass
+    return md5(str(value)).hexdigest()[:16]
+
+def _entry_tokens(entry):
+    # The tokens of the values in an entry returned by getEntryForObject
+    if entry is None or entry == '':
+        return set()
+    if isinstance(entry, (types.ListType, types.TupleType)):
+        return set([_value_token(v) for v in entry])
+    return set([_value_token(entry)])
+
+def _entry_digest(entry):
+    # Compares entries returned by getEntryForObject without keeping them.
+    # Equal entries of different repr only cause needless invalidation.
+    return md5(repr(entry)).digest()
+
+def _includes(shape, names):
+    for name in names:
+        if name not in shape:
+            return False
+    return True
+
+def _pin_time(value, index_name):
+    """
+    Pin a DateTime or datetime in a query on index_name to the start of its
+    time bucket so that queries relative to now share a cache key while
+    the bucket lasts. Other values are returned unchanged.
+    """
+    seconds = query.time_seconds(value)
+    if seconds is None:
+        return value
+    return _pin_seconds(seconds, index_name)
+
+def _pin_seconds(seconds, index_name):
+    bucket = TIME_BUCKETS.get(index_name, TIME_BUCKET)
+    if bucket > 0:
+        return 'time:%d' % (int(seconds // bucket) * bucket)
+    return 'time:%r' % seconds
+
+def _is_now(value, index_name):
+    """
+    Return True if value is a DateTime or datetime which _pin_time pins to
+    the current time bucket of index_name, ie. a time which is taken to be
+    relative to now.
+    """
+    seconds = query.time_seconds(value)
+    if seconds is None:
+        return False
+    return _pin_seconds(seconds, index_name) \
+        == _pin_seconds(time.time(), index_name)
+
+def _generation_duration(name):
+    # Generations of values, eg. '_generation_review_state:<token>',
+    # expire. The others are permanent.
+    if ':' in name[name.rfind(GENERATION_KEY):]:
+        return VALUE_GENERATION_DURATION
+    return 0
+
+def _strip_time(value, index_name):
+    """
+    Replace a DateTime or datetime in a query which is relative to now, see
+    _is_now, by a placeholder, so that queries relative to now are recorded
+    as one query. Other times are pinned, so queries on fixed dates are
+    recorded apart.
+    """
+    if _is_now(value, index_name):
+        return 'time:now'
+    return _pin_time(value, index_name)
+
+def _initial_generation():
+    # Milliseconds since the epoch. This is always larger than any value a
+    # previously evicted counter could have reached through incr.
+    return int(time.time() * 1000)
+
+def _pack_rid_map(digests, overflow=False, generation=None):
+    flags = RIDMAP_VERSION
+    if overflow:
+        flags = flags | RIDMAP_OVERFLOW
+    return chr(flags) + struct.pack(RIDMAP_GENERATION, int(generation or 0)) \
+        + ''.join(digests)
+
+def _unpack_rid_map(value):
+    """
+    Returns: (list of digests, overflow flag, catalog generation). An
+    unreadable value is reported as an overflow so that invalidation
+    remains correct.
+    """
+    if value is None:
+        return [], False, None
+    if not isinstance(value, types.StringType) \
+        or len(value) < RIDMAP_HEADER_SIZE:
+        return [], True, None
+    flags = ord(value[0])
+    if (flags & ~RIDMAP_OVERFLOW) != RIDMAP_VERSION \
+        or (len(value) - RIDMAP_HEADER_SIZE) % RIDMAP_DIGEST_SIZE:
+        return [], True, None
+    generation = struct.unpack(RIDMAP_GENERATION,
+                               value[1:RIDMAP_HEADER_SIZE])[0]
+    size = RIDMAP_DIGEST_SIZE
+    digests = [value[i:i+size] \
+               for i in range(RIDMAP_HEADER_SIZE, len(value), size)]
+    return digests, bool(flags & RIDMAP_OVERFLOW), generation
+
+def _detach(rs):
+    """
+    Return a copy of the result set rs which other threads may read. The
+    result of a single index may be a set of the index itself, which
+    belongs to the database connection of the thread that applied the
+    index and changes with the index.
+    """
+    if rs is None:
+        return None
+    if hasattr(rs, 'items'):
+        return IIBucket(rs.items())
+    if hasattr(rs, 'keys'):
+        return IISet(rs.keys())
+    return IISet(rs)
+
 def _getMemcachedAdapter(self):
     global mem_cache, MEMCACHE_DURATION
     txn = transaction.get()
@@ -295,7 +730,7 @@ def _memcache_available(self):
     _memcache_failure_timestamp = 0
     return True
 
-def _cache_result(self, cache_key, rs, search_indexes=[]):
+def _cache_result(self, cache_key, rs):
     global MEMCACHE_DURATION,  _memcache_failure_timestamp
 
     if not self._memcache_available():
@@ -307,26 +742,74 @@ def _cache_result(self, cache_key, rs, search_indexes=[]):
         return
 
     cache_id = '/'.join(self.getPhysicalPath())
+    start = time.time()
     to_set = {}
 
-    lcache_key = cache_id + cache_key
-    to_set[cache_key] = rs
-
-    # Use get_multi with a prefix to save bandwidth
-    to_get = []
-    for r in rs:
-        to_get.append(str(r))
-        to_set[str(r)] = [lcache_key]
-    for idx in search_indexes:
-        if idx in ('sort_on','sort_order','sort_limit'): continue  
-        to_get.append(idx)
-        to_set[idx] = [lcache_key]
+    size = len(rs)
+    cache_threshold = self._get_cache_setting('cache_threshold', CACHE_THRESHOLD)
+    if cache_threshold and size > cache_threshold:
+        self._record_policy_decision('uncached')
+        return
 
-    # Augment the values of to_set with possibly existing values
+    track_threshold = self._get_cache_setting('track_threshold', TRACK_THRESHOLD)
+    if track_threshold and size > track_threshold:
+        # Tracking every rid costs more than recomputing the query. Stamp
+        # the result with the removal generation so that it is discarded
+        # once any record is removed. Index changes are covered by the
+        # generations in cache_key.
+        removal = getattr(self, '_v_generations', {}).get(REMOVAL_GENERATION_KEY)
+        if removal is None:
+            return
+        decision = 'untracked'
+        stamp = int(removal)
+        to_get = []
+    else:
+        decision = 'tracked'
+        stamp = None
+        to_get = []
+        for r in rs:
+            to_get.append(str(r))
+    try:
+        to_set[cache_key] = codec.encode(rs, stamp)
+    except (TypeError, ValueError, OverflowError):
+        # Eg. weights which are not integers
+        LOG.debug("[%s] Unable to encode the result of %s" % (cache_id, cache_key))
+        return
+    self._record_policy_decision(decision)
+
+    # Augment the possibly existing rid maps with the digest of cache_key.
+    # Rid maps which already contain the digest need not be written.
+    # Use get_multi with a prefix to save bandwidth. Index level
+    # invalidation is handled by generations, so only rids are tracked.
+    digest = unhexlify(cache_key)
+    generation = getattr(self, '_v_generations', {}).get(GENERATION_KEY)
+    if generation is not None:
+        generation = int(generation)
     result = self._getMemcachedAdapter().get_multi(to_get, key_prefix=cache_id)
-    for k,v in result.items():
-        if not isinstance(v, types.ListType): continue
-        to_set[k].extend(v)
+    for k in to_get:
+        digests, overflow, map_generation = _unpack_rid_map(result.get(k))
+        if (generation is not None) and (map_generation != generation):
+            if map_generation is None:
+                # A new or unreadable map
+                pass
+            elif map_generation > generation:
+                # cache_key was orphaned by a catalog generation bump
+                # already
+                continue
+            else:
+                # The keys of these digests were orphaned by a catalog
+                # generation bump
+                digests, overflow = [], False
+            map_generation = generation
+        if digest in digests:
+            continue
+        digests.append(digest)
+        if len(digests) > RIDMAP_MAX_ENTRIES:
+            # Forget the oldest queries. Invalidating this rid must now
+            # bump the catalog generation.
+            digests = digests[-RIDMAP_MAX_ENTRIES:]
+            overflow = True
+        to_set[k] = _pack_rid_map(digests, overflow, map_generation)
 
     if to_set:
         now_seconds = int(time.time())
@@ -342,162 +825,920 @@ def _cache_result(self, cache_key, rs, search_indexes=[]):
         li = to_set.items()
         li.sort()
         hash = md5(str(li)).hexdigest()
-        if (now_seconds - memcache_insertion_timestamps.get(hash, 0)) < 10:
+        if not memcache_insertion_timestamps.set_if_absent(hash, now_seconds):
             LOG.debug("Prevent a call to set_multi since the same insert was done recently")
+            metrics.incr(cache_id, 'throttled')
             return
-        memcache_insertion_timestamps[hash] = now_seconds                       
 
         result = self._getMemcachedAdapter().set_multi(to_set, key_prefix=cache_id, duration=MEMCACHE_DURATION)
+        metrics.observe(cache_id, 'set', time.time() - start)
         if result == False:
             return
-
-        '''
-        # xxx: restore later
-        # Return value of non-empty list indicates error
-        if isinstance(result, types.ListType) and len(result):
-            LOG.error("_cache_result set_multi failed") 
-            _memcache_failure_timestamp = now_seconds
-            # The return value of set_multi is the original to_set list in 
-            # case of no daemons responding.
-            if len(result) != len(to_set):
-                LOG.error("Some keys were successfully written to memcache. This case needs further handling.")
-                # xxx: maybe do a self._clear_cache()?
-        '''
+        metrics.incr(cache_id, 'sets', len(to_set))
+        metrics.incr(cache_id, 'bytes_out',
+                     sum([len(v) for v in to_set.values()]))
 
 def _get_cached_result(self, cache_key, default=[]):
-    global _memcache_failure_timestamp
-
     if not self._memcache_available():
         return default
 
     cache_id = '/'.join(self.getPhysicalPath())
     key = cache_id + cache_key
-    _cache_misses.setdefault(key, 0)
-    result = self._getMemcachedAdapter().get(key, default)
+    adapter = self._getMemcachedAdapter()
+
+    # The removal generation was fetched along with the generations in
+    # cache_key.
+    removal = getattr(self, '_v_generations', {}).get(REMOVAL_GENERATION_KEY)
+    if (removal is not None) and not adapter.delete_pending(key):
+        entry = _local_cache.get(key)
+        if entry is not None:
+            if entry[0] == removal:
+                return entry[1]
+            _local_cache.delete(key)
+
+    start = time.time()
+    result = adapter.get(key, default)
+    metrics.observe(cache_id, 'get', time.time() - start)
     # todo: Return default if any item in rs is not an integer. How?        
     if result is None:
         # Record the time of the miss. If we keep missing this key
         # then something is wrong with memcache and we must stop
         # hitting it for a while.
-        now_seconds = int(time.time())           
-        if _cache_misses.get(key, 0) > 10:
+        if _cache_misses.increment(key) > 10:
             LOG.error("_get_cache_key failed 10 times") 
-            _memcache_failure_timestamp = now_seconds
+            metrics.incr(cache_id, 'failures')
+            _record_failure()
             _cache_misses.clear()
-        else:
-            try:
-                _cache_misses[key] += 1
-            except KeyError:
-                pass
         return default
 
-    _cache_misses[key] = 0  
-    return result
+    _cache_misses.delete(key)
+    if result is default:
+        return default
 
-def _invalidate_cache(self, rid=None, index_name='', immediate=False):
-    """ Invalidate cached results affected by rid and / or index_name
-    """
-    global _memcache_failure_timestamp
+    try:
+        stamp, rs = codec.decode(result)
+    except codec.CodecError:
+        LOG.error("Unable to decode cached result %s" % key)
+        return default
+    metrics.incr(cache_id, 'bytes_in', len(result))
+
+    # Untracked result sets are stamped with the removal generation
+    if (stamp is not None) and (stamp != removal):
+        return default
 
+    if removal is not None:
+        _local_cache.set(key, (removal, rs), len(result))
+    return rs
+
+def _invalidate_cache(self, rid=None, index_name='', immediate=False,
+                      removed=False, value_tokens=()):
+    """ Invalidate cached results affected by rid and / or index_name.
+    Set removed if rid is no longer in the catalog. Queries for the values
+    of index_name identified by value_tokens are invalidated as well.
+    """
     if not self._memcache_available():
         return
 
+    if not immediate:
+        bulk = self._get_bulk_invalidation()
+        if (bulk is not None) and bulk.depth:
+            bulk.add(rid, index_name, removed, value_tokens)
+            return
+
     cache_id = '/'.join(self.getPhysicalPath())
     LOG.debug('[%s] _invalidate_cache rid=%s, index_name=%s' % (cache_id, rid, index_name))
 
     to_delete = []
 
-    # rid and index_name are mutually exclusive, so no need for get_multi
-    # trickery.
-
     if rid is not None:
         s_rid = cache_id + str(rid)
-        rid_map = self._getMemcachedAdapter().get(s_rid, [])        
-        if rid_map is not None:
-            to_delete.extend(rid_map)
+        digests, overflow, generation = _unpack_rid_map(
+            self._getMemcachedAdapter().get(s_rid, None))
+        for digest in digests:
+            to_delete.append(cache_id + hexlify(digest))
         to_delete.append(s_rid)
+        if overflow:
+            # Not all queries containing rid are known
+            self._getMemcachedAdapter().incr(
+                cache_id + GENERATION_KEY, immediate=immediate)
+        if removed:
+            # Discard untracked result sets which may contain rid
+            self._getMemcachedAdapter().incr(
+                cache_id + REMOVAL_GENERATION_KEY, immediate=immediate)
 
     if index_name:
-        s_index_name = cache_id + index_name
-        index_map = self._getMemcachedAdapter().get(s_index_name, []) 
-        if index_map is not None:
-            to_delete.extend(index_map)
-        to_delete.append(s_index_name)
+        # Orphan every query that used the index as a whole
+        self._getMemcachedAdapter().incr(
+            cache_id + GENERATION_KEY + '_' + index_name, immediate=immediate)
+        for token in value_tokens:
+            self._getMemcachedAdapter().incr(
+                cache_id + GENERATION_KEY + '_' + index_name + ':' + token,
+                immediate=immediate)
 
     if to_delete:
-        now_seconds = int(time.time())
         LOG.debug('[%s] Remove %s items from cache' % (cache_id, len(to_delete)))
+        metrics.incr(cache_id, 'deletes', len(to_delete))
         # Return value of 1 indicates no error
         if self._getMemcachedAdapter().delete_multi(to_delete, immediate=immediate) != 1:
             LOG.error("_invalidate_cache delete_multi failed")
-            _memcache_failure_timestamp = now_seconds
+            metrics.incr(cache_id, 'failures')
+            _record_failure()
+
+def _get_bulk_invalidation(self, create=False):
+    """
+    Return the BulkInvalidation of this catalog in the current transaction
+    or None. A new one is resolved before the transaction commits.
+    """
+    txn = transaction.get()
+    if not hasattr(txn, 'v_bulk_invalidations'):
+        if not create:
+            return None
+        txn.v_bulk_invalidations = {}
+    cache_id = '/'.join(self.getPhysicalPath())
+    bulk = txn.v_bulk_invalidations.get(cache_id)
+    if (bulk is None) and create:
+        bulk = txn.v_bulk_invalidations[cache_id] = BulkInvalidation()
+        txn.addBeforeCommitHook(self._resolve_bulk_invalidation)
+    return bulk
+
+def bulkInvalidation(self):
+    """
+    Collect cache invalidations until the returned BulkInvalidation is
+    closed and resolve them when the transaction commits.
+    """
+    bulk = self._get_bulk_invalidation(create=True)
+    bulk.open()
+    return bulk
+
+def _resolve_bulk_invalidation(self):
+    """
+    Apply the invalidations collected by the BulkInvalidation of this
+    catalog. Deletes and generation bumps are buffered and written along
+    with the other writes of the transaction.
+    """
+    txn = transaction.get()
+    cache_id = '/'.join(self.getPhysicalPath())
+    bulk = getattr(txn, 'v_bulk_invalidations', {}).pop(cache_id, None)
+    if (bulk is None) or not len(bulk) or not self._memcache_available():
+        return
+
+    adapter = self._getMemcachedAdapter()
+    LOG.debug('[%s] Resolve bulk invalidation of %s rids and %s generations' \
+        % (cache_id, len(bulk.rids), len(bulk.names)))
+    if bulk.removed:
+        # Discard untracked result sets which may contain removed rids
+        adapter.incr(cache_id + REMOVAL_GENERATION_KEY)
+
+    if len(bulk) > BULK_THRESHOLD:
+        # Orphaning everything is cheaper than resolving every rid map
+        adapter.incr(cache_id + GENERATION_KEY)
+        return
+
+    overflow = False
+    to_delete = []
+    if bulk.rids:
+        keys = [str(rid) for rid in bulk.rids]
+        result = adapter.get_multi(keys, key_prefix=cache_id)
+        for k in keys:
+            digests, rid_overflow, generation = _unpack_rid_map(result.get(k))
+            overflow = overflow or rid_overflow
+            for digest in digests:
+                to_delete.append(cache_id + hexlify(digest))
+            to_delete.append(cache_id + k)
+    if overflow:
+        # Not all queries containing the rids are known
+        adapter.incr(cache_id + GENERATION_KEY)
+    for name in bulk.names:
+        adapter.incr(cache_id + name)
+    if to_delete:
+        metrics.incr(cache_id, 'deletes', len(to_delete))
+        adapter.delete_multi(to_delete)
 
 def _clear_cache(self):  
     if not self._memcache_available():
         return
-    LOG.debug('Flush cache')
-    # No return value for flush_all
-    # xxx: This flushes all caches which is inefficient. Currently
-    # there is no way to delete all keys starting with eg. 
-    # /site/portal_catalog
-    self._getMemcachedAdapter().flush_all()
-    _hits.clear()
-    _misses.clear()
-
-def _get_cache_key(self, args):
-
-    def pin_datetime(dt):
-        # Pin to dt granularity which is 1 minute by default
-        return dt.strftime('%Y-%m-%d.%h:%m %Z')
-
-    items = list(args.request.items())
-    items.extend(list(args.keywords.items()))
-    items.sort()
-    sorted = []
-    for k, v in items:
-        if isinstance(v, types.ListType):
-            v.sort()
-
-        elif isinstance(v, types.TupleType):
-            v = list(v)
-            v.sort()
-
-        elif isinstance(v, DateTime):
-            v = pin_datetime(v)
-
-        elif isinstance(v, types.DictType):               
-            # Find DateTime objects in v and pin them
-            tsorted = []
-            titems = v.items()
-            titems.sort()
-            for tk, tv in titems:
-                if isinstance(tv, DateTime):
-                    tv = pin_datetime(tv)
-                elif isinstance(tv, types.ListType) or isinstance(tv, types.TupleType):
-                    li = []
-                    for item in list(tv):
-                        if isinstance(item, DateTime):
-                            item = pin_datetime(item)
-                        li.append(item)
-                    tv = li
-
-                tsorted.append((tk, tv))
-            v = tsorted
-
-        sorted.append((k,v))
-    cache_key = str(sorted)
-    return md5(cache_key).hexdigest()
+    cache_id = '/'.join(self.getPhysicalPath())
+    LOG.debug('[%s] Clear cache' % cache_id)
+    # Bumping the catalog generation orphans every key of this catalog
+    # only. Other catalogs sharing the memcached servers are unaffected.
+    self._getMemcachedAdapter().incr(cache_id + GENERATION_KEY)
+    metrics.clear(cache_id)
+
+def _get_generation_values(self, names):
+    """
+    Return the values of the generation counters names, which are not
+    prefixed with the cache id. Missing counters are initialised.
+
+    Returns None if caching is not possible, ie. memcached is unavailable,
+    one of the generations is bumped by the current transaction or had to
+    be initialised.
+    """
+    if not self._memcache_available():
+        return None
+
+    cache_id = '/'.join(self.getPhysicalPath())
+    adapter = self._getMemcachedAdapter()
+    # Metadata changes do not affect results. _get_brains checks them.
+    if adapter.incr_pending([cache_id + n for n in names \
+                             if n != METADATA_GENERATION_KEY]):
+        return None
+    bulk = self._get_bulk_invalidation()
+    if (bulk is not None) and len(bulk):
+        # Invalidations are pending until commit
+        return None
+
+    result = adapter.get_multi(names, key_prefix=cache_id)
+    missing = [name for name in names if result.get(name) is None]
+    if not missing:
+        return [result[name] for name in names]
+
+    # First use, expired or evicted. The counters are initialised with one
+    # set_multi per duration instead of an add each. A set may overwrite a
+    # counter initialised concurrently by someone else, so nothing is
+    # cached under the new values until they are read back by a later
+    # search.
+    value = _initial_generation()
+    by_duration = {}
+    for name in missing:
+        by_duration.setdefault(_generation_duration(name), {})[name] = value
+    for duration, to_set in by_duration.items():
+        _set_multi(adapter.memcache, to_set, cache_id, duration)
+    return None
+
+def _get_generations(self, index_names=(), extra_indexes=()):
+    """
+    Return the catalog generation and the generations of index_names, which
+    are index names or value dependencies as returned by _get_dependencies,
+    as a string which is folded into cache keys, or None if caching is not
+    possible.
+
+    The removal generation and the generations of extra_indexes are
+    fetched in the same call. They are not part of the string but kept in
+    _v_generations along with the others.
+    """
+    self._v_generations = {}
+    names = [GENERATION_KEY]
+    for name in index_names:
+        names.append(GENERATION_KEY + '_' + name)
+    folded = len(names)
+    names.append(REMOVAL_GENERATION_KEY)
+    for name in extra_indexes:
+        names.append(GENERATION_KEY + '_' + name)
+    if METADATA_CACHE_MAX_ENTRIES:
+        names.append(METADATA_GENERATION_KEY)
+    values = self._get_generation_values(names)
+    if values is None:
+        return None
+    self._v_generations = dict(zip(names, values))
+    generations = []
+    for name, value in zip(names[:folded], values[:folded]):
+        generations.append('%s=%s' % (name, value))
+    return ','.join(generations)
+
+def _get_cache_setting(self, name, default):
+    """
+    Return the catalogcache_<name> property, which may be acquired from
+    the ZCatalog, or default.
+    """
+    value = getattr(self, 'catalogcache_' + name, None)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def _record_policy_decision(self, decision):
+    cache_id = '/'.join(self.getPhysicalPath())
+    metrics.incr(cache_id, decision)
+
+def _admit(self, cost):
+    """
+    Return True if the result of the query of the last _get_cache_key call,
+    which took cost seconds to compute, is worth caching.
+    """
+    min_cost = self._get_cache_setting('admit_min_cost', ADMIT_MIN_COST)
+    min_frequency = self._get_cache_setting('admit_min_frequency',
+        ADMIT_MIN_FREQUENCY)
+    if (min_cost <= 0) and (min_frequency <= 1):
+        return True
+
+    # Count the query regardless of generations, so that invalidation does
+    # not reset its popularity
+    frequency = _frequency.increment(getattr(self, '_v_query_hash', None))
+    if (frequency >= min_frequency) and (cost * 1000000 * frequency >= min_cost):
+        return True
+    self._record_policy_decision('rejected')
+    return False
+
+def _get_cache_key(self, args, search_indexes=None, extra_indexes=(),
+                   canonical=None):
+    """
+    Return the key under which the result of query args is cached, or None
+    if the result may not be cached. The generations of extra_indexes are
+    fetched for use by _get_sort_cache_key but do not affect the key.
+    canonical is the canonical form of args if it is known already.
+    """
+    if search_indexes is None:
+        search_indexes = self._get_search_indexes(args)
+    generations = self._get_generations(
+        self._get_dependencies(args, search_indexes), extra_indexes)
+    if generations is None:
+        return None
+
+    # The canonical form never mutates the query and lets equivalent
+    # queries share a key
+    if canonical is None:
+        canonical = query.normalize(args, self.indexes, _pin_time)
+    self._v_query_hash = hash(canonical)
+    self._v_canonical = canonical
+    return query.digest(canonical + '|' + generations)
+
+def _get_dependencies(self, args, search_indexes):
+    """
+    Return the names of the generations the result of query args depends
+    on. A query which names the values of a value index depends on the
+    generations of those values only, eg. 'review_state:<token>'. Other
+    queries depend on the generation of the whole index.
+    """
+    dependencies = []
+    for name in search_indexes:
+        values = self._get_query_values(args, name)
+        if values is None:
+            dependencies.append(name)
+        else:
+            tokens = [_value_token(v) for v in values]
+            tokens.sort()
+            for token in tokens:
+                dependencies.append(name + ':' + token)
+    return dependencies
+
+def _get_query_values(self, args, name):
+    """
+    Return the values queried for in value index name, or None if the
+    query can not be expressed as a list of values, eg. range queries.
+    """
+    index = self.indexes.get(name)
+    if getattr(index, 'meta_type', None) not in VALUE_INDEX_TYPES:
+        return None
+    # Old style options change the meaning of the query
+    for option in ('_operator', '_usage'):
+        if args.get(name + option, None) is not None:
+            return None
+
+    query = args.get(name, None)
+    if isinstance(query, types.DictType):
+        for k in query.keys():
+            if k not in ('query', 'operator'):
+                return None
+        query = query.get('query')
+    if isinstance(query, (types.ListType, types.TupleType)):
+        values = list(query)
+    else:
+        values = [query]
+
+    if not values or (len(values) > VALUE_DEPENDENCY_MAX):
+        return None
+    for v in values:
+        if not isinstance(v, VALUE_TYPES):
+            return None
+    return values
+
+def _get_sort_cache_key(self, cache_key, sort_index, reverse=0, limit=None):
+    """
+    Return the key under which the ordered and limited rids for the query
+    with key cache_key are cached, or None if they may not be cached. The
+    generation of sort_index must have been fetched by _get_cache_key.
+    """
+    name = GENERATION_KEY + '_' + sort_index.getId()
+    generation = getattr(self, '_v_generations', {}).get(name)
+    if generation is None:
+        return None
+    key = '%s,%s=%s,reverse=%s,limit=%s' \
+        % (cache_key, name, generation, bool(reverse), limit)
+    return query.digest(key)
+
+def _sort_rids(self, rs, sort_index, reverse=0, limit=None):
+    """
+    Return the rids in rs as a list ordered by sort_index and truncated to
+    limit. Rids which are not in sort_index are dropped, as in sortResults.
+    """
+    if hasattr(rs, 'keys'):
+        rs = rs.keys()
+    rlen = len(rs)
+    result = []
+    append = result.append
+
+    if limit is None and rlen > (len(sort_index) * (rlen / 100 + 1)):
+        # The result set is much larger than the sort index, so iterate
+        # over the sort index.
+        for k, intset in sort_index.items():
+            intset = intersection(rs, intset)
+            if intset:
+                keys = getattr(intset, 'keys', None)
+                if keys is not None:
+                    intset = keys()
+                for did in intset:
+                    append((k, did))
+    else:
+        index_key_map = sort_index.documentToKeyMap()
+        for did in rs:
+            try:
+                key = index_key_map[did]
+            except KeyError:
+                pass
+            else:
+                append((key, did))
+
+    result.sort()
+    if reverse:
+        result.reverse()
+    if limit is not None:
+        result = result[:limit]
+    return [did for key, did in result]
+
+def _apply_indexes(self, request, generations=None):
+    """
+    Return the intersection of the results of every index for request, or
+    None if no index used the request. The smallest results are intersected
+    first.
+
+    generations are the generations fetched by the _get_cache_key call for
+    request, if any. With the partial cache they key the results of the
+    indexes, which are then reused and cached.
+    """
+    keys = {}
+    partial = {}
+    if generations \
+        and self._get_cache_setting('partial_cache', PARTIAL_CACHE):
+        keys = self._get_partial_keys(request, generations)
+        partial = self._get_partial_results(keys,
+            generations.get(REMOVAL_GENERATION_KEY))
+
+    results = []
+    to_cache = {}
+    for i in self.indexes.keys():
+        r = partial.get(i)
+        if r is not None:
+            results.append((len(r), r))
+            continue
+        index = self.getIndex(i)
+        _apply_index = getattr(index, "_apply_index", None)
+        if _apply_index is None:
+            continue
+        r = _apply_index(request)
+
+        if r is not None:
+            r, u = r
+            results.append((len(r), r))
+            if keys.has_key(i):
+                to_cache[keys[i]] = r
+    if to_cache:
+        self._cache_partial_results(to_cache,
+            generations.get(REMOVAL_GENERATION_KEY))
+
+    # Intersections take time proportional to the smaller set, so starting
+    # with the most selective result keeps every step small
+    results.sort(lambda a, b: cmp(a[0], b[0]))
+    rs = None
+    for size, r in results:
+        w, rs = weightedIntersection(rs, r)
+        if not rs:
+            break
+    return rs
+
+def _get_partial_keys(self, request, generations):
+    """
+    Return a dictionary of the names of the indexes request gives a value
+    to the keys their results are cached under. Indexes whose generations
+    were not fetched are left out.
+    """
+    if generations.get(REMOVAL_GENERATION_KEY) is None:
+        return {}
+    parts = query.normalize_parts(request, self.indexes, _pin_time)
+    catalog = '%s=%s' % (GENERATION_KEY, generations.get(GENERATION_KEY))
+    keys = {}
+    for name, part in parts.items():
+        values = [catalog]
+        for dependency in self._get_dependencies(request, [name]):
+            generation = GENERATION_KEY + '_' + dependency
+            value = generations.get(generation)
+            if value is None:
+                break
+            values.append('%s=%s' % (generation, value))
+        else:
+            keys[name] = PARTIAL_KEY + query.digest(
+                part + '|' + ','.join(values))
+    return keys
+
+def _get_partial_results(self, keys, removal):
+    """
+    Return a dictionary of index names to their cached results. keys maps
+    index names to keys as returned by _get_partial_keys.
+    """
+    if not keys:
+        return {}
+    cache_id = '/'.join(self.getPhysicalPath())
+    start = time.time()
+    result = self._getMemcachedAdapter().get_multi(keys.values(),
+        key_prefix=cache_id)
+    metrics.observe(cache_id, 'get', time.time() - start)
+    results = {}
+    for name, key in keys.items():
+        value = result.get(key)
+        if value is None:
+            continue
+        try:
+            stamp, rs = codec.decode(value)
+        except codec.CodecError:
+            continue
+        metrics.incr(cache_id, 'bytes_in', len(value))
+        if stamp == removal:
+            results[name] = rs
+    metrics.incr(cache_id, 'partial_hits', len(results))
+    metrics.incr(cache_id, 'partial_misses', len(keys) - len(results))
+    return results
+
+def _cache_partial_results(self, to_cache, removal):
+    """
+    Cache the results of indexes. to_cache maps keys as returned by
+    _get_partial_keys to results.
+    """
+    to_set = {}
+    for key, rs in to_cache.items():
+        if PARTIAL_MAX_RIDS and (len(rs) > PARTIAL_MAX_RIDS):
+            continue
+        try:
+            to_set[key] = codec.encode(rs, int(removal))
+        except (TypeError, ValueError, OverflowError):
+            # Eg. weights which are not integers
+            continue
+    if not to_set:
+        return
+    cache_id = '/'.join(self.getPhysicalPath())
+    start = time.time()
+    result = self._getMemcachedAdapter().set_multi(to_set,
+        key_prefix=cache_id, duration=MEMCACHE_DURATION)
+    metrics.observe(cache_id, 'set', time.time() - start)
+    if result == False:
+        return
+    metrics.incr(cache_id, 'sets', len(to_set))
+    metrics.incr(cache_id, 'bytes_out',
+                 sum([len(v) for v in to_set.values()]))
+
+def _begin_flight(self, cache_key, default):
+    """
+    Coordinate computing the result of cache_key with the other threads of
+    this process and, if LEASE_TIME is set, with other clients.
+
+    Returns: (flight, rs). If flight is not None this thread computes the
+    result and must pass it to _end_flight and call _end_lease. rs is the
+    result computed by someone else, a stale result or default.
+    """
+    if not SINGLE_FLIGHT_WAIT:
+        return None, default
+
+    key = '/'.join(self.getPhysicalPath()) + cache_key
+    leader, flight = _flights.join(key)
+    if not leader:
+        if SERVE_STALE:
+            rs = self._get_latest_result(default)
+            if rs is not default:
+                return None, rs
+        return None, _flights.wait(flight, SINGLE_FLIGHT_WAIT, default)
+
+    if not LEASE_TIME:
+        return flight, default
+
+    adapter = self._getMemcachedAdapter()
+    if adapter.add(key + LEASE_SUFFIX, 1, LEASE_TIME):
+        return flight, default
+
+    # Another client computes the result and writes it when its transaction
+    # commits
+    rs = default
+    if SERVE_STALE:
+        rs = self._get_latest_result(default)
+    deadline = time.time() + SINGLE_FLIGHT_WAIT
+    while (rs is default) and (time.time() < deadline):
+        time.sleep(LEASE_POLL_INTERVAL)
+        rs = self._get_cached_result(cache_key, default)
+        if (rs is default) and (adapter.get(key + LEASE_SUFFIX, None) is None):
+            # Given up without caching a result
+            break
+    if rs is default:
+        return flight, default
+    _flights.land(key, flight, rs)
+    return None, rs
+
+def _end_flight(self, cache_key, flight, rs, default):
+    """
+    Hand the result rs of cache_key to the threads waiting for it. rs is
+    default if it could not be computed. Otherwise it must not belong to a
+    database connection, see _detach.
+    """
+    key = '/'.join(self.getPhysicalPath()) + cache_key
+    if rs is default:
+        _flights.land(key, flight)
+    else:
+        _flights.land(key, flight, rs)
+
+def _end_lease(self, cache_key, cached):
+    """
+    Release the lease on cache_key unless its result was cached, in which
+    case it expires once other clients can find the result.
+    """
+    if (not LEASE_TIME) or cached:
+        return
+    key = '/'.join(self.getPhysicalPath()) + cache_key + LEASE_SUFFIX
+    self._getMemcachedAdapter().delete_multi([key], immediate=True)
+
+def _set_latest_result(self, rs):
+    """
+    Remember rs as the latest result of the query of the last
+    _get_cache_key call, for SERVE_STALE. rs is read by other threads, so
+    it must not belong to a database connection, see _detach.
+    """
+    if (not SERVE_STALE) or (rs is None):
+        return
+    query_hash = getattr(self, '_v_query_hash', None)
+    if query_hash is None:
+        return
+    key = ('/'.join(self.getPhysicalPath()), query_hash)
+    _latest_results.set(key, rs, 4 * len(rs))
+
+def _get_latest_result(self, default=None):
+    """
+    Return the latest result of the query of the last _get_cache_key call
+    without records which were removed since, or default.
+    """
+    query_hash = getattr(self, '_v_query_hash', None)
+    if query_hash is None:
+        return default
+    rs = _latest_results.get(('/'.join(self.getPhysicalPath()), query_hash))
+    if rs is None:
+        return default
+    return self._without_removed(rs)
+
+def _without_removed(self, rs):
+    """
+    Return rs, which is a set, bucket or list of rids, without the rids
+    which are no longer in the catalog.
+    """
+    has_key = self.data.has_key
+    if isinstance(rs, types.ListType):
+        return [rid for rid in rs if has_key(rid)]
+    if hasattr(rs, 'items'):
+        items = [(rid, w) for rid, w in rs.items() if has_key(rid)]
+        if len(items) == len(rs):
+            return rs
+        return IIBucket(items)
+    rids = [rid for rid in rs.keys() if has_key(rid)]
+    if len(rids) == len(rs):
+        return rs
+    return IISet(rids)
+
+def _revalidates(self, search_indexes):
+    """
+    Return True if the result of a query on search_indexes may be served
+    stale and revalidated in the background.
+    """
+    if not (REVALIDATE_INDEXES and search_indexes):
+        return False
+    for name in search_indexes:
+        if name not in REVALIDATE_INDEXES:
+            return False
+    return True
+
+def _get_latest_key(self):
+    # The key of the latest result of the query of the last _get_cache_key
+    # call, which does not depend on generations
+    return LATEST_KEY + query.digest(self._v_canonical)
+
+def _set_stale_result(self, rs):
+    """
+    Store rs as the latest result of the query of the last _get_cache_key
+    call.
+    """
+    if (rs is None) or (getattr(self, '_v_canonical', None) is None):
+        return
+    cache_threshold = self._get_cache_setting('cache_threshold', CACHE_THRESHOLD)
+    if cache_threshold and len(rs) > cache_threshold:
+        return
+    cache_id = '/'.join(self.getPhysicalPath())
+    try:
+        # Stamped with the time it is known to be fresh
+        value = codec.encode(rs, int(time.time()))
+    except (TypeError, ValueError, OverflowError):
+        return
+    self._getMemcachedAdapter().set_multi({self._get_latest_key(): value},
+        key_prefix=cache_id, duration=MEMCACHE_DURATION)
+
+def _refresh_stale_result(self, rs):
+    """
+    Restamp the latest result of the query of the last _get_cache_key call,
+    since rs was just found in the cache and is fresh. Staleness is thus
+    measured from when the result was last known to be fresh, not from
+    when it was computed. Done at most every REVALIDATE_MAX_AGE / 2
+    seconds per query and process.
+    """
+    if getattr(self, '_v_canonical', None) is None:
+        return
+    key = '/'.join(self.getPhysicalPath()) + self._get_latest_key()
+    if _stale_refreshes.set_if_absent(key, 1):
+        self._set_stale_result(rs)
+
+def _get_stale_result(self, request, default):
+    """
+    Return the latest result of request, whose key was computed by the last
+    _get_cache_key call, without records which were removed since, and
+    have it recomputed in the background. Return default if there is no
+    result which was fresh within the last REVALIDATE_MAX_AGE seconds.
+    """
+    if getattr(self, '_v_canonical', None) is None:
+        return default
+    cache_id = '/'.join(self.getPhysicalPath())
+    key = self._get_latest_key()
+    value = self._getMemcachedAdapter().get(cache_id + key, None)
+    if value is None:
+        return default
+    try:
+        stamp, rs = codec.decode(value)
+    except codec.CodecError:
+        return default
+    if (stamp is None) or (time.time() - stamp > REVALIDATE_MAX_AGE):
+        return default
+
+    if _revalidations.set_if_absent(cache_id + key, 1):
+        _revalidator.schedule(cache_id + key, self,
+                              query.snapshot(request, self.indexes))
+    metrics.incr(cache_id, 'stale')
+    return self._without_removed(rs)
+
+def _revalidate(self, args):
+    """
+    Recompute and cache the result of query args. Called by the
+    Revalidator in its own transaction.
+    """
+    search_indexes = self._get_search_indexes(args)
+    cache_key = self._get_cache_key(args, search_indexes)
+    if cache_key is None:
+        return
+    rs = self._apply_indexes(args, self._v_generations)
+    self._cache_result(cache_key, rs)
+    self._set_stale_result(rs)
+
+def _get_query_record(self):
+    """
+    Return the record of the most frequent queries of this catalog in this
+    process. A new record is restored from the cache.
+    """
+    cache_id = '/'.join(self.getPhysicalPath())
+    record, created = warmup.get_record(cache_id, WARMUP_TOP_K)
+    if created and self._memcache_available():
+        data = mem_cache.get(cache_id + WARMUP_KEY)
+        if data is not None:
+            warmup.restore(record, data)
+        if WARMUP_ON_START:
+            self.warmUp(wait=False, record=record)
+    return record
+
+def _record_query(self, request):
+    """
+    Count the query of the last _get_cache_key call, request, in the record
+    of the most frequent queries and store the record every
+    WARMUP_PERSIST_INTERVAL seconds.
+    """
+    canonical = getattr(self, '_v_canonical', None)
+    if canonical is None:
+        return
+    if 'time:' in canonical:
+        # Pinned times relative to now change with every bucket. Record the
+        # query without them and keep them relative to now for replaying.
+        canonical = query.normalize(request, self.indexes, _strip_time)
+    record = self._get_query_record()
+    if record.add(canonical):
+        try:
+            args = warmup.relative(query.snapshot(request, self.indexes),
+                                   _is_now)
+        except ValueError:
+            # Arguments the record cannot store are not replayed
+            args = None
+        record.set_value(canonical, args)
+
+    cache_id = '/'.join(self.getPhysicalPath())
+    if _warmup_persisted.set_if_absent(cache_id, 1) \
+        and self._memcache_available():
+        # Keep queries recorded by other clients
+        data = mem_cache.get(cache_id + WARMUP_KEY)
+        if data is not None:
+            warmup.restore(record, data)
+        _set_multi(mem_cache, {cache_id + WARMUP_KEY: warmup.dump(record)},
+                   '', 0)
+
+def warmUp(self, threads=None, wait=True, record=None):
+    """
+    Replay the most frequent queries of this catalog so that their results
+    are cached, eg. after a restart.
+
+    Returns: the number of queries which are replayed
+    """
+    if not self._memcache_available():
+        return 0
+    if record is None:
+        record = self._get_query_record()
+    queries = [args for canonical, count, args in record.top() \
+               if args is not None]
+    if threads is None:
+        threads = WARMUP_THREADS
+    count = warmup.warm_up(self, queries, threads, wait)
+    metrics.incr('/'.join(self.getPhysicalPath()), 'warmed', count)
+    return count
+
+def _caches_shape(self, shape):
+    """
+    Return False if queries of shape, as returned by query.shape, should
+    bypass the cache.
+    """
+    if not shape:
+        # Everything is returned, which is never cached
+        return False
+    for names in UNCACHEABLE_SHAPES:
+        if _includes(shape, names):
+            return False
+    cache_id = '/'.join(self.getPhysicalPath())
+    return not _shapes.bypassed((cache_id, shape))
+
+def _record_shape(self, shape, hit):
+    """
+    Count a lookup of a query of shape, so that shapes which rarely hit
+    bypass the cache.
+    """
+    for names in CACHEABLE_SHAPES:
+        if _includes(shape, names):
+            return
+    cache_id = '/'.join(self.getPhysicalPath())
+    if _shapes.record((cache_id, shape), hit):
+        LOG.info("[%s] Queries on %s hit less than %s%% of the time. "
+                 "Bypassing the cache for %s seconds." % (cache_id,
+                 ', '.join(shape), SHAPE_MIN_HIT_RATIO, SHAPE_BYPASS_TIME))
+
+def _fresh_result(result):
+    """
+    Return a copy of result, a lazy sequence which was never accessed, so
+    that callers repeating a search do not share the brains it
+    materializes. Lists hold materialized state, except _seq which holds
+    what is materialized.
+    """
+    if not isinstance(result, Lazy):
+        return result
+    klass = result.__class__
+    copy = klass.__new__(klass)
+    state = result.__dict__.copy()
+    for name, value in state.items():
+        if (name != '_seq') and isinstance(value, types.ListType):
+            state[name] = []
+    if isinstance(result, LazyCat) and state.has_key('_seq'):
+        state['_seq'] = [_fresh_result(s) for s in state['_seq']]
+    copy.__dict__.update(state)
+    return copy
+
+def _get_search_memo(self):
+    """
+    Return the mapping of search keys to results of this catalog in the
+    current transaction.
+    """
+    txn = transaction.get()
+    if not hasattr(txn, 'v_search_memo'):
+        txn.v_search_memo = {}
+    cache_id = '/'.join(self.getPhysicalPath())
+    memo = txn.v_search_memo.get(cache_id)
+    if memo is None:
+        memo = txn.v_search_memo[cache_id] = {}
+    return memo
+
+def _clear_search_memo(self):
+    txn = transaction.get()
+    if getattr(txn, 'v_search_memo', None):
+        txn.v_search_memo.pop('/'.join(self.getPhysicalPath()), None)
 
 def _get_search_indexes(self, args):
     keys = list(args.request.keys())
     keys.extend(list(args.keywords.keys()))
-    return keys
+    indexes = self.indexes
+    result = []
+    for k in keys:
+        if indexes.has_key(k) and (k not in result):
+            result.append(k)
+    result.sort()
+    return result
 
 # Methods clear, catalog, uncatalogObject, search are from the default Catalog.py
 def clear(self):
     """ clear catalog """
 
     self._clear_cache()
+    self._clear_search_memo()
     self.data  = IOBTree()  # mapping of rid to meta_data
     self.uids  = OIBTree()  # mapping of uid to rid
     self.paths = IOBTree()  # mapping of rid to uid
@@ -527,11 +1768,15 @@ def catalogObject(self, object, uid, threshold=None, idxs=None,
     if idxs is None:
         idxs = []
 
+    # Results found earlier in this transaction may change
+    self._clear_search_memo()
+
     data = self.data
     index = self.uids.get(uid, None)
 
-    if index is not None:
-        self._invalidate_cache(rid=index)
+    # Cached results of an existing object need not be invalidated by rid.
+    # Any change to an index entry invalidates the queries which depend on
+    # it below.
 
     if index is None:  # we are inserting new data
         #self._clear_cache() # not needed? 
@@ -544,7 +1789,12 @@ def catalogObject(self, object, uid, threshold=None, idxs=None,
         self.paths[index] = uid
 
     elif update_metadata:  # we are updating and we need to update metadata
+        record = data.get(index)
         self.updateMetadata(object, uid)
+        if METADATA_CACHE_MAX_ENTRIES and (data.get(index) is not record):
+            # Cached records of this catalog are outdated
+            self._getMemcachedAdapter().incr(
+                '/'.join(self.getPhysicalPath()) + METADATA_GENERATION_KEY)
 
     # do indexing
 
@@ -556,22 +1806,50 @@ def catalogObject(self, object, uid, threshold=None, idxs=None,
     for name in use_indexes:
         x = self.getIndex(name)
         if hasattr(x, 'index_object'):
-            before = self.getIndex(name).getEntryForObject(index, "")
-
-            blah = x.index_object(index, object, threshold)
-
-            after = self.getIndex(name).getEntryForObject(index, "")
-
-            # If index has changed we must invalidate parts of the cache
-            if before != after:
-                self._invalidate_cache(index_name=name)
-
+            blah = self._index_object(x, name, index, object, threshold)
             total = total + blah
         else:
             LOG.error('catalogObject was passed bad index object %s.' % str(x))
 
     return total
 
+def _index_object(self, x, name, rid, object, threshold=None):
+    """
+    Apply object to the index x called name and invalidate the cached
+    results which its change affects. Returns the result of index_object.
+    """
+    meta_type = getattr(x, 'meta_type', None)
+    if meta_type in CHANGE_UNDETECTED_TYPES:
+        result = x.index_object(rid, object, threshold)
+        self._invalidate_cache(index_name=name)
+        return result
+
+    value_index = meta_type in VALUE_INDEX_TYPES
+    signal = meta_type in CHANGE_SIGNAL_TYPES
+    if value_index:
+        # The values the object loses are only known before indexing
+        before = x.getEntryForObject(rid, "")
+    elif not signal:
+        before = _entry_digest(x.getEntryForObject(rid, ""))
+
+    result = x.index_object(rid, object, threshold)
+    if signal and not result:
+        # Unchanged
+        return result
+
+    # If index has changed we must invalidate parts of the cache
+    if value_index:
+        after = x.getEntryForObject(rid, "")
+        if before != after:
+            # Queries for values which the object gained or lost
+            tokens = _entry_tokens(before) ^ _entry_tokens(after)
+            self._invalidate_cache(index_name=name, value_tokens=tokens)
+    elif signal:
+        self._invalidate_cache(index_name=name)
+    elif _entry_digest(x.getEntryForObject(rid, "")) != before:
+        self._invalidate_cache(index_name=name)
+    return result
+
 def uncatalogObject(self, uid):
     """
     Uncatalog and object from the Catalog.  and 'uid' is a unique
@@ -591,7 +1869,8 @@ def uncatalogObject(self, uid):
     rid = uids.get(uid, None)
 
     if rid is not None:
-        self._invalidate_cache(rid=rid)
+        self._invalidate_cache(rid=rid, removed=True)
+        self._clear_search_memo()
 
         for name in indexes:
             x = self.getIndex(name)
@@ -619,6 +1898,40 @@ def search(self, request, sort_index=None, reverse=0, limit=None, merge=1):
     results is not guaranteed to fall within the limit however, you should
     still slice or batch the results as usual."""
 
+    if not (merge and SEARCH_MEMO_MAX_ENTRIES and self._memcache_available()):
+        # Raw results are modified by mergeResults. Without a cache the
+        # catalog behaves as if it was not patched.
+        return self._search(request, sort_index, reverse, limit, merge)
+
+    canonical = query.normalize(request, self.indexes, _pin_time)
+    # Templates often repeat searches within a request. Reuse the result
+    # until the catalog changes.
+    if sort_index is None:
+        sort_on = None
+    else:
+        sort_on = sort_index.getId()
+    memo_key = '%s|%s|%s|%s' % (canonical, sort_on, reverse and 1 or 0, limit)
+    memo = self._get_search_memo()
+    result = memo.get(memo_key)
+    if result is not None:
+        metrics.incr('/'.join(self.getPhysicalPath()), 'memoized')
+        return _fresh_result(result)
+
+    result = self._search(request, sort_index, reverse, limit, merge,
+                          canonical)
+    if len(memo) < SEARCH_MEMO_MAX_ENTRIES:
+        # The memoized result is never accessed, every caller gets a copy
+        memo[memo_key] = result
+        return _fresh_result(result)
+    return result
+
+def _search(self, request, sort_index=None, reverse=0, limit=None, merge=1,
+            canonical=None):
+    """
+    Search without reusing results of the current transaction. canonical
+    is the canonical form of request if it is known already.
+    """
+
     rs = None # resultset
 
     # Indexes fulfill a fairly large contract here. We hand each
@@ -638,47 +1951,113 @@ def search(self, request, sort_index=None, reverse=0, limit=None, merge=1):
     # Note that if the indexes find query arguments, but the end result
     # is an empty sequence, we do nothing
     cache_id = '/'.join(self.getPhysicalPath())
-    cache_key = self._get_cache_key(request)
-    _misses.setdefault(cache_id, 0)
-    _hits.setdefault(cache_id, 0)
+    search_indexes = self._get_search_indexes(request)
+    shape = query.shape(request, search_indexes)
+
+    # The ordered rids of sorted queries may be cached as well. They depend
+    # on the sort index in addition to the search indexes.
+    sort_cache = (sort_index is not None) and merge \
+        and hasattr(sort_index, 'documentToKeyMap') \
+        and self._get_cache_setting('sort_cache', SORT_CACHE)
+    bypassed = not self._caches_shape(shape)
+    if bypassed:
+        # Not worth computing a key or asking the cache
+        cache_key = None
+        metrics.incr(cache_id, 'bypassed')
+    elif sort_cache:
+        cache_key = self._get_cache_key(request, search_indexes,
+            extra_indexes=[sort_index.getId()], canonical=canonical)
+    else:
+        cache_key = self._get_cache_key(request, search_indexes,
+            canonical=canonical)
+    sort_cache_key = None
+    if sort_cache and (cache_key is not None):
+        sort_cache_key = self._get_sort_cache_key(cache_key, sort_index,
+            reverse, limit)
+    if (cache_key is not None) and WARMUP_TOP_K:
+        self._record_query(request)
+    # The generations of this search key the metadata cache
+    token = None
+    if cache_key is not None:
+        token = self._get_metadata_token()
+
     marker = '_marker'
-    rs = self._get_cached_result(cache_key, marker)
+    # Results found in the cache were admitted before
+    admitted = True
+    sorted_rids = marker
+    if sort_cache_key is not None:
+        sorted_rids = self._get_cached_result(sort_cache_key, marker)
+    if sorted_rids is not marker:
+        rs = sorted_rids
+    elif cache_key is None:
+        rs = marker
+    else:
+        rs = self._get_cached_result(cache_key, marker)
+
+    flight = None
+    coalesced = False
+    cached = rs is not marker
+    if (rs is marker) and (cache_key is not None) \
+        and self._revalidates(search_indexes):
+        rs = self._get_stale_result(request, marker)
+        coalesced = rs is not marker
+    if (rs is marker) and (cache_key is not None):
+        # Another thread or client may be computing the result already
+        flight, rs = self._begin_flight(cache_key, marker)
+        coalesced = rs is not marker
+    if cache_key is not None:
+        # Stale and coalesced results are not hits of the shape
+        self._record_shape(shape, cached)
 
     if rs is marker:
         LOG.debug('[%s] MISS: %s' % (cache_id, cache_key)) 
-        rs = None
-        for i in self.indexes.keys():
-            index = self.getIndex(i)
-            _apply_index = getattr(index, "_apply_index", None)
-            if _apply_index is None:
-                continue
-            r = _apply_index(request)
-
-            if r is not None:
-                r, u = r
-                w, rs = weightedIntersection(rs, r)
+        start = time.time()
+        generations = None
+        if cache_key is not None:
+            generations = self._v_generations
+        try:
+            rs = self._apply_indexes(request, generations)
+        except:
+            if flight is not None:
+                self._end_flight(cache_key, flight, marker, marker)
+            raise
+        cost = time.time() - start
+        # rs may be a set of an index, which belongs to the database
+        # connection of this thread. Other threads are handed a copy.
+        shared = None
+        if (flight is not None) or SERVE_STALE:
+            shared = _detach(rs)
+        if flight is not None:
+            self._end_flight(cache_key, flight, shared, marker)
+        metrics.observe(cache_id, 'index', cost)
 
-        search_indexes = self._get_search_indexes(request)
         LOG.debug("[%s] Search indexes = %s" % (cache_id, str(search_indexes)))
-        self._cache_result(cache_key, rs, search_indexes)
-
-        try:
-            _misses[cache_id] += 1
-        except KeyError:
-            pass
+        if cache_key is not None:
+            admitted = self._admit(cost)
+            if admitted:
+                self._cache_result(cache_key, rs)
+            if flight is not None:
+                self._end_lease(cache_key, admitted)
+            self._set_latest_result(shared)
+            if self._revalidates(search_indexes):
+                self._set_stale_result(rs)
+
+        if not bypassed:
+            metrics.incr(cache_id, 'misses')
+    elif coalesced:
+        # Computed, and cached, by another thread or client
+        admitted = False
+        metrics.incr(cache_id, 'coalesced')
     else:
         #LOG.debug('[%s] HIT: %s' % (cache_id, cache_key)) 
-        try:
-            _hits[cache_id] += 1
-        except KeyError:
-            pass
+        metrics.incr(cache_id, 'hits')
+        if sorted_rids is marker:
+            self._set_latest_result(rs)
+            if self._revalidates(search_indexes):
+                self._refresh_stale_result(rs)
 
-    # Output stats
-    if int(time.time()) % 10 == 0:
-        hits = _hits.get(cache_id)
-        if hits:
-            misses = _misses.get(cache_id, 0)
-            LOG.info('[%s] Hit rate: %.2f%%' % (cache_id, hits*100.0/(hits+misses)))
+    if sorted_rids is not marker:
+        return self._lazy_brains(sorted_rids, token)
 
     if rs is None:
         # None of the indexes found anything to do with the request
@@ -733,17 +2112,116 @@ def search(self, request, sort_index=None, reverse=0, limit=None, merge=1):
             # no scores
             if hasattr(rs, 'keys'):
                 rs = rs.keys()
-            return LazyMap(self.__getitem__, rs, len(rs))
+            return self._lazy_brains(rs, token)
         else:
             # sort.  If there are scores, then this block is not
             # reached, therefore 'sort-on' does not happen in the
             # context of a text index query.  This should probably
             # sort by relevance first, then the 'sort-on' attribute.
+            if sort_cache_key is not None:
+                rids = self._sort_rids(rs, sort_index, reverse, limit)
+                if admitted:
+                    self._cache_result(sort_cache_key, rids)
+                return self._lazy_brains(rids, token)
             return self.sortResults(rs, sort_index, reverse, limit, merge)
     else:
         # Empty result set
         return LazyCat([])
 
+def _lazy_brains(self, rids, token=None):
+    """
+    Return a lazy sequence of the brains of rids. token, as returned by
+    _get_metadata_token, keys the metadata cache.
+    """
+    if not BRAIN_BATCH_SIZE:
+        return LazyMap(self.__getitem__, rids, len(rids))
+    return LazyBrains(self, rids, len(rids), BRAIN_BATCH_SIZE, token)
+
+def _get_metadata_token(self):
+    """
+    Return the key of the records in the metadata cache as of the
+    generations fetched by the last _get_cache_key call, or None if the
+    cache may not be used.
+    """
+    if not METADATA_CACHE_MAX_ENTRIES:
+        return None
+    generations = getattr(self, '_v_generations', None) or {}
+    removal = generations.get(REMOVAL_GENERATION_KEY)
+    metadata = generations.get(METADATA_GENERATION_KEY)
+    if (removal is None) or (metadata is None):
+        return None
+    return '%s:%s' % (removal, metadata)
+
+def _get_brains(self, rids, token=None):
+    """
+    Return the brains of rids, leaving out rids which are no longer in the
+    catalog. The records of rids which are close to each other are fetched
+    in one pass over self.data. token, as returned by _get_metadata_token,
+    keys the metadata cache.
+    """
+    data = self.data
+    cache_id = '/'.join(self.getPhysicalPath())
+    if token is not None:
+        # Changes of this transaction are not in the metadata cache
+        adapter = self._getMemcachedAdapter()
+        if adapter.incr_pending([cache_id + REMOVAL_GENERATION_KEY,
+                                 cache_id + METADATA_GENERATION_KEY]):
+            token = None
+
+    records = {}
+    missing = []
+    for rid in rids:
+        if not isinstance(rid, types.IntType):
+            continue
+        if token is not None:
+            record = _metadata.get((cache_id, rid, token))
+            if record is not None:
+                records[rid] = record
+                continue
+        missing.append(rid)
+
+    if missing:
+        low, high = min(missing), max(missing)
+        if high - low < BRAIN_BATCH_DENSITY * len(missing):
+            wanted = dict.fromkeys(missing)
+            for rid, record in data.items(low, high):
+                if wanted.has_key(rid):
+                    records[rid] = record
+        else:
+            for rid in missing:
+                record = data.get(rid)
+                if record is not None:
+                    records[rid] = record
+        if token is not None:
+            for rid in missing:
+                record = records.get(rid)
+                if record is not None:
+                    _metadata.set((cache_id, rid, token), record)
+
+    brains = []
+    stale = []
+    result_class = self._v_result_class
+    parent = self.aq_parent
+    for rid in rids:
+        record = records.get(rid)
+        if record is None:
+            stale.append(rid)
+            continue
+        r = result_class(record).__of__(parent)
+        r.data_record_id_ = rid
+        r.data_record_score_ = 1
+        r.data_record_normalized_score_ = 1
+        brains.append(r)
+
+    if stale:
+        # Memcache may be responsible for these bad rids. Skip them and
+        # remove them from the cache when the transaction commits, which
+        # bumps the removal generation once however many there are.
+        LOG.error("rids %s lead to KeyError. Removing from cache." % stale)
+        for rid in stale:
+            self._invalidate_cache(rid=rid, removed=True)
+    return brains
+
 def __getitem__(self, index, ttype=type(())):
     """
     Returns instances of self._v_brains, or whatever is passed
@@ -757,7 +2235,7 @@ def __getitem__(self, index, ttype=type(())):
         # needed since we started using transaction aware caching.
         if not isinstance(key, types.IntType) or not self.data.has_key(key):
             LOG.error("Weighted rid %s leads to KeyError. Removing from cache." % index)
-            self._invalidate_cache(rid=index, immediate=True)
+            self._invalidate_cache(rid=key, immediate=True, removed=True)
         r=self._v_result_class(self.data[key]).__of__(self.aq_parent)
         r.data_record_id_ = key
         r.data_record_score_ = score
@@ -766,7 +2244,7 @@ def __getitem__(self, index, ttype=type(())):
         # otherwise no score, set all scores to 1
         if not isinstance(index, types.IntType) or not self.data.has_key(index):
             LOG.error("rid %s leads to KeyError. Removing from cache." % index)
-            self._invalidate_cache(rid=index, immediate=True)
+            self._invalidate_cache(rid=index, immediate=True, removed=True)
         r=self._v_result_class(self.data[index]).__of__(self.aq_parent)
         r.data_record_id_ = index
         r.data_record_score_ = 1
@@ -780,10 +2258,65 @@ Catalog._cache_result = _cache_result
 Catalog._get_cached_result = _get_cached_result
 Catalog._invalidate_cache = _invalidate_cache
 Catalog._clear_cache = _clear_cache
+Catalog._get_bulk_invalidation = _get_bulk_invalidation
+Catalog.bulkInvalidation = bulkInvalidation
+Catalog._resolve_bulk_invalidation = _resolve_bulk_invalidation
+Catalog._get_generation_values = _get_generation_values
+Catalog._get_generations = _get_generations
+Catalog._get_cache_setting = _get_cache_setting
+Catalog._admit = _admit
+Catalog._record_policy_decision = _record_policy_decision
 Catalog._get_cache_key = _get_cache_key
+Catalog._get_dependencies = _get_dependencies
+Catalog._get_query_values = _get_query_values
+Catalog._get_sort_cache_key = _get_sort_cache_key
+Catalog._sort_rids = _sort_rids
+Catalog._apply_indexes = _apply_indexes
+Catalog._get_partial_keys = _get_partial_keys
+Catalog._get_partial_results = _get_partial_results
+Catalog._cache_partial_results = _cache_partial_results
+Catalog._begin_flight = _begin_flight
+Catalog._end_flight = _end_flight
+Catalog._end_lease = _end_lease
+Catalog._set_latest_result = _set_latest_result
+Catalog._get_latest_result = _get_latest_result
+Catalog._without_removed = _without_removed
+Catalog._revalidates = _revalidates
+Catalog._get_latest_key = _get_latest_key
+Catalog._set_stale_result = _set_stale_result
+Catalog._refresh_stale_result = _refresh_stale_result
+Catalog._get_stale_result = _get_stale_result
+Catalog._revalidate = _revalidate
+Catalog._get_query_record = _get_query_record
+Catalog._record_query = _record_query
+Catalog.warmUp = warmUp
+Catalog._caches_shape = _caches_shape
+Catalog._record_shape = _record_shape
+Catalog._get_search_memo = _get_search_memo
+Catalog._clear_search_memo = _clear_search_memo
 Catalog._get_search_indexes = _get_search_indexes
 Catalog.clear = clear
 Catalog.catalogObject = catalogObject
+Catalog._index_object = _index_object
 Catalog.uncatalogObject = uncatalogObject
 Catalog.search = search
+Catalog._search = _search
+Catalog._lazy_brains = _lazy_brains
+Catalog._get_metadata_token = _get_metadata_token
+Catalog._get_brains = _get_brains
 Catalog.__getitem__ = __getitem__
+
+from Products.ZCatalog.ZCatalog import ZCatalog
+_refreshCatalog = ZCatalog.refreshCatalog
+
+def refreshCatalog(self, *args, **kw):
+    """
+    Reindex every object with the invalidations collected in bulk
+    """
+    bulk = self._catalog.bulkInvalidation()
+    try:
+        return _refreshCatalog(self, *args, **kw)
+    finally:
+        bulk.close()
+
+ZCatalog.refreshCatalog = refreshCatalog
@@ -0,0 +1,294 @@
+"""
+Canonical form of catalog queries.
+
+Semantically identical queries must share a cache key. normalize returns a
+string in which
+
+- only arguments which can influence the result are kept, ie. index names,
+  old style index options like review_state_operator and the sort
+  arguments,
+- empty arguments, which indexes ignore, are dropped,
+- {'query': x} is the same as x and the default operator is dropped,
+- for indexes other than text indexes a single value is the same as a list
+  holding it, and lists and tuples are sorted and deduplicated,
+- mapping keys are sorted and every value is written with its type, so the
+  form does not depend on repr details.
+
+The query is never modified.
+"""
+
+import types
+import time
+import calendar
+from datetime import datetime
+
+from DateTime import DateTime
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+from md5 import md5
+
+SORT_KEYS = ('sort_on', 'sort_order', 'sort_limit')
+REVERSE_SORT_ORDERS = ('reverse', 'descending')
+# Indexes whose query strings are parsed, so lists are not sets
+TEXT_INDEX_TYPES = ('ZCTextIndex', 'TextIndex', 'TextIndexNG2', 'TextIndexNG3')
+DEFAULT_OPERATOR = 'or'
+INTEGER_TYPES = (types.IntType, types.LongType, types.BooleanType)
+SEQUENCE_TYPES = (types.ListType, types.TupleType)
+STRING_TYPES = (types.StringType, types.UnicodeType)
+SCALAR_TYPES = STRING_TYPES + INTEGER_TYPES + SEQUENCE_TYPES
+
+def digest(value):
+    """
+    Return a 32 character hex digest of the string value. xxhash is used
+    if it is installed.
+    """
+    if xxhash is not None:
+        return xxhash.xxh128(value).hexdigest()
+    return md5(value).hexdigest()
+
+def time_seconds(value):
+    """
+    Return the seconds since the epoch of value if it is a DateTime or a
+    datetime, otherwise None. Naive datetimes are in local time.
+    """
+    if isinstance(value, DateTime):
+        return value.timeTime()
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            seconds = time.mktime(value.timetuple())
+        else:
+            seconds = calendar.timegm(value.utctimetuple())
+        return seconds + value.microsecond / 1000000.0
+    return None
+
+def normalize(args, indexes, pin=None):
+    """
+    Return the canonical form of the query args, a CatalogSearchArgumentsMap.
+    indexes maps index names to indexes. pin(value, index_name) may replace
+    time values, see patch._pin_time.
+    """
+    if args.request:
+        query = _collect(args)
+    else:
+        # The common case of keyword arguments only. Empty arguments are
+        # dropped below.
+        query = args.keywords
+    names = query.keys()
+    names.sort()
+    parts = []
+    get_index = indexes.get
+    for name in names:
+        value = query[name]
+        t = type(value)
+        if t is types.StringType:
+            if not value:
+                continue
+            index = get_index(name)
+            if (index is not None) \
+                and (getattr(index, 'meta_type', None) not in TEXT_INDEX_TYPES):
+                # The common case of a single plain value
+                parts.append('%s=[s%d:%s]' % (name, len(value), value))
+                continue
+        elif (value is None) or ((t is types.UnicodeType) and not value):
+            continue
+        value = _normalize_item(name, value, indexes, pin)
+        if value is not None:
+            parts.append('%s=%s' % (name, value))
+    return ';'.join(parts)
+
+def normalize_parts(args, indexes, pin=None):
+    """
+    Return a dictionary of the index names of the query args to the
+    canonical form of the part of args each index uses, ie. its argument
+    and its old style options.
+    """
+    query = _collect(args)
+    names = query.keys()
+    names.sort()
+    parts = {}
+    has_index = indexes.has_key
+    for name in names:
+        if has_index(name):
+            index_name = name
+        elif name in SORT_KEYS:
+            continue
+        else:
+            index_name = _get_option_index_name(name, indexes)
+            if index_name is None:
+                continue
+        value = _normalize_item(name, query[name], indexes, pin)
+        parts.setdefault(index_name, []).append('%s=%s' % (name, value))
+    for index_name, items in parts.items():
+        parts[index_name] = ';'.join(items)
+    return parts
+
+def _collect(args):
+    query = {}
+    # Keywords take precedence over the request
+    for source in (args.request, args.keywords):
+        for k, v in source.items():
+            if (v is None) or ((type(v) in STRING_TYPES) and not v):
+                # Indexes ignore empty arguments
+                query.pop(k, None)
+            else:
+                query[k] = v
+    return query
+
+def _normalize_item(name, value, indexes, pin):
+    # The canonical form of argument name, or None if it is not used
+    if indexes.has_key(name):
+        if (type(value) is types.StringType) \
+            and (getattr(indexes[name], 'meta_type', None) \
+                 not in TEXT_INDEX_TYPES):
+            # The common case of a single plain value
+            return '[s%d:%s]' % (len(value), value)
+        return _normalize_index_query(value, indexes[name], name, pin)
+    if name in SORT_KEYS:
+        return _normalize_sort(name, value)
+    index_name = _get_option_index_name(name, indexes)
+    if index_name is None:
+        return None
+    return _serialize(value, pin, index_name)
+
+def snapshot(args, indexes):
+    """
+    Return a dictionary of the arguments of the query args, a
+    CatalogSearchArgumentsMap, which can influence the result. Unlike args
+    it does not refer to the request, so it may outlive it.
+    """
+    query = {}
+    for source in (args.request, args.keywords):
+        for k, v in source.items():
+            if indexes.has_key(k) or (k in SORT_KEYS) \
+                or (_get_option_index_name(k, indexes) is not None):
+                query[k] = v
+    return query
+
+def shape(args, names):
+    """
+    Return the shape of the query args, a CatalogSearchArgumentsMap, ie. a
+    sorted tuple of those of names, eg. the index names found in args,
+    which args gives a value which is not empty. An empty shape means that
+    no index will find anything to do with args.
+    """
+    result = []
+    for name in names:
+        v = args.get(name)
+        if (v is None) or ((type(v) in STRING_TYPES) and not v):
+            continue
+        result.append(name)
+    result.sort()
+    return tuple(result)
+
+def _get_option_index_name(name, indexes):
+    # The index an old style option like review_state_operator belongs to
+    for index_name in indexes.keys():
+        if name.startswith(index_name + '_'):
+            return index_name
+    return None
+
+def _normalize_sort(name, value):
+    if name == 'sort_order':
+        if str(value).lower() in REVERSE_SORT_ORDERS:
+            return 'reverse'
+        return 'ascending'
+    if name == 'sort_limit':
+        try:
+            return 'i%d' % int(value)
+        except (TypeError, ValueError):
+            pass
+    return _serialize(value)
+
+def _normalize_index_query(value, index, index_name, pin):
+    text = getattr(index, 'meta_type', None) in TEXT_INDEX_TYPES
+
+    options = {}
+    t = type(value)
+    if t is types.DictType:
+        options = value.copy()
+        value = options.pop('query', None)
+    elif (t not in SCALAR_TYPES) and hasattr(value, 'keys') \
+        and hasattr(value, 'query'):
+        # A ZPublisher record
+        for k in value.keys():
+            options[k] = getattr(value, k)
+        value = options.pop('query', None)
+
+    if options and (options.get('operator') == DEFAULT_OPERATOR):
+        del options['operator']
+
+    if text:
+        value = _serialize(value, pin, index_name)
+    else:
+        if type(value) not in SEQUENCE_TYPES:
+            value = [value]
+        value = _serialize_set(value, pin, index_name)
+
+    if not options:
+        return value
+    return value + _serialize(options, pin, index_name)
+
+def _serialize_set(values, pin=None, index_name=None):
+    if (len(values) == 1) and (type(values[0]) is types.StringType):
+        return '[s%d:%s]' % (len(values[0]), values[0])
+    for v in values:
+        if type(v) is not types.StringType:
+            break
+    else:
+        # Plain strings only, the common case
+        items = dict.fromkeys(values).keys()
+        items.sort()
+        return '[%s]' % ','.join(['s%d:%s' % (len(v), v) for v in items])
+
+    items = {}
+    for v in values:
+        items[_serialize(v, pin, index_name)] = 1
+    items = items.keys()
+    items.sort()
+    return '[%s]' % ','.join(items)
+
+def _serialize(value, pin=None, index_name=None):
+    """
+    Write value with its type so that equal values of different repr and
+    different values of equal repr are told apart.
+    """
+    t = type(value)
+    if t is types.StringType:
+        return 's%d:%s' % (len(value), value)
+    if t is types.UnicodeType:
+        try:
+            # Equal to the plain string in BTrees
+            value = value.encode('ascii')
+        except UnicodeError:
+            value = value.encode('utf-8')
+            return 'u%d:%s' % (len(value), value)
+        return 's%d:%s' % (len(value), value)
+    if t in INTEGER_TYPES:
+        return 'i%d' % value
+    if value is None:
+        return 'n'
+    if t in SEQUENCE_TYPES:
+        return '(%s)' % ','.join([_serialize(v, pin, index_name) for v in value])
+    if t is types.DictType:
+        keys = value.keys()
+        keys.sort()
+        return '{%s}' % ','.join(['%s:%s' % (_serialize(k),
+                                             _serialize(value[k], pin, index_name))
+                                  for k in keys])
+    if t is types.FloatType:
+        return 'f%r' % value
+
+    # Only times are pinned
+    if pin is not None:
+        pinned = pin(value, index_name)
+        if pinned is not value:
+            return 't%s' % pinned
+    if isinstance(value, types.StringType):
+        return _serialize(str(value))
+    if isinstance(value, types.UnicodeType):
+        return _serialize(unicode(value))
+    value = repr(value)
+    return 'r%d:%s' % (len(value), value)
@@ -0,0 +1,117 @@
+import threading
+
+import transaction
+from Acquisition import aq_parent, aq_base
+from Products.ZCatalog.Catalog import LOG
+
+class _Container(object):
+    """
+    Stands in for the parent of a ZCatalog loaded in a background thread,
+    so that the catalog keeps its physical path and hence its cache id.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def getPhysicalPath(self):
+        return self.path
+
+def locate(catalog):
+    """
+    Returns: (db, oid, path) of the ZCatalog of catalog, which a background
+    thread may pass to call_catalog, or None if it is not stored yet.
+    """
+    zcatalog = aq_parent(catalog)
+    jar = getattr(aq_base(zcatalog), '_p_jar', None)
+    if jar is None:
+        return None
+    return (jar.db(), zcatalog._p_oid, zcatalog.getPhysicalPath())
+
+def call_catalog(location, func, *args):
+    """
+    Call func with the catalog at location, as returned by locate, and args
+    in a transaction of its own, which is committed, with a connection of
+    its own. Errors are logged.
+
+    Returns: True if the call succeeded
+    """
+    db, oid, path = location
+    connection = db.open()
+    try:
+        try:
+            zcatalog = connection.get(oid).__of__(_Container(path[:-1]))
+            func(zcatalog._catalog, *args)
+            # Writes the values cached by func
+            transaction.commit()
+            return True
+        except Exception:
+            LOG.exception("%s on %s failed" % (func.__name__, '/'.join(path)))
+            transaction.abort()
+            return False
+    finally:
+        connection.close()
+
+def _revalidate(catalog, args):
+    from Products.ZCatalog.Catalog import CatalogSearchArgumentsMap
+    catalog._revalidate(CatalogSearchArgumentsMap(None, args))
+
+class Revalidator(object):
+    """
+    Recomputes the results of queries from a background thread, with its
+    own database connection, after a stale result was served.
+
+    Pending queries are coalesced per key and bounded in number. Queries
+    which do not fit are dropped, since the next miss recomputes them.
+    """
+
+    def __init__(self, max_pending=1000):
+        self.max_pending = max_pending
+        self.pending = {}
+        self.condition = threading.Condition(threading.Lock())
+        self.thread = None
+
+    def schedule(self, key, catalog, args):
+        """
+        Recompute the result of args, a dictionary as returned by
+        query.snapshot, on catalog.
+        """
+        location = locate(catalog)
+        if location is None:
+            return False
+        self.condition.acquire()
+        try:
+            if (len(self.pending) >= self.max_pending) \
+                and not self.pending.has_key(key):
+                return False
+            self.pending[key] = (location, args)
+            self._start()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return True
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _start(self):
+        # Called with the condition held
+        if (self.thread is not None) and self.thread.isAlive():
+            return
+        self.thread = threading.Thread(target=self._run,
+                                       name='catalogcache-revalidator')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _take(self):
+        self.condition.acquire()
+        try:
+            while not self.pending:
+                self.condition.wait()
+            return self.pending.popitem()[1]
+        finally:
+            self.condition.release()
+
+    def _run(self):
+        while 1:
+            location, args = self._take()
+            call_catalog(location, _revalidate, args)
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+
+from collective.catalogcache import patch
+from collective.catalogcache.backends import MMapBackend
+
+class MemcachedAdapterTests(unittest.TestCase):
+    """
+    Writes of a transaction are buffered until it commits
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = MMapBackend(os.path.join(self.directory, 'cache'),
+                                   size=64*1024, bucket_size=16*1024)
+        self._writer = patch._writer
+        # Write from the committing thread
+        patch._writer = None
+        transaction.begin()
+
+    def tearDown(self):
+        transaction.abort()
+        patch._writer = self._writer
+        self.backend.map.close()
+        os.close(self.backend.fd)
+        shutil.rmtree(self.directory)
+
+    def _adapter(self):
+        return patch.MemcachedAdapter(self.backend, 60)
+
+    def test_commit(self):
+        self.backend.set_multi({'/old': 'x', '/counter': 5})
+        adapter = self._adapter()
+        adapter.set_multi({'a': 1, 'b': 2}, key_prefix='/')
+        adapter.delete_multi(['/b', '/old'])
+        adapter.incr('/counter')
+        adapter.incr('/counter')
+        self.assertEqual(adapter.get('/a', None), 1)
+        self.assertEqual(adapter.get_multi(['a', 'b', 'old'], '/'), {'a': 1})
+        self.failUnless(adapter.incr_pending(['/counter']))
+        # Nothing is written before the transaction commits
+        self.assertEqual(self.backend.get('/a'), None)
+        self.assertEqual(self.backend.get('/old'), 'x')
+        transaction.commit()
+
+        self.assertEqual(self.backend.get('/a'), 1)
+        self.assertEqual(self.backend.get('/b'), None)
+        self.assertEqual(self.backend.get('/old'), None)
+        # Increments of a transaction are coalesced
+        self.assertEqual(self.backend.get('/counter'), 6)
+
+    def test_set_after_delete(self):
+        self.backend.set_multi({'/a': 'old'})
+        adapter = self._adapter()
+        adapter.delete_multi(['/a'])
+        adapter.set_multi({'a': 'new'}, key_prefix='/')
+        self.assertEqual(adapter.get('/a', None), 'new')
+        transaction.commit()
+        self.assertEqual(self.backend.get('/a'), 'new')
+
+    def test_abort(self):
+        self.backend.set_multi({'/a': 'old', '/counter': 5})
+        adapter = self._adapter()
+        adapter.set_multi({'a': 'new'}, key_prefix='/')
+        adapter.delete_multi(['/counter'])
+        adapter.incr('/counter')
+        transaction.abort()
+
+        self.assertEqual(self.backend.get('/a'), 'old')
+        self.assertEqual(self.backend.get('/counter'), 5)
+        # The next transaction starts with no pending writes
+        adapter = self._adapter()
+        self.assertEqual(adapter.get('/a', None), 'old')
+        self.failIf(adapter.incr_pending(['/counter']))
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(MemcachedAdapterTests),
+        ))
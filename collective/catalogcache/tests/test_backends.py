@@ -0,0 +1,217 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from collective.catalogcache.backends import MMapBackend, SLOT_DELETED, \
+    HashRing, CircuitBreaker
+
+class MMapBackendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # One bucket of 64 slots
+        self.backend = MMapBackend(os.path.join(self.directory, 'cache'),
+                                   size=4096, bucket_size=4096)
+
+    def tearDown(self):
+        self.backend.map.close()
+        os.close(self.backend.fd)
+        shutil.rmtree(self.directory)
+
+    def _keys(self, slot, count):
+        """
+        Return count keys which are first probed at slot
+        """
+        backend = self.backend
+        keys = []
+        i = 0
+        while len(keys) < count:
+            key = 'key%d' % i
+            if backend._locate(key)[1] % backend.slots == slot:
+                keys.append(key)
+            i += 1
+        return keys
+
+    def _slot_of(self, key):
+        bucket, h = self.backend._locate(key)
+        return self.backend._find(bucket, key, h)[0]
+
+    def test_get_set_delete(self):
+        backend = self.backend
+        self.assertEqual(backend.get('/a'), None)
+        self.assertEqual(backend.set_multi({'a': 'x', 'b': [1, 2]},
+                                           key_prefix='/'), [])
+        self.assertEqual(backend.get('/a'), 'x')
+        self.assertEqual(backend.get_multi(['a', 'b', 'c'], key_prefix='/'),
+                         {'a': 'x', 'b': [1, 2]})
+        backend.set_multi({'/a': 'y'})
+        self.assertEqual(backend.get('/a'), 'y')
+        self.assertEqual(backend.delete_multi(['/a', '/c']), 1)
+        self.assertEqual(backend.get('/a'), None)
+        self.assertEqual(backend.get('/b'), [1, 2])
+
+    def test_add_and_incr(self):
+        backend = self.backend
+        self.assertEqual(backend.incr('counter'), None)
+        self.assertEqual(backend.add('counter', 5), 1)
+        self.assertEqual(backend.add('counter', 7), 0)
+        self.assertEqual(backend.incr('counter'), 6)
+        self.assertEqual(backend.incr('counter', 10), 16)
+        self.assertEqual(backend.get('counter'), 16)
+        backend.set_multi({'text': 'abc'})
+        self.assertEqual(backend.incr('text'), None)
+
+    def test_expiry(self):
+        backend = self.backend
+        bucket, h = backend._locate('old')
+        # Expired a while ago
+        backend._lock(bucket)
+        try:
+            backend._store(bucket, 'old', h, 1, 0, 'x')
+        finally:
+            backend._unlock(bucket)
+        self.assertEqual(backend.get('old'), None)
+        self.assertEqual(backend.add('old', 'y'), 1)
+        self.assertEqual(backend.get('old'), 'y')
+
+    def test_slot_collisions(self):
+        backend = self.backend
+        keys = self._keys(10, 3)
+        for k in keys:
+            backend.set_multi({k: k.upper()})
+        self.assertEqual([self._slot_of(k) for k in keys], [10, 11, 12])
+        for k in keys:
+            self.assertEqual(backend.get(k), k.upper())
+
+        # Deleting a key leaves a tombstone, so the keys probed after it
+        # are still found
+        backend.delete_multi([keys[1]])
+        self.assertEqual(backend._slot(0, 11)[1], SLOT_DELETED)
+        self.assertEqual(backend.get(keys[1]), None)
+        self.assertEqual(backend.get(keys[2]), keys[2].upper())
+
+        # The tombstone is reused
+        backend.set_multi({keys[1]: 'again'})
+        self.assertEqual(self._slot_of(keys[1]), 11)
+        self.assertEqual(backend.get(keys[1]), 'again')
+
+    def test_probing_wraps_around(self):
+        backend = self.backend
+        last = backend.slots - 1
+        keys = self._keys(last, 3)
+        for k in keys:
+            backend.set_multi({k: k})
+        self.assertEqual([self._slot_of(k) for k in keys], [last, 0, 1])
+        for k in keys:
+            self.assertEqual(backend.get(k), k)
+        backend.delete_multi([keys[0]])
+        self.assertEqual(backend.get(keys[2]), keys[2])
+
+    def test_compaction_evicts_oldest(self):
+        backend = self.backend
+        value = 'v' * 200
+        for i in range(100):
+            backend.set_multi({'key%d' % i: value})
+        used, filled = backend._header(0)
+        self.failUnless(used <= backend.capacity)
+        self.failUnless(filled <= backend.max_filled)
+        self.assertEqual(backend.get('key99'), value)
+        self.assertEqual(backend.get('key0'), None)
+        found = [i for i in range(100) \
+                 if backend.get('key%d' % i) is not None]
+        # The newest entries survive
+        self.assertEqual(found, range(100 - len(found), 100))
+
+    def test_shared_between_instances(self):
+        self.backend.set_multi({'shared': 'x'})
+        other = MMapBackend(self.backend.path, size=4096, bucket_size=4096)
+        try:
+            self.assertEqual(other.get('shared'), 'x')
+        finally:
+            other.map.close()
+            os.close(other.fd)
+
+class HashRingTests(unittest.TestCase):
+
+    servers = ['10.0.0.1:11211', '10.0.0.2:11211', '10.0.0.3:11211',
+               '10.0.0.4:11211']
+    keys = ['/plone/portal_catalog%d' % i for i in range(20000)]
+
+    def test_distribution(self):
+        ring = HashRing(self.servers)
+        counts = dict.fromkeys(self.servers, 0)
+        for key in self.keys:
+            counts[ring.get(key)] += 1
+        expected = len(self.keys) / len(self.servers)
+        for server, count in counts.items():
+            self.failUnless(abs(count - expected) < 0.2 * expected,
+                            "%s holds %s keys" % (server, count))
+
+    def test_removing_a_server_only_moves_its_keys(self):
+        ring = HashRing(self.servers)
+        smaller = HashRing(self.servers[:-1])
+        removed = self.servers[-1]
+        moved = 0
+        for key in self.keys:
+            before = ring.get(key)
+            after = smaller.get(key)
+            if before == removed:
+                moved += 1
+                self.assertNotEqual(after, removed)
+            else:
+                self.assertEqual(after, before)
+        self.failUnless(moved)
+
+    def test_single_server(self):
+        ring = HashRing(self.servers[:1])
+        for key in self.keys[:100]:
+            self.assertEqual(ring.get(key), self.servers[0])
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def test_opens_after_threshold_failures(self):
+        breaker = CircuitBreaker(threshold=3, retry_interval=60)
+        self.assertEqual(breaker.allow(), breaker.CLOSED)
+        breaker.failure()
+        breaker.failure()
+        self.assertEqual(breaker.allow(), breaker.CLOSED)
+        breaker.success()
+        # Only consecutive failures count
+        breaker.failure()
+        breaker.failure()
+        self.assertEqual(breaker.allow(), breaker.CLOSED)
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertEqual(breaker.allow(), None)
+
+    def test_probe_closes(self):
+        breaker = CircuitBreaker(threshold=1, retry_interval=60)
+        breaker.failure()
+        self.assertEqual(breaker.allow(), None)
+        breaker.opened -= 60
+        # One caller probes, the others keep away
+        self.assertEqual(breaker.allow(), breaker.PROBING)
+        self.assertEqual(breaker.allow(), None)
+        breaker.success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(breaker.allow(), breaker.CLOSED)
+
+    def test_failed_probe_opens_again(self):
+        breaker = CircuitBreaker(threshold=5, retry_interval=60)
+        for i in range(5):
+            breaker.failure()
+        breaker.opened -= 60
+        self.assertEqual(breaker.allow(), breaker.PROBING)
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertEqual(breaker.allow(), None)
+        breaker.opened -= 60
+        self.assertEqual(breaker.allow(), breaker.PROBING)
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(MMapBackendTests),
+        unittest.makeSuite(HashRingTests),
+        unittest.makeSuite(CircuitBreakerTests),
+        ))
@@ -0,0 +1,75 @@
+import unittest
+
+from BTrees.IIBTree import IISet, IIBucket
+
+from collective.catalogcache import codec
+
+class CodecTests(unittest.TestCase):
+
+    def setUp(self):
+        self._threshold = codec.COMPRESS_THRESHOLD
+
+    def tearDown(self):
+        codec.COMPRESS_THRESHOLD = self._threshold
+
+    def _round_trip(self, rs, stamp=None):
+        return codec.decode(codec.encode(rs, stamp))
+
+    def test_empty(self):
+        stamp, rs = self._round_trip(IISet())
+        self.assertEqual(stamp, None)
+        self.failUnless(isinstance(rs, IISet))
+        self.assertEqual(list(rs), [])
+        self.assertEqual(self._round_trip(IIBucket())[1].items(), [])
+        self.assertEqual(self._round_trip([])[1], [])
+
+    def test_set(self):
+        stamp, rs = self._round_trip(IISet([3, 1, -7, 2**31 - 1]), 42)
+        self.assertEqual(stamp, 42)
+        self.failUnless(isinstance(rs, IISet))
+        self.assertEqual(list(rs), [-7, 1, 3, 2**31 - 1])
+
+    def test_bucket(self):
+        bucket = IIBucket([(1, 10), (5, 0), (9, -3)])
+        stamp, rs = self._round_trip(bucket, 2**40)
+        self.assertEqual(stamp, 2**40)
+        self.failUnless(isinstance(rs, IIBucket))
+        self.assertEqual(rs.items(), [(1, 10), (5, 0), (9, -3)])
+
+    def test_list_keeps_order(self):
+        stamp, rs = self._round_trip([5, 3, 9, 3])
+        self.assertEqual(rs, [5, 3, 9, 3])
+
+    def test_compressed(self):
+        codec.COMPRESS_THRESHOLD = 16
+        rids = range(1000)
+        data = codec.encode(IISet(rids))
+        self.failUnless(len(data) < 4 * len(rids))
+        self.assertEqual(list(codec.decode(data)[1]), rids)
+        codec.COMPRESS_THRESHOLD = 0
+        self.assertEqual(len(codec.encode(IISet(rids))),
+                         codec.HEADER_SIZE + 4 * len(rids))
+
+    def test_unencodable(self):
+        # Result sets of other types may hold values which do not fit
+        self.assertRaises((TypeError, ValueError, OverflowError),
+                          codec.encode, {1: 2**40})
+        self.assertRaises((TypeError, ValueError, OverflowError),
+                          codec.encode, {1: 0.5})
+        self.assertRaises((TypeError, ValueError, OverflowError),
+                          codec.encode, [2**40])
+
+    def test_corrupt(self):
+        data = codec.encode(IISet([1, 2, 3]))
+        self.assertRaises(codec.CodecError, codec.decode, None)
+        self.assertRaises(codec.CodecError, codec.decode, '')
+        self.assertRaises(codec.CodecError, codec.decode, '\x09' + data[1:])
+        self.assertRaises(codec.CodecError, codec.decode, data[:-1])
+        self.assertRaises(codec.CodecError, codec.decode,
+                          data[:1] + chr(codec.KIND_SET | codec.COMPRESSED)
+                          + data[2:])
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(CodecTests),
+        ))
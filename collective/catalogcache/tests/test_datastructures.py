@@ -0,0 +1,138 @@
+import sys
+import unittest
+from md5 import md5
+
+from collective.catalogcache import patch
+from collective.catalogcache.datastructures import TTLMap, Counters, \
+    WriteBuffer
+
+NAMES = ('hits', 'misses', 'tracked', 'untracked', 'uncached')
+
+class SoakTests(unittest.TestCase):
+    """
+    Process wide state must stay bounded however many distinct queries a
+    long running process sees
+    """
+
+    def tearDown(self):
+        patch.memcache_insertion_timestamps.clear()
+        patch._cache_misses.clear()
+
+    def _assertBounded(self, ttlmap):
+        self.failUnless(len(ttlmap) <= ttlmap.max_entries)
+        self.failUnless(len(ttlmap.order) <= 2 * ttlmap.max_entries + 1)
+        getsizeof = getattr(sys, 'getsizeof', None)
+        if getsizeof is not None:
+            limit = getsizeof(dict.fromkeys(range(4 * ttlmap.max_entries)))
+            self.failUnless(getsizeof(ttlmap.mapping) <= limit)
+
+    def test_throttle_and_miss_state(self):
+        limit = patch.STATE_MAX_ENTRIES
+        insertions = patch.memcache_insertion_timestamps
+        misses = patch._cache_misses
+        for i in xrange(5 * limit):
+            key = md5(str(i)).hexdigest()
+            self.failUnless(insertions.set_if_absent(key, i))
+            misses.increment(key)
+            if not i % 1000:
+                self._assertBounded(insertions)
+                self._assertBounded(misses)
+        self._assertBounded(insertions)
+        self._assertBounded(misses)
+        # The most recent keys are kept
+        self.assertEqual(insertions.get(key), i)
+        self.assertEqual(misses.get(key), 1)
+
+    def test_hot_keys_among_distinct_keys(self):
+        # Keys which are set again leave superseded records in the order
+        ttlmap = TTLMap(3600, 1000)
+        for i in xrange(100000):
+            ttlmap.set('hot%d' % (i % 10), i)
+            ttlmap.increment('cold%d' % i)
+            if not i % 1000:
+                self._assertBounded(ttlmap)
+        self._assertBounded(ttlmap)
+        for n in range(10):
+            self.failIfEqual(ttlmap.get('hot%d' % n), None)
+
+    def test_expired_entries_are_purged(self):
+        ttlmap = TTLMap(0, 1000)
+        for i in xrange(10000):
+            ttlmap.set(i, i)
+            self.failUnless(len(ttlmap) <= 1)
+            self.failUnless(len(ttlmap.order) <= 1)
+        self.assertEqual(ttlmap.get(9999), None)
+
+    def test_counters(self):
+        counters = Counters(NAMES)
+        catalogs = ['/plone%d/portal_catalog' % n for n in range(3)]
+        for i in xrange(100000):
+            counters.incr(catalogs[i % 3], NAMES[i % len(NAMES)])
+        self.assertEqual(len(counters.keys()), 3)
+        for cache_id in catalogs:
+            group = counters.group(cache_id)
+            self.assertEqual(len(group), len(NAMES))
+        self.assertEqual(sum([sum(counters.group(cache_id).values()) \
+                              for cache_id in catalogs]), 100000)
+
+class WriteBufferTests(unittest.TestCase):
+
+    def test_unwritten(self):
+        buffer = WriteBuffer()
+        marker = []
+        self.failUnless(buffer.get('a', marker, None) is marker)
+        self.failIf(buffer.is_deleted('a'))
+        self.assertEqual(len(buffer), 0)
+
+    def test_set_after_delete(self):
+        buffer = WriteBuffer()
+        buffer.delete('a')
+        buffer.set('a', 1)
+        self.assertEqual(buffer.get('a', None, 'deleted'), 1)
+        # The old value is still deleted before the new one is written
+        self.failUnless(buffer.is_deleted('a'))
+        self.assertEqual(buffer.sets, {'a': 1})
+
+    def test_delete_after_set(self):
+        buffer = WriteBuffer()
+        buffer.set('a', 1)
+        buffer.set('b', 2)
+        buffer.delete('a')
+        self.assertEqual(buffer.get('a', None, 'deleted'), 'deleted')
+        self.assertEqual(buffer.sets, {'b': 2})
+        self.assertEqual(buffer.deletes, set(['a']))
+
+    def test_repeated_writes(self):
+        buffer = WriteBuffer()
+        for i in range(3):
+            buffer.set('a', i)
+            buffer.delete('b')
+        self.assertEqual(buffer.get('a'), 2)
+        self.assertEqual(len(buffer), 2)
+
+    def test_incr_coalescing(self):
+        buffer = WriteBuffer()
+        for i in range(1000):
+            buffer.incr('/catalog_generation_removal')
+        buffer.incr('/catalog_generation_path')
+        self.assertEqual(len(buffer.incrs), 2)
+        self.failUnless(buffer.incr_pending(['/other',
+                                             '/catalog_generation_path']))
+        self.failIf(buffer.incr_pending(['/other']))
+
+    def test_clear(self):
+        buffer = WriteBuffer()
+        buffer.set('a', 1)
+        buffer.delete('b')
+        buffer.incr('c')
+        buffer.clear()
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.get('a'), None)
+        self.failIf(buffer.is_deleted('b'))
+        self.failIf(buffer.incr_pending(['c']))
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(SoakTests),
+        unittest.makeSuite(WriteBufferTests),
+        ))
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from BTrees.IOBTree import IOBTree
+
+from collective.catalogcache import patch
+from collective.catalogcache.backends import MMapBackend
+from collective.catalogcache.lazy import LazyBrains
+
+class Catalog(object):
+    """
+    Returns rids as brains, leaving out stale ones, and counts the rids it
+    was asked for
+    """
+
+    def __init__(self, stale=()):
+        self.stale = stale
+        self.fetched = 0
+
+    def __getitem__(self, rid):
+        raise AssertionError("Brains are materialized in batches")
+
+    def _get_brains(self, rids, token=None):
+        self.fetched += len(rids)
+        return [rid for rid in rids if rid not in self.stale]
+
+class LazyBrainsTests(unittest.TestCase):
+
+    def test_negative_index_materializes_the_tail(self):
+        catalog = Catalog()
+        brains = LazyBrains(catalog, range(100000), 100000, 50)
+        self.assertEqual(brains[-1], 99999)
+        self.assertEqual(brains[-120], 99880)
+        self.assertEqual(catalog.fetched, 150)
+
+    def test_stale_rids(self):
+        catalog = Catalog(stale=(1, 5, 97, 98))
+        brains = LazyBrains(catalog, range(100), 100, 10)
+        self.assertEqual(brains[-1], 99)
+        self.assertEqual(brains[-2], 96)
+        self.assertEqual(brains[1], 2)
+        self.assertEqual(brains[-95], 2)
+        self.assertEqual(len(brains), 96)
+        self.assertRaises(IndexError, brains.__getitem__, -97)
+        self.assertRaises(IndexError, brains.__getitem__, 96)
+
+    def test_positive_index_after_tail(self):
+        catalog = Catalog(stale=(3,))
+        brains = LazyBrains(catalog, range(30), 30, 10)
+        self.assertEqual(brains[-5], 25)
+        self.assertEqual([brains[i] for i in range(28)],
+                         [rid for rid in range(29) if rid != 3])
+        self.assertEqual(catalog.fetched, 30)
+
+class Brain(object):
+
+    def __init__(self, record):
+        self.record = record
+
+    def __of__(self, parent):
+        return self
+
+class PatchedCatalog(object):
+    """
+    The parts of a patched Catalog which build brains
+    """
+
+    _getMemcachedAdapter = patch._getMemcachedAdapter
+    _memcache_available = patch._memcache_available
+    _get_bulk_invalidation = patch._get_bulk_invalidation
+    _invalidate_cache = patch._invalidate_cache
+    _get_brains = patch._get_brains
+    _v_result_class = Brain
+    aq_parent = None
+
+    def __init__(self, rids):
+        self.data = IOBTree()
+        for rid in rids:
+            self.data[rid] = 'record%d' % rid
+
+    def getPhysicalPath(self):
+        return ('', 'plone', 'portal_catalog')
+
+class GetBrainsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = MMapBackend(os.path.join(self.directory, 'cache'),
+                                   size=64*1024, bucket_size=16*1024)
+        self._saved = (patch.mem_cache, patch.HAS_MEMCACHE, patch._writer)
+        patch.mem_cache = self.backend
+        patch.HAS_MEMCACHE = True
+        # Write from the committing thread
+        patch._writer = None
+        transaction.begin()
+
+    def tearDown(self):
+        transaction.abort()
+        patch.mem_cache, patch.HAS_MEMCACHE, patch._writer = self._saved
+        self.backend.map.close()
+        os.close(self.backend.fd)
+        shutil.rmtree(self.directory)
+
+    def test_stale_rids(self):
+        removal = '/plone/portal_catalog' + patch.REMOVAL_GENERATION_KEY
+        self.backend.set_multi({removal: 5,
+                                '/plone/portal_catalog3': 'rid map'})
+        catalog = PatchedCatalog([rid for rid in range(10) if rid % 3])
+        brains = catalog._get_brains(range(10))
+        self.assertEqual([brain.record for brain in brains],
+                         ['record%d' % rid for rid in range(10) if rid % 3])
+        # Invalidated when the transaction commits
+        self.assertEqual(self.backend.get(removal), 5)
+        self.assertEqual(self.backend.get('/plone/portal_catalog3'),
+                         'rid map')
+        transaction.commit()
+        # Once for all stale rids
+        self.assertEqual(self.backend.get(removal), 6)
+        self.assertEqual(self.backend.get('/plone/portal_catalog3'), None)
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(LazyBrainsTests),
+        unittest.makeSuite(GetBrainsTests),
+        ))
@@ -0,0 +1,204 @@
+import unittest
+from datetime import datetime, timedelta, tzinfo
+
+from DateTime import DateTime
+from Products.ZCatalog.Catalog import CatalogSearchArgumentsMap
+
+from collective.catalogcache import patch
+from collective.catalogcache import query
+
+class Index(object):
+
+    def __init__(self, meta_type):
+        self.meta_type = meta_type
+
+INDEXES = {
+    'effective': Index('DateIndex'),
+    'expires': Index('DateIndex'),
+    'created': Index('DateIndex'),
+    'effectiveRange': Index('DateRangeIndex'),
+    'portal_type': Index('FieldIndex'),
+    }
+
+# The start of an hour, and so of a minute
+START = 1700000000 - 1700000000 % 3600
+
+class UTC(tzinfo):
+
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return 'UTC'
+
+class Clock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+def normalize(**kw):
+    return query.normalize(CatalogSearchArgumentsMap({}, kw), INDEXES,
+                           patch._pin_time)
+
+class TimeBucketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._time_bucket = patch.TIME_BUCKET
+        self._time_buckets = patch.TIME_BUCKETS
+        patch.TIME_BUCKET = 60
+        patch.TIME_BUCKETS = {'created': 3600}
+
+    def tearDown(self):
+        patch.TIME_BUCKET = self._time_bucket
+        patch.TIME_BUCKETS = self._time_buckets
+
+class PinTimeTests(TimeBucketTestCase):
+
+    def test_same_bucket(self):
+        self.assertEqual(patch._pin_time(DateTime(START + 5), 'effective'),
+                         patch._pin_time(DateTime(START + 55), 'effective'))
+
+    def test_next_bucket(self):
+        self.assertNotEqual(
+            patch._pin_time(DateTime(START + 55), 'effective'),
+            patch._pin_time(DateTime(START + 65), 'effective'))
+
+    def test_naive_datetime(self):
+        self.assertEqual(
+            patch._pin_time(datetime.fromtimestamp(START + 5), 'effective'),
+            patch._pin_time(DateTime(START + 55), 'effective'))
+
+    def test_aware_datetime(self):
+        self.assertEqual(
+            patch._pin_time(datetime.fromtimestamp(START + 5, UTC()),
+                            'effective'),
+            patch._pin_time(DateTime(START + 55), 'effective'))
+
+    def test_bucket_per_index(self):
+        self.assertEqual(patch._pin_time(DateTime(START + 5), 'created'),
+                         patch._pin_time(DateTime(START + 3000), 'created'))
+        self.assertNotEqual(
+            patch._pin_time(DateTime(START + 3000), 'created'),
+            patch._pin_time(DateTime(START + 3605), 'created'))
+
+    def test_disabled(self):
+        patch.TIME_BUCKET = 0
+        patch.TIME_BUCKETS = {}
+        self.assertNotEqual(
+            patch._pin_time(DateTime(START + 5), 'effective'),
+            patch._pin_time(DateTime(START + 55), 'effective'))
+        self.assertEqual(patch._pin_time(DateTime(START + 5), 'effective'),
+                         patch._pin_time(DateTime(START + 5), 'effective'))
+
+    def test_other_values(self):
+        value = '2010/01/01'
+        self.failUnless(patch._pin_time(value, 'effective') is value)
+        value = START
+        self.failUnless(patch._pin_time(value, 'effective') is value)
+
+class NormalizeTests(TimeBucketTestCase):
+
+    def test_now_relative_queries_share_a_form(self):
+        self.assertEqual(
+            normalize(effective={'query': DateTime(START + 5),
+                                 'range': 'max'}),
+            normalize(effective={'query': DateTime(START + 55),
+                                 'range': 'max'}))
+
+    def test_range_of_times(self):
+        self.assertEqual(
+            normalize(expires={'query': [DateTime(START + 5),
+                                         DateTime(START + 86405)],
+                               'range': 'min:max'}),
+            normalize(expires={'query': [DateTime(START + 55),
+                                         DateTime(START + 86455)],
+                               'range': 'min:max'}))
+        self.assertNotEqual(
+            normalize(expires={'query': [DateTime(START + 5),
+                                         DateTime(START + 86405)],
+                               'range': 'min:max'}),
+            normalize(expires={'query': [DateTime(START + 5),
+                                         DateTime(START + 86465)],
+                               'range': 'min:max'}))
+
+    def test_date_range_index(self):
+        self.assertEqual(normalize(effectiveRange=DateTime(START + 5)),
+                         normalize(effectiveRange=DateTime(START + 55)))
+
+    def test_datetime_and_DateTime(self):
+        self.assertEqual(
+            normalize(effective={'query': datetime.fromtimestamp(START + 5),
+                                 'range': 'max'}),
+            normalize(effective={'query': DateTime(START + 55),
+                                 'range': 'max'}))
+
+    def test_next_bucket(self):
+        self.assertNotEqual(
+            normalize(effective={'query': DateTime(START + 55),
+                                 'range': 'max'}),
+            normalize(effective={'query': DateTime(START + 65),
+                                 'range': 'max'}))
+
+    def test_bucket_per_index(self):
+        self.assertEqual(
+            normalize(created={'query': DateTime(START + 5), 'range': 'min'}),
+            normalize(created={'query': DateTime(START + 3000),
+                               'range': 'min'}))
+        self.assertNotEqual(
+            normalize(effective={'query': DateTime(START + 5),
+                                 'range': 'min'}),
+            normalize(effective={'query': DateTime(START + 3000),
+                                 'range': 'min'}))
+
+    def test_other_arguments_are_kept(self):
+        self.assertNotEqual(
+            normalize(portal_type='Document',
+                      effective={'query': DateTime(START + 5),
+                                 'range': 'max'}),
+            normalize(portal_type='News Item',
+                      effective={'query': DateTime(START + 55),
+                                 'range': 'max'}))
+
+    def test_stripped_times(self):
+        # Queries are recorded for warming up without their times relative
+        # to now, while queries on fixed dates are recorded apart
+        def stripped(value):
+            return query.normalize(CatalogSearchArgumentsMap({}, {
+                'effective': {'query': value, 'range': 'max'}}),
+                INDEXES, patch._strip_time)
+
+        saved = patch.time
+        try:
+            patch.time = Clock(START + 30)
+            today = stripped(DateTime(START + 10))
+            self.failUnless('time:now' in today)
+            self.assertEqual(today, stripped(DateTime(START + 50)))
+            fixed = stripped(DateTime(START - 86400))
+            self.failIf('time:now' in fixed)
+            self.assertNotEqual(fixed, today)
+            self.assertNotEqual(fixed, stripped(DateTime(START - 2 * 86400)))
+
+            patch.time = Clock(START + 86430)
+            self.assertEqual(stripped(DateTime(START + 86410)), today)
+            self.assertEqual(stripped(DateTime(START - 86400)), fixed)
+        finally:
+            patch.time = saved
+
+    def test_query_is_not_modified(self):
+        now = DateTime(START + 5)
+        args = {'query': now, 'range': 'max'}
+        normalize(effective=args)
+        self.assertEqual(args, {'query': now, 'range': 'max'})
+        self.failUnless(args['query'] is now)
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(PinTimeTests),
+        unittest.makeSuite(NormalizeTests),
+        ))
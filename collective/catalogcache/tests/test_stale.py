@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import transaction
+from BTrees.IIBTree import IISet
+from Products.ZCatalog.Catalog import CatalogSearchArgumentsMap
+
+from collective.catalogcache import patch
+from collective.catalogcache.backends import MMapBackend
+
+START = 1700000000
+
+class Clock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+class Revalidator(object):
+
+    def __init__(self):
+        self.scheduled = []
+
+    def schedule(self, key, catalog, args):
+        self.scheduled.append(key)
+
+class Catalog(object):
+    """
+    The parts of a patched Catalog which serve stale results
+    """
+
+    _getMemcachedAdapter = patch._getMemcachedAdapter
+    _get_cache_setting = patch._get_cache_setting
+    _get_latest_key = patch._get_latest_key
+    _set_stale_result = patch._set_stale_result
+    _refresh_stale_result = patch._refresh_stale_result
+    _get_stale_result = patch._get_stale_result
+    _without_removed = patch._without_removed
+
+    def __init__(self, rids):
+        self.data = dict.fromkeys(rids)
+        self.indexes = {'portal_type': None}
+        self._v_canonical = 'portal_type=[s4:News]'
+
+    def getPhysicalPath(self):
+        return ('', 'plone', 'portal_catalog')
+
+class StaleResultTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = MMapBackend(os.path.join(self.directory, 'cache'),
+                                   size=64*1024, bucket_size=16*1024)
+        self.clock = Clock(START)
+        self.revalidator = Revalidator()
+        self._saved = (patch.mem_cache, patch.time, patch._revalidator,
+                       patch.REVALIDATE_MAX_AGE)
+        patch.mem_cache = self.backend
+        patch.time = self.clock
+        patch._revalidator = self.revalidator
+        patch.REVALIDATE_MAX_AGE = 10
+        patch._revalidations.clear()
+        patch._stale_refreshes.clear()
+        transaction.begin()
+        self.catalog = Catalog(range(5))
+        self.request = CatalogSearchArgumentsMap({}, {'portal_type': 'News'})
+
+    def tearDown(self):
+        transaction.abort()
+        patch.mem_cache, patch.time, patch._revalidator, \
+            patch.REVALIDATE_MAX_AGE = self._saved
+        patch._revalidations.clear()
+        patch._stale_refreshes.clear()
+        self.backend.map.close()
+        os.close(self.backend.fd)
+        shutil.rmtree(self.directory)
+
+    def _stale(self):
+        return self.catalog._get_stale_result(self.request, None)
+
+    def test_recently_computed(self):
+        self.catalog._set_stale_result(IISet([1, 2, 3]))
+        self.clock.now += 5
+        self.assertEqual(list(self._stale()), [1, 2, 3])
+        self.assertEqual(len(self.revalidator.scheduled), 1)
+        # Serving it again does not recompute it again
+        self._stale()
+        self.assertEqual(len(self.revalidator.scheduled), 1)
+
+    def test_too_old(self):
+        self.catalog._set_stale_result(IISet([1, 2, 3]))
+        self.clock.now += 11
+        self.assertEqual(self._stale(), None)
+        self.assertEqual(self.revalidator.scheduled, [])
+
+    def test_cached_long_then_invalidated(self):
+        # Computed once and then found in the cache for an hour
+        self.catalog._set_stale_result(IISet([1, 2, 3]))
+        for i in range(720):
+            self.clock.now += 5
+            self.catalog._refresh_stale_result(IISet([1, 2, 3]))
+            patch._stale_refreshes.clear()
+        # Invalidated now, ie. the next search misses the cache
+        self.clock.now += 3
+        del self.catalog.data[2]
+        self.assertEqual(list(self._stale()), [1, 3])
+        self.clock.now += 10
+        self.assertEqual(self._stale(), None)
+
+    def test_refreshes_are_throttled(self):
+        self.catalog._set_stale_result(IISet([1, 2, 3]))
+        self.clock.now += 8
+        self.catalog._refresh_stale_result(IISet([1, 2, 3]))
+        self.clock.now += 8
+        # Within REVALIDATE_MAX_AGE / 2 of the last refresh
+        self.catalog._refresh_stale_result(IISet([1, 2, 3]))
+        self.clock.now += 5
+        self.assertEqual(self._stale(), None)
+
+    def test_unencodable_result(self):
+        self.catalog._set_stale_result([2**40])
+        self.assertEqual(self._stale(), None)
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(StaleResultTests),
+        ))
@@ -0,0 +1,122 @@
+import unittest
+import marshal
+from cPickle import dumps
+from datetime import datetime, timedelta, tzinfo
+
+from DateTime import DateTime
+
+from collective.catalogcache import warmup
+from collective.catalogcache.datastructures import SpaceSaving
+
+NOW = 1700000000
+
+class UTC(tzinfo):
+
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return 'UTC'
+
+class Record(object):
+    """
+    Stands in for a ZPublisher record
+    """
+
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+    def keys(self):
+        return self.__dict__.keys()
+
+def is_now(value, name):
+    # Times within a minute of NOW
+    return abs(warmup.query.time_seconds(value) - NOW) < 60
+
+def round_trip(args, now):
+    # As stored in and read from the cache
+    data = marshal.dumps(warmup.relative(args, is_now, NOW))
+    return warmup.absolute(marshal.loads(data), now)
+
+class RelativeTimeTests(unittest.TestCase):
+
+    def test_DateTime(self):
+        args = round_trip({'effective': {'query': DateTime(NOW - 30),
+                                         'range': 'max'}}, NOW + 3600)
+        self.assertEqual(args['effective']['range'], 'max')
+        self.failUnless(isinstance(args['effective']['query'], DateTime))
+        self.assertEqual(args['effective']['query'].timeTime(), NOW + 3570)
+
+    def test_datetime(self):
+        args = round_trip({'created': [datetime.fromtimestamp(NOW - 30),
+                                       datetime.fromtimestamp(NOW + 30)]},
+                          NOW + 3600)
+        self.assertEqual(args['created'],
+                         [datetime.fromtimestamp(NOW + 3570),
+                          datetime.fromtimestamp(NOW + 3630)])
+
+    def test_aware_datetime(self):
+        value = datetime.fromtimestamp(NOW - 30, UTC())
+        args = round_trip({'created': value}, NOW + 3600)
+        self.assertEqual(args['created'], value + timedelta(seconds=3600))
+        self.failIf(args['created'].tzinfo is None)
+
+    def test_fixed_times_are_kept(self):
+        args = round_trip({
+            'effective': {'query': [DateTime(NOW - 30), DateTime('2010/01/01')],
+                          'range': 'min:max'},
+            'created': datetime(2010, 1, 1, 12, 30)}, NOW + 3600)
+        self.assertEqual(args['effective']['query'][0].timeTime(),
+                         NOW + 3570)
+        self.assertEqual(args['effective']['query'][1],
+                         DateTime('2010/01/01'))
+        self.assertEqual(args['created'], datetime(2010, 1, 1, 12, 30))
+
+    def test_other_values(self):
+        args = {'portal_type': ('Document', 'News Item'),
+                'review_state': 'published', 'sort_limit': 10,
+                'Title': u'caf\xe9', 'getObjPositionInParent': 1.5,
+                'is_folderish': True, 'Subject': ['a', 'b']}
+        self.assertEqual(round_trip(args, NOW), args)
+
+    def test_records_become_dictionaries(self):
+        args = round_trip({'path': Record(query='/plone', depth=1)}, NOW)
+        self.assertEqual(args, {'path': {'query': '/plone', 'depth': 1}})
+
+    def test_other_types(self):
+        self.assertRaises(ValueError, warmup.relative,
+                          {'getObject': object()}, is_now, NOW)
+
+class StoreTests(unittest.TestCase):
+
+    def test_dump_and_restore(self):
+        record = SpaceSaving(10)
+        args = warmup.relative({'effective': DateTime(NOW)}, is_now, NOW)
+        for i in range(3):
+            record.add('effective=time:now')
+        record.set_value('effective=time:now', args)
+        record.add('portal_type=[s4:News]')
+
+        restored = SpaceSaving(10)
+        warmup.restore(restored, warmup.dump(record))
+        # Queries without arguments are not stored
+        self.assertEqual(restored.top(), [('effective=time:now', 3, args)])
+
+    def test_other_data_is_ignored(self):
+        record = SpaceSaving(10)
+        warmup.restore(record, dumps([('portal_type=[s4:News]', 3,
+                                       dumps({'portal_type': 'News'}))]))
+        warmup.restore(record, 'garbage')
+        warmup.restore(record, warmup.RECORD_FORMAT + 'garbage')
+        warmup.restore(record, warmup.RECORD_FORMAT
+                       + marshal.dumps([('a', 1, 'not arguments')]))
+        self.assertEqual(record.top(), [])
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(RelativeTimeTests),
+        unittest.makeSuite(StoreTests),
+        ))
@@ -0,0 +1,109 @@
+import unittest
+
+from collective.catalogcache.writer import WriteBehind
+
+class Writer(WriteBehind):
+    """
+    Writes only when told to and records what it wrote and deleted
+    """
+
+    def __init__(self, **kw):
+        self.written = {}
+        self.deleted = []
+        # Called in the middle of a write
+        self.during_write = None
+        WriteBehind.__init__(self, self._record, delete=self.deleted.extend,
+                             **kw)
+
+    def _start(self):
+        pass
+
+    def _record(self, chunk):
+        if self.during_write is not None:
+            self.during_write()
+        self.written.update(chunk)
+
+class WriteBehindTests(unittest.TestCase):
+
+    def test_coalesces_per_key(self):
+        writer = Writer()
+        writer.enqueue({'a': 1, 'b': 2})
+        writer.enqueue({'a': 3})
+        self.assertEqual(len(writer), 2)
+        writer.flush()
+        self.assertEqual(writer.written, {'a': 3, 'b': 2})
+        self.assertEqual(len(writer), 0)
+
+    def test_chunks(self):
+        writer = Writer(chunk_size=3)
+        writer.enqueue(dict([(str(i), i) for i in range(10)]))
+        chunk, sequence = writer._take(block=False)
+        self.assertEqual(len(chunk), 3)
+        writer._write(chunk, sequence)
+        writer.flush()
+        self.assertEqual(len(writer.written), 10)
+        self.assertEqual(writer.writing, 0)
+
+    def test_full_queue_drops(self):
+        writer = Writer(max_keys=2)
+        self.assertEqual(writer.enqueue({'a': 1, 'b': 2}), 0)
+        self.assertEqual(writer.enqueue({'a': 3, 'c': 4}), 1)
+        self.assertEqual(writer.dropped, 1)
+        writer.flush()
+        self.assertEqual(writer.written, {'a': 3, 'b': 2})
+
+    def test_discard_pending(self):
+        writer = Writer()
+        writer.enqueue({'a': 1, 'b': 2})
+        writer.discard(['a', 'c'])
+        writer.flush()
+        self.assertEqual(writer.written, {'b': 2})
+        self.assertEqual(writer.deleted, [])
+
+    def test_discard_after_take(self):
+        writer = Writer()
+        writer.enqueue({'a': 1, 'b': 2})
+        chunk, sequence = writer._take(block=False)
+        # A transaction deletes a while the chunk is on its way
+        writer.discard(['a'])
+        writer._write(chunk, sequence)
+        self.assertEqual(writer.written, {'b': 2})
+        self.assertEqual(writer.deleted, [])
+        self.assertEqual(writer.discarded, {})
+
+    def test_discard_during_write(self):
+        writer = Writer()
+        writer.enqueue({'a': 1, 'b': 2})
+        writer.during_write = lambda: writer.discard(['a'])
+        writer.flush()
+        # The delete of a may have reached the backend before the write
+        self.assertEqual(writer.deleted, ['a'])
+        self.assertEqual(writer.discarded, {})
+
+    def test_set_after_discard(self):
+        writer = Writer()
+        writer.enqueue({'a': 1})
+        chunk, sequence = writer._take(block=False)
+        writer.discard(['a'])
+        # A later transaction sets a again
+        writer.enqueue({'a': 2})
+        writer._write(chunk, sequence)
+        self.assertEqual(writer.written, {})
+        writer.flush()
+        self.assertEqual(writer.written, {'a': 2})
+        self.assertEqual(writer.deleted, [])
+
+    def test_failed_write(self):
+        writer = Writer()
+        def fail():
+            raise IOError("Connection refused")
+        writer.during_write = fail
+        writer.enqueue({'a': 1})
+        writer.flush()
+        self.assertEqual(writer.written, {})
+        self.assertEqual(writer.writing, 0)
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(WriteBehindTests),
+        ))
@@ -0,0 +1,225 @@
+"""
+Warming the cache with the most frequent queries of a catalog.
+
+The most frequent cacheable queries of each catalog are recorded per
+process in a SpaceSaving record, keyed by their canonical form with times
+relative to now replaced by a placeholder, together with their arguments
+as returned by query.snapshot in a form marshal can store. Times relative
+to now are kept as offsets from when the query was recorded and are
+shifted to the time of replaying, so that queries on eg. effective and
+expires warm current keys. Other times are kept as they are. The record is
+stored in the cache under a key which does not depend on the generations,
+so it survives restarts and clearing the cache of the catalog. warm_up
+replays recorded queries through Catalog.searchResults in worker threads,
+each with its own database connection.
+"""
+
+import types
+import marshal
+import threading
+import time
+from datetime import datetime, timedelta, tzinfo
+
+from DateTime import DateTime
+from Products.ZCatalog.Catalog import LOG
+
+from collective.catalogcache.datastructures import SpaceSaving
+from collective.catalogcache import query
+from collective.catalogcache.revalidate import locate, call_catalog
+
+_records = {}
+_lock = threading.Lock()
+
+def get_record(cache_id, capacity):
+    """
+    Returns: (record, created), the record of the queries of cache_id and
+    whether it was created by this call, in which case it should be
+    restored.
+    """
+    record = _records.get(cache_id)
+    if record is not None:
+        return record, False
+    _lock.acquire()
+    try:
+        record = _records.get(cache_id)
+        if record is not None:
+            return record, False
+        record = _records[cache_id] = SpaceSaving(capacity)
+        return record, True
+    finally:
+        _lock.release()
+
+# A time in stored query arguments is (TIME_TAG, kind, seconds, relative),
+# where seconds are an offset from now if relative is true
+TIME_TAG = '__catalogcache_time__'
+DATETIME_TIME = 'DateTime'
+NAIVE_TIME = 'datetime'
+AWARE_TIME = 'datetime-utc'
+# Marks stored records, so that values of other formats are not unmarshaled
+RECORD_FORMAT = 'catalogcache-queries-1:'
+PLAIN_TYPES = (types.StringType, types.UnicodeType, types.IntType,
+               types.LongType, types.FloatType, types.BooleanType,
+               types.NoneType)
+
+class UTC(tzinfo):
+
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return 'UTC'
+
+_utc = UTC()
+
+def relative(args, is_now, now=None):
+    """
+    Return query arguments args, a dictionary as returned by
+    query.snapshot, in a form which marshal can store. Times for which
+    is_now(value, name) is true, where name is the argument they belong
+    to, are kept relative to now. Raises ValueError for values of other
+    types.
+    """
+    if now is None:
+        now = time.time()
+    result = {}
+    for name, value in args.items():
+        result[name] = _plain(value, name, is_now, now)
+    return result
+
+def _plain(value, name, is_now, now):
+    t = type(value)
+    if t in PLAIN_TYPES:
+        return value
+    seconds = query.time_seconds(value)
+    if seconds is not None:
+        if isinstance(value, DateTime):
+            kind = DATETIME_TIME
+        elif value.tzinfo is None:
+            kind = NAIVE_TIME
+        else:
+            kind = AWARE_TIME
+        if is_now(value, name):
+            return (TIME_TAG, kind, seconds - now, True)
+        return (TIME_TAG, kind, seconds, False)
+    if t is types.ListType:
+        return [_plain(v, name, is_now, now) for v in value]
+    if t is types.TupleType:
+        return tuple([_plain(v, name, is_now, now) for v in value])
+    if (t is types.DictType) \
+        or (hasattr(value, 'keys') and hasattr(value, 'query')):
+        # A ZPublisher record is stored as a dictionary, which indexes
+        # accept as well
+        result = {}
+        for k in value.keys():
+            if type(k) not in PLAIN_TYPES:
+                raise ValueError("Unable to store %r" % (k,))
+            if t is types.DictType:
+                v = value[k]
+            else:
+                v = getattr(value, k)
+            result[k] = _plain(v, name, is_now, now)
+        return result
+    raise ValueError("Unable to store %r" % (value,))
+
+def absolute(value, now=None):
+    """
+    Return query arguments value as returned by relative with times
+    restored and those relative to now shifted to now.
+    """
+    if now is None:
+        now = time.time()
+    t = type(value)
+    if t is types.TupleType:
+        if (len(value) == 4) and (value[0] == TIME_TAG):
+            return _time(value, now)
+        return tuple([absolute(v, now) for v in value])
+    if t is types.DictType:
+        return dict([(k, absolute(v, now)) for k, v in value.items()])
+    if t is types.ListType:
+        return [absolute(v, now) for v in value]
+    return value
+
+def _time(value, now):
+    tag, kind, seconds, is_relative = value
+    if is_relative:
+        seconds = now + seconds
+    if kind == NAIVE_TIME:
+        return datetime.fromtimestamp(seconds)
+    if kind == AWARE_TIME:
+        return datetime.fromtimestamp(seconds, _utc)
+    return DateTime(seconds)
+
+def dump(record):
+    """
+    Returns: the entries of record as a string
+    """
+    entries = []
+    for canonical, count, args in record.top():
+        if args is not None:
+            entries.append((canonical, count, args))
+    return RECORD_FORMAT + marshal.dumps(entries)
+
+def restore(record, data):
+    """
+    Merge the entries of data, as returned by dump, into record. data is
+    read from the cache, which is shared, so it is not unpickled.
+    """
+    if not (isinstance(data, types.StringType) \
+            and data.startswith(RECORD_FORMAT)):
+        LOG.warning("Ignoring a query record of an unknown format")
+        return
+    try:
+        entries = marshal.loads(data[len(RECORD_FORMAT):])
+        for canonical, count, args in entries:
+            if isinstance(canonical, types.StringType) \
+                and (type(count) in (types.IntType, types.LongType)) \
+                and isinstance(args, types.DictType):
+                record.merge(canonical, count, args)
+    except Exception:
+        LOG.warning("Ignoring a corrupt query record")
+
+def _replay(catalog, args):
+    # The sort arguments are applied by searchResults
+    catalog.searchResults(None, **absolute(args))
+
+def warm_up(catalog, queries, threads=4, wait=True):
+    """
+    Replay queries, a list of dictionaries as returned by relative, on
+    catalog from threads worker threads. Each query is replayed in a
+    transaction of its own which is committed, so that its result is
+    written to the cache.
+
+    Returns: the number of queries which are replayed
+    """
+    location = locate(catalog)
+    if (location is None) or not queries:
+        return 0
+    queries = list(queries)
+    lock = threading.Lock()
+
+    def work():
+        while 1:
+            lock.acquire()
+            try:
+                if not queries:
+                    return
+                args = queries.pop(0)
+            finally:
+                lock.release()
+            call_catalog(location, _replay, args)
+
+    count = len(queries)
+    workers = []
+    for i in range(max(1, min(threads, count))):
+        worker = threading.Thread(target=work, name='catalogcache-warmup')
+        worker.setDaemon(True)
+        worker.start()
+        workers.append(worker)
+    if wait:
+        for worker in workers:
+            worker.join()
+    LOG.info("Warming up %s with %s queries" % ('/'.join(location[2]), count))
+    return count
@@ -0,0 +1,168 @@
+import threading
+
+from Products.ZCatalog.Catalog import LOG
+
+class WriteBehind(object):
+    """
+    Writes values to the cache from a background thread so that committing
+    transactions do not wait for the cache.
+
+    Pending values are coalesced per key, so only the latest value of a key
+    is written, and are written in chunks. The number of pending keys is
+    bounded. Values which do not fit are dropped, which is safe since the
+    cache is only an optimisation.
+
+    Keys which are discarded are not written, even if they were already
+    taken for writing. Keys which are discarded while their chunk is being
+    written are deleted again once it has been written.
+    """
+
+    def __init__(self, write, max_keys=100000, chunk_size=500, delete=None):
+        # write is called with a dictionary of prefixed keys to values and
+        # delete with a list of prefixed keys
+        self.write = write
+        self.delete = delete
+        self.max_keys = max_keys
+        self.chunk_size = chunk_size
+        self.pending = {}
+        self.condition = threading.Condition(threading.Lock())
+        self.thread = None
+        self.dropped = 0
+        # Every discard has a sequence number. Keys discarded while chunks
+        # are being written map to the number of their latest discard.
+        self.sequence = 0
+        self.discarded = {}
+        self.writing = 0
+
+    def enqueue(self, to_set):
+        """
+        Returns: the number of keys which were dropped
+        """
+        dropped = 0
+        self.condition.acquire()
+        try:
+            pending = self.pending
+            for k, v in to_set.items():
+                if (len(pending) >= self.max_keys) and not pending.has_key(k):
+                    dropped += 1
+                    continue
+                pending[k] = v
+            self.dropped += dropped
+            self._start()
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        if dropped:
+            LOG.debug("Write behind queue is full. Dropped %s keys." % dropped)
+        return dropped
+
+    def discard(self, keys):
+        """
+        Forget pending values of keys, eg. because they are being deleted.
+        """
+        self.condition.acquire()
+        try:
+            self.sequence += 1
+            sequence = self.sequence
+            pending = self.pending
+            discarded = self.discarded
+            writing = self.writing
+            for k in keys:
+                if pending.has_key(k):
+                    del pending[k]
+                if writing:
+                    discarded[k] = sequence
+        finally:
+            self.condition.release()
+
+    def flush(self):
+        """
+        Write all pending values from the calling thread
+        """
+        while 1:
+            chunk, sequence = self._take(block=False)
+            if not chunk:
+                break
+            self._write(chunk, sequence)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _start(self):
+        # Called with the condition held
+        if (self.thread is not None) and self.thread.isAlive():
+            return
+        self.thread = threading.Thread(target=self._run,
+                                       name='catalogcache-writer')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _take(self, block=True):
+        """
+        Returns: (chunk of pending values, discard sequence number). A
+        chunk which is not empty must be passed to _write.
+        """
+        self.condition.acquire()
+        try:
+            while block and not self.pending:
+                self.condition.wait()
+            chunk = {}
+            pending = self.pending
+            for i in range(min(self.chunk_size, len(pending))):
+                k, v = pending.popitem()
+                chunk[k] = v
+            if chunk:
+                self.writing += 1
+            return chunk, self.sequence
+        finally:
+            self.condition.release()
+
+    def _write(self, chunk, sequence):
+        """
+        Write chunk, which was taken as of discard number sequence
+        """
+        self.condition.acquire()
+        try:
+            chunk = self._undiscarded(chunk, sequence)
+            sequence = self.sequence
+        finally:
+            self.condition.release()
+        try:
+            if chunk:
+                self.write(chunk)
+        except Exception:
+            LOG.exception("Write behind of %s keys failed" % len(chunk))
+
+        self.condition.acquire()
+        try:
+            # The deletes of keys discarded during the write may have been
+            # done before the write
+            late = [k for k in chunk.keys() \
+                    if self.discarded.get(k, 0) > sequence]
+            self.writing -= 1
+            if not self.writing:
+                self.discarded.clear()
+        finally:
+            self.condition.release()
+        if late and (self.delete is not None):
+            try:
+                self.delete(late)
+            except Exception:
+                LOG.exception("Write behind delete of %s keys failed" \
+                    % len(late))
+
+    def _undiscarded(self, chunk, sequence):
+        # Called with the condition held
+        discarded = self.discarded
+        if not discarded:
+            return chunk
+        result = {}
+        for k, v in chunk.items():
+            if discarded.get(k, 0) <= sequence:
+                result[k] = v
+        return result
+
+    def _run(self):
+        while 1:
+            chunk, sequence = self._take()
+            self._write(chunk, sequence)